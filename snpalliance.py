@@ -1,6 +1,6 @@
 #
 # Input: Alliance Feed
-# Output:  SNP_ALLIANCE_TSV, 1 per Chromosome
+# Output:  SNP_ALLIANCE_TSV.<chr>.tsv, 1 per Chromosome, sorted & without duplicate rows
 #
 #   SNP ID
 #   MGI ID
@@ -13,20 +13,73 @@
 # For each VCF file (1 per Chromosome)
 #   create a corresponding TSV
 #
- 
-import sys 
+# The VCF files are processed SNP_ALLIANCE_WORKERS at a time
+# (1 process per file; 1 = one after another), largest first: estimated by
+# their runtime in SNP_ALLIANCE_RUNTIME_FILE, or by their size (see snpschedule.py)
+#
+# The rows are sorted & de-duplicated in memory, SNP_ALLIANCE_SORT_ROWS
+# rows at a time (see SortedTSVWriter); same lines, in the same order, as
+# "sort | uniq" in the locale of the environment (LC_COLLATE)
+#
+# Each TSV also gets a binary index, SNP_ALLIANCE_TSV.<chr>.tsv.idx, that
+# snpmrkwithin.py memory-maps instead of parsing the TSV (see writeIndex)
+#
+# If SNP_ALLIANCE_KEYS=yes, each TSV also gets a key index,
+# SNP_ALLIANCE_TSV.<chr>.tsv.keys: the SNP IDs are resolved to _ConsensusSnp_key
+# and the MGI IDs to _Marker_key (bulk lookups, see writeKeyIndex), so that
+# snpmrkwithin.py can match the Alliance rows without querying the accids.
+# The key index must be re-created (snpalliance.sh) after a SNP or marker reload.
+#
+
+import sys
 import os
+import time
 import gzip
+import heapq
+import locale
+import struct
+import multiprocessing
+from array import array
 import db
+import snpschedule
 
 db.setTrace(True)
 
 # list of chromosomes to process
-chrList = [
-'1','2','3','4','5','6','7','8','9','10',
-'11','12','13','14','15','16','17','18','19',
-'X','Y','MT'
-]
+chrList = snpschedule.chrList
+
+# number of VCF files to process at the same time
+WORKERS = int(os.environ.get('SNP_ALLIANCE_WORKERS', '1'))
+
+# runtime of each VCF file in the last run (the estimates of the schedule)
+RUNTIME_FILE = os.environ.get('SNP_ALLIANCE_RUNTIME_FILE')
+
+# number of bytes buffered before writing them to the TSV
+BUFFER = 8 * 1024 * 1024
+
+# max number of (unique) rows sorted in memory; more are sorted in runs & merged
+SORT_ROWS = int(os.environ.get('SNP_ALLIANCE_SORT_ROWS', '5000000'))
+
+# the rows are sorted as sort(1) sorts them: in the collation order of the
+# locale of the environment, ties broken by the characters (see SortedTSVWriter);
+# in the C locale, that is just the order of the characters
+try:
+    COLLATE = locale.setlocale(locale.LC_COLLATE, '')
+except locale.Error:
+    # as sort(1) does
+    COLLATE = locale.setlocale(locale.LC_COLLATE, 'C')
+
+# binary index header: magic, number of keys, number of fxn keys
+# (must match snpmrkwithin.AllianceIndex)
+INDEX_MAGIC = b'SNPALX1\0'
+INDEX_HEADER = '<8sQQ'
+
+# yes = also write the key index (_Marker_key/_ConsensusSnp_key) of each TSV
+KEYS = os.environ.get('SNP_ALLIANCE_KEYS', 'no') == 'yes'
+KEYS_MAGIC = b'SNPALK1\0'
+
+# max number of SNP IDs in a SNP_Accession lookup query
+LOOKUP_BATCH = 10000
 
 #
 # SNP Function Class -> Marker Function Class translator
@@ -48,56 +101,379 @@ for r in results:
     fxnLookup[key].append(value)
 #print(fxnLookup)
 
-for chr in chrList:
+#
+# MGI ID -> _Marker_key (preferred MGI IDs, as in snpmrkwithin.markerQuery)
+#
+markerLookup = {}
+if KEYS:
+    results = db.sql('''
+    select a.accid, a._object_key
+    from acc_accession a
+    where a._mgitype_key = 2
+    and a._logicaldb_key = 1
+    and a.preferred = 1
+    ''', 'auto')
+    for r in results:
+        markerLookup[r['accid']] = r['_object_key']
+
+#
+# SNP Term -> end of the TSV row(s) for that term ("SNP Term|Term key|MGD Term\n")
+#
+fxnRows = {}
+for term in fxnLookup:
+    fxnRows[term] = [term + '|' + str(t['_term_key']) + '|' + t['term'] + '\n' for t in fxnLookup[term]]
+
+# Purpose: Return the sort key of a TSV row: its collation key in COLLATE
+#          and, for the rows that collate the same, the row itself
+# Returns: (collation key, row)
+# Assumes: COLLATE is not the C locale (sortKey is None then)
+# Effects: Nothing
+# Throws:  Nothing
+
+def collationKey(row):
+    return (locale.strxfrm(row), row)
+
+if COLLATE in ('C', 'POSIX') or COLLATE.startswith('C.'):
+    sortKey = None
+else:
+    sortKey = collationKey
+
+# Purpose: Writer of a sorted TSV without duplicate rows
+#          The rows are collected in a set; every SORT_ROWS (unique) rows, they are
+#          sorted & written to a temporary run file (fileName.run.N).
+#          close() writes fileName: the sorted set if there are no runs, otherwise
+#          the merged runs, skipping duplicate rows.
+#          The rows are sorted by sortKey, so the result is the same as
+#          "sort fileName | uniq" in the locale of the environment (COLLATE).
+
+class SortedTSVWriter:
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.rows = set()
+        self.runs = []
+        self.written = 0
+
+    # Purpose: Add one row ('\n' terminated)
+    # Returns: Nothing
+    # Assumes: Nothing
+    # Effects: May write a run file
+    # Throws:  Nothing
+
+    def add(self, row):
+        self.rows.add(row)
+        if len(self.rows) >= SORT_ROWS:
+            self.writeRun()
+
+    # Purpose: Write the collected rows, sorted, to a new run file
+    # Returns: Nothing
+    # Assumes: Nothing
+    # Effects: Writes a file
+    # Throws:  Nothing
+
+    def writeRun(self):
+        runFile = '%s.run.%s' % (self.fileName, len(self.runs))
+        with open(runFile, 'w', buffering = BUFFER) as fp:
+            fp.writelines(sorted(self.rows, key = sortKey))
+        self.runs.append(runFile)
+        self.rows = set()
+
+    # Purpose: Write fileName
+    # Returns: Nothing
+    # Assumes: Nothing
+    # Effects: Writes fileName, removes the run files
+    # Throws:  Nothing
+
+    def close(self):
+        with open(self.fileName, 'w', buffering = BUFFER) as fp:
+            if not self.runs:
+                rows = sorted(self.rows, key = sortKey)
+                fp.writelines(rows)
+                self.written = len(rows)
+                self.rows = set()
+                return
+
+            self.writeRun()
+            runs = [open(runFile, 'r', buffering = BUFFER) for runFile in self.runs]
+            previous = None
+            for row in heapq.merge(*runs, key = sortKey):
+                if row != previous:
+                    fp.write(row)
+                    self.written = self.written + 1
+                    previous = row
+            for run in runs:
+                run.close()
+
+        for runFile in self.runs:
+            os.remove(runFile)
+
+# Purpose: Read the rows of a TSV, grouped by SNP ID/MGI ID pair
+#          (the fxn keys of a pair in TSV order; in a locale other than C,
+#          the rows of a pair need not be contiguous in the sorted TSV)
+#          Rows whose SNP ID is not rs<n> or MGI ID not MGI:<n> can never match
+#          a ConsensusSnp/marker accid and are left out.
+# Returns: (list of (SNP ID, MGI ID, [fxnKey, ...]), number of rows left out)
+# Assumes: Nothing
+# Effects: Reads a file
+# Throws:  Nothing
+
+def readGroups(tsvFile):
+
+    groups = []
+    pairs = {}
+    skipped = 0
+
+    with open(tsvFile, 'r', buffering = BUFFER) as fp:
+        for line in fp:
+            tokens = line.split('|', 5)
+            pair = tokens[0] + '|' + tokens[1]
+            if pair not in pairs:
+                group = None
+                if tokens[0].startswith('rs') and tokens[0][2:].isdigit() \
+                        and tokens[1].startswith('MGI:') and tokens[1][4:].isdigit() \
+                        and int(tokens[0][2:]) < 2**32 and int(tokens[1][4:]) < 2**32:
+                    group = (tokens[0], tokens[1], [])
+                    groups.append(group)
+                pairs[pair] = group
+            group = pairs[pair]
+            if group is None:
+                skipped = skipped + 1
+                continue
+            group[2].append(int(tokens[4]))
+
+    return groups, skipped
+
+# Purpose: Write a binary index (see writeIndex)
+# Returns: number of keys
+# Assumes: Nothing
+# Effects: Writes a file
+# Throws:  Nothing
+
+def writeIndexFile(fileName, magic, groups):
+
+    groups.sort(key = lambda g: g[0])
+
+    keys = array('Q', [g[0] for g in groups])
+    offsets = array('I', [0])
+    fxnKeys = array('I')
+    for key, fxn in groups:
+        fxnKeys.extend(fxn)
+        offsets.append(len(fxnKeys))
+
+    with open(fileName, 'wb') as fp:
+        fp.write(struct.pack(INDEX_HEADER, magic, len(keys), len(fxnKeys)))
+        keys.tofile(fp)
+        offsets.tofile(fp)
+        fxnKeys.tofile(fp)
+
+    return len(keys)
+
+# Purpose: Write the binary index of a TSV (tsvFile.idx)
+#
+#          header  : INDEX_MAGIC, N (number of keys), M (number of fxn keys)
+#          keys    : N uint64, MGI number << 32 | rs number, ascending
+#          offsets : N + 1 uint32; the fxn keys of keys[i] are fxnKeys[offsets[i]:offsets[i + 1]]
+#          fxnKeys : M uint32 term keys, in TSV order
+#          (native byte order)
+#
+#          So the rows of a marker are a contiguous range of keys.
+# Returns: number of keys
+# Assumes: groups is the result of readGroups()
+# Effects: Writes a file
+# Throws:  Nothing
+
+def writeIndex(tsvFile, groups):
+
+    return writeIndexFile(tsvFile + '.idx', INDEX_MAGIC,
+        [(int(mgiid[4:]) << 32 | int(rsid[2:]), fxn) for rsid, mgiid, fxn in groups])
+
+# Purpose: Resolve SNP IDs to _ConsensusSnp_keys, LOOKUP_BATCH IDs per query
+#          (a SNP ID may resolve to more than one key)
+# Returns: dictionary of SNP ID -> [_ConsensusSnp_key, ...]
+# Assumes: the SNP IDs are rs<n> (see readGroups)
+# Effects: Queries a database
+# Throws:  Nothing
+
+def lookupSNPs(snpIds):
+
+    snpLookup = {}
+    snpIds = sorted(snpIds)
+
+    for i in range(0, len(snpIds), LOOKUP_BATCH):
+        results = db.sql('''
+            select a.accid, a._object_key
+            from snp_accession a
+            where a._mgitype_key = 30
+            and a.accid in ('%s')
+            ''' % ("','".join(snpIds[i:i + LOOKUP_BATCH])), 'auto')
+        for r in results:
+            if r['accid'] not in snpLookup:
+                snpLookup[r['accid']] = []
+            snpLookup[r['accid']].append(r['_object_key'])
+
+    return snpLookup
+
+# Purpose: Write the key index of a TSV (tsvFile.keys)
+#          Same format as the binary index (see writeIndex), with KEYS_MAGIC
+#          and keys _Marker_key << 32 | _ConsensusSnp_key.
+#          The MGI IDs are resolved by markerLookup, the SNP IDs by lookupSNPs;
+#          rows whose IDs do not resolve are left out.
+# Returns: (number of keys, number of SNP ID/MGI ID pairs that did not resolve)
+# Assumes: groups is the result of readGroups()
+# Effects: Queries a database, Writes a file
+# Throws:  Nothing
+
+def writeKeyIndex(tsvFile, groups):
+
+    snpLookup = lookupSNPs(set([g[0] for g in groups]))
+
+    keyGroups = {}
+    unresolved = 0
+    for rsid, mgiid, fxn in groups:
+        markerKey = markerLookup.get(mgiid)
+        snpKeys = snpLookup.get(rsid)
+        if markerKey is None or snpKeys is None:
+            unresolved = unresolved + 1
+            continue
+        for snpKey in snpKeys:
+            key = markerKey << 32 | snpKey
+            if key not in keyGroups:
+                keyGroups[key] = []
+            keyGroups[key].extend(fxn)
+
+    return writeIndexFile(tsvFile + '.keys', KEYS_MAGIC, list(keyGroups.items())), unresolved
+
+# Purpose: Return the CSQ properties of a VCF INFO column
+#          (the ';' separated properties that start with 'CSQ')
+# Returns: list of strings
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def csqProperties(info):
+
+    properties = []
+
+    if info.startswith('CSQ'):
+        pos = 0
+    else:
+        pos = info.find(';CSQ')
+        if pos >= 0:
+            pos = pos + 1
+
+    while pos >= 0:
+        end = info.find(';', pos)
+        if end < 0:
+            properties.append(info[pos:])
+            break
+        properties.append(info[pos:end])
+        pos = info.find(';CSQ', end)
+        if pos >= 0:
+            pos = pos + 1
+
+    return properties
+
+# Purpose: Create the TSV of one chromosome from its VCF file
+#          For each consequence entry of each CSQ property whose gene is an
+#          MGI ID, write 1 row per (translated) consequence term.
+#          Only the needed CSQ fields (consequence, symbol, MGI ID) are split out.
+#          The TSV is sorted & has no duplicate rows (see SortedTSVWriter).
+#          Then writes the binary index of the TSV (see writeIndex),
+#          and if KEYS, its key index (see writeKeyIndex).
+# Returns: number of rows written, or None if the VCF file could not be read
+# Assumes: Nothing
+# Effects: Reads the VCF file, writes the TSV & its index, queries a database
+# Throws:  Nothing
+
+def processVCF(chr):
 
     try:
         vep = 'MGI.vep.' + str(chr) + '.vcf.gz'
         inFile = gzip.open(os.environ['SNP_ALLIANCE_INPUT'] + vep, 'rt')
-        outFile = open(os.environ['SNP_ALLIANCE_TSV'] + '.' + str(chr), 'w')
+        outFile = SortedTSVWriter(os.environ['SNP_ALLIANCE_TSV'] + '.' + str(chr) + '.tsv')
     except:
-        inFile.close()
-        continue
+        print('processVCF(): cannot process %s' % (vep))
+        return None
 
-    for line in inFile:
+    rows = 0
 
-        if line.startswith("##"):
-            #print(line)
-            continue
+    for line in inFile:
 
-        if line.startswith("#"):
-            #print(line)
+        if line[0] == '#':
             continue
 
-        #if line.find("MGI:1351639") <= -1:
-        #    continue
-
-        columns = line.split('\t')
+        columns = line.split('\t', 8)
         rsid = columns[2]
 
-        # split col 7 by ';'
-        properties = columns[7].split(';')
-        for property in properties:
-            # if starts with CSQ
-            if property.startswith('CSQ'):
-                # split by ',' to find consequence entries
-                centries = property.split(',')
-                for entry in centries:
-                    fields = entry.split('|')
-                    if not fields[4].startswith("MGI:") :
-                        continue
-                    cterms = fields[1].split('&')
-                    symbol = fields[3]
-                    mgiid = fields[4]
-                    for term in cterms:
-                        if term in fxnLookup:
-                            for t in fxnLookup[term]:
-                                outFile.write(rsid + "|" + \
-                                    mgiid + "|" + \
-                                    symbol + "|" + \
-                                    term + "|" + \
-                                    str(t['_term_key']) + "|" + \
-                                    t['term'] + "\n")
+        for property in csqProperties(columns[7]):
+            # split by ',' to find consequence entries
+            for entry in property.split(','):
+                fields = entry.split('|', 5)
+                mgiid = fields[4]
+                if not mgiid.startswith('MGI:'):
+                    continue
+                prefix = rsid + '|' + mgiid + '|' + fields[3] + '|'
+                for term in fields[1].split('&'):
+                    if term in fxnRows:
+                        for suffix in fxnRows[term]:
+                            outFile.add(prefix + suffix)
+                            rows = rows + 1
 
+    inFile.close()
     outFile.close()
 
-inFile.close()
+    groups, skipped = readGroups(outFile.fileName)
+    keys = writeIndex(outFile.fileName, groups)
+    if skipped:
+        print('processVCF(): %s: %s rows without rs/MGI ids not indexed' % (vep, skipped))
+
+    print('processVCF(): %s: %s rows, %s unique rows, %s sort runs, %s index keys' \
+        % (vep, rows, outFile.written, len(outFile.runs), keys))
+
+    if KEYS:
+        db.useOneConnection(1)
+        keys, unresolved = writeKeyIndex(outFile.fileName, groups)
+        db.useOneConnection(0)
+        print('processVCF(): %s: %s key index keys, %s SNP ID/MGI ID pairs not resolved' \
+            % (vep, keys, unresolved))
+
+    sys.stdout.flush()
+
+    return outFile.written
+
+# Purpose: Process the VCF file of a chromosome (see processVCF) & time it
+# Returns: wall seconds, or None if the VCF file could not be read
+# Assumes: Nothing
+# Effects: see processVCF
+# Throws:  Nothing
+
+def vcfWorker(chr):
+
+    startTime = time.time()
+    if processVCF(chr) is None:
+        return None
+    return time.time() - startTime
+
+#
+#  MAIN
+#
+
+if WORKERS > 1:
+    costs = {}
+    for chr in chrList:
+        costs[chr] = snpschedule.fileSize(os.environ['SNP_ALLIANCE_INPUT'] + 'MGI.vep.' + str(chr) + '.vcf.gz')
+    estimates = snpschedule.estimate(chrList, costs, snpschedule.readRuntimes(RUNTIME_FILE))
+    schedule = snpschedule.largestFirst(chrList, estimates)
+    snpschedule.printSchedule('snpalliance.py', schedule, estimates)
+
+    # fork, so that the workers inherit fxnRows
+    pool = multiprocessing.get_context('fork').Pool(WORKERS)
+    times = pool.map(vcfWorker, schedule, 1)
+    pool.close()
+    pool.join()
+else:
+    schedule = chrList
+    times = [vcfWorker(chr) for chr in chrList]
+
+snpschedule.saveRuntimes(RUNTIME_FILE, dict([(chr, t) for chr, t in zip(schedule, times) if t is not None]))
+
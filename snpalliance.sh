@@ -6,7 +6,8 @@
 #
 # For each chromosome
 #	. copy each Alliance vep/vcf ($SNP_ALLIANCE_INPUT) to the /data/loads/mgi/snpcacheload/output folder
-#	. sort & uniq the file -> chr.tsv
+#	  sorted (as sort(1) in the current locale) & uniq -> chr.tsv, + binary index chr.tsv.idx (by snpalliance.py)
+#	  + key index chr.tsv.keys if SNP_ALLIANCE_KEYS=yes
 #
 # The TSV files remain static until this script is run again.
 # This script should be run again if a new Alliance vep/vcf file is mirroed via mirror_wget/alliancegenome.org.variants
@@ -40,12 +41,7 @@ cd ${CACHEDATADIR}
 
 date >> ${LOG} 2>&1
 echo "Process SNP Alliance Feed TSV files"  >> ${LOG} 2>&1
+rm -rf *.tsv *.tsv.idx *.tsv.keys
 ${PYTHON} ${SNPCACHELOAD}/snpalliance.py >> ${LOG} 2>&1
-rm -rf *.tsv
-for i in `ls snpalliance.output.*`
-do
-sort ${i} | uniq > ${i}.tsv
-rm -rf ${i}
-done
 date >> ${LOG} 2>&1
 
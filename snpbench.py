@@ -0,0 +1,169 @@
+#  snpbench.py
+###########################################################################
+#
+#  Purpose:
+#
+#      Compare the snpmrkwithin.py join engines (SNPMRK_ENGINE) on the
+#      same chromosomes: each engine creates the bcp file of a chromosome
+#      in a separate process, and the wall time, CPU time & number of rows
+#      of each run are reported, with the md5 of its bcp file (the engines
+#      must create the same file).
+#
+#      Used to decide which chromosomes (if any) to give the sql engine
+#      (SNPMRK_SQL_CHROMOSOMES).
+#
+#  Usage:
+#
+#      snpbench.py [-e engine,...] [-o dir] [chr ...]
+#
+#      -e : engines to compare (default: pair,batch,sql)
+#      -o : directory of the bench bcp files (default: ${CACHEDATADIR});
+#           the files are removed when done
+#      chr : chromosomes to compare (default: 19)
+#
+#  Env Vars:
+#
+#      same as snpmrkwithin.py
+#
+#  Outputs:
+#
+#      one line per chromosome & engine: SNPs of the chromosome, rows,
+#      wall & CPU seconds, rows/sec, md5 of the bcp file
+#
+#  Exit Codes:
+#
+#      0:  Successful completion
+#      1:  An engine failed, or the engines created different bcp files
+#
+###########################################################################
+
+import sys
+import os
+import time
+import hashlib
+import resource
+import multiprocessing
+import db
+import snpmrkwithin
+
+#
+#  CONSTANTS
+#
+
+ENGINES = ['pair', 'batch', 'sql']
+CHROMOSOMES = ['19']
+
+# Purpose: Create the bcp file of chr with one engine
+#          (run in a child process, so each engine starts from the same state)
+# Returns: Nothing
+# Assumes: snpmrkwithin.initialize() has been called
+# Effects: Queries a database, Outputs to bcpFile
+# Throws:  Nothing
+
+def runEngine(engine, chr, bcpFile):
+
+    snpmrkwithin.ENGINE = engine
+    snpmrkwithin.SQL_CHROMOSOMES = []
+    snpmrkwithin.primaryKey = 1
+
+    db.useOneConnection(1)
+    snpmrkwithin.processChromosome(chr, bcpFile)
+    db.useOneConnection(0)
+
+    sys.stdout.flush()
+
+    return
+
+# Purpose: Run one engine on chr & measure it
+# Returns: dictionary: wall, cpu (seconds), rows, md5 of the bcp file;
+#          None if the engine failed
+# Assumes: Nothing
+# Effects: Queries a database, creates & removes bcpFile
+# Throws:  Nothing
+
+def benchEngine(engine, chr, bcpFile):
+
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    startTime = time.time()
+
+    p = multiprocessing.get_context('fork').Process(target = runEngine, args = (engine, chr, bcpFile))
+    p.start()
+    p.join()
+
+    wall = time.time() - startTime
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    if p.exitcode != 0 or not os.path.exists(bcpFile):
+        return None
+
+    md5 = hashlib.md5()
+    rows = 0
+    with open(bcpFile, 'rb') as fp:
+        for line in fp:
+            md5.update(line)
+            rows = rows + 1
+    os.remove(bcpFile)
+
+    return {'wall' : wall,
+            'cpu' : (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+            'rows' : rows,
+            'md5' : md5.hexdigest()}
+
+#
+#  MAIN
+#
+
+engines = ENGINES
+outputDir = os.environ['CACHEDATADIR']
+
+args = sys.argv[1:]
+while args[:1] in (['-e'], ['-o']) and len(args) > 1:
+    if args[0] == '-e':
+        engines = args[1].split(',')
+    else:
+        outputDir = args[1]
+    args = args[2:]
+
+chromosomes = args or CHROMOSOMES
+
+for engine in engines:
+    if engine not in ENGINES:
+        sys.stderr.write('Usage: snpbench.py [-e engine,...] [-o dir] [chr ...]\n')
+        sys.stderr.write('Unknown engine: %s (engines: %s)\n' % (engine, ','.join(ENGINES)))
+        sys.exit(1)
+
+snpmrkwithin.initialize()
+
+results = []
+for chr in chromosomes:
+    snpCount = snpmrkwithin.snpChecksum(chr, 1, snpmrkwithin.maxCoordinate(chr))[3]
+    for engine in engines:
+        print('snpbench.py: chromosome %s, engine %s' % (chr, engine))
+        sys.stdout.flush()
+        bcpFile = '%s/snpbench.%s.%s.bcp' % (outputDir, engine, chr)
+        results.append((chr, snpCount, engine, benchEngine(engine, chr, bcpFile)))
+
+failed = 0
+
+print('\n%-5s %10s %-6s %10s %10s %10s %12s  %s' % ('chr', 'SNPs', 'engine', 'rows', 'wall', 'cpu', 'rows/sec', 'md5'))
+for chr, snpCount, engine, r in results:
+    if r is None:
+        print('%-5s %10s %-6s FAILED' % (chr, snpCount, engine))
+        failed = 1
+        continue
+    print('%-5s %10s %-6s %10s %10.1f %10.1f %12.0f  %s' % (chr, snpCount, engine, r['rows'], \
+        r['wall'], r['cpu'], r['rows'] / max(r['wall'], 0.001), r['md5']))
+
+print('')
+for chr in chromosomes:
+    runs = [(r['wall'], engine, r['md5']) for c, snpCount, engine, r in results if c == chr and r is not None]
+    if not runs:
+        continue
+    runs.sort()
+    print('chromosome %s: fastest engine: %s (%.1f sec)' % (chr, runs[0][1], runs[0][0]))
+    if len(set([md5 for wall, engine, md5 in runs])) > 1:
+        print('chromosome %s: ERROR: the engines created different bcp files' % (chr))
+        failed = 1
+
+sys.stdout.flush()
+sys.exit(failed)
@@ -0,0 +1,44 @@
+#!/bin/sh
+
+#
+# This script is a wrapper around snpbench.py, which compares the
+# snpmrkwithin.py join engines (SNPMRK_ENGINE) on the same chromosomes.
+#     snpbench.sh [-e engine,...] [chr ...]
+#
+# For each chromosome & engine
+#	. create the bcp file of the chromosome in ${CACHEDATADIR}
+#	. report wall & CPU time, rows, rows/sec & md5 of the bcp file
+#
+# The bcp files are removed when done; nothing is loaded.
+# Use the report to set SNPMRK_ENGINE/SNPMRK_SQL_CHROMOSOMES in Configuration.
+#
+
+cd `dirname $0` 
+
+COMMON_CONFIG=Configuration
+
+#
+# Make sure the common configuration file exists and source it. 
+#
+if [ -f ${COMMON_CONFIG} ]
+then
+    . ${COMMON_CONFIG}
+else
+    echo "Missing configuration file: ${COMMON_CONFIG}"
+    exit 1
+fi
+
+#
+# Initialize the log file.
+# open LOG in append mode and redirect stdout
+#
+LOG=${CACHELOGSDIR}/snpbench.log
+rm -rf ${LOG}
+>>${LOG}
+
+date >> ${LOG} 2>&1
+echo "Compare snpmrkwithin.py engines"  >> ${LOG} 2>&1
+${PYTHON} ${SNPCACHELOAD}/snpbench.py "$@" >> ${LOG} 2>&1
+STAT=$?
+date >> ${LOG} 2>&1
+exit ${STAT}
@@ -1,15 +1,12 @@
 import sys 
 import os
 import db
+import snpschedule
 
 db.setTrace(True)
 
 # list of chromosomes to process
-chrList = [
-'1','2','3','4','5','6','7','8','9','10',
-'11','12','13','14','15','16','17','18','19',
-'X','Y','MT'
-]
+chrList = snpschedule.chrList
 
 print("\ntotal count in Production (zSNP_ConsensusSnp_Marker)")
 results = db.sql(''' select count(*) as counter from zSNP_ConsensusSnp_Marker ''', 'auto')
@@ -0,0 +1,120 @@
+#  snpdirection.py
+###########################################################################
+#
+#  Purpose:
+#
+#      Classify SNP/marker pairs by the direction & distance of the SNP
+#      from the marker, for snpmrkwithin.py (within distance of; the pair,
+#      batch & sql engines) and snpmrklocus.py (locus-region):
+#
+#      . a SNP at or left of the marker midpoint is on the left of the marker:
+#        distance = markerStart - snpLoc
+#      . a SNP right of the marker midpoint is on the right of the marker:
+#        distance = snpLoc - markerEnd
+#
+#      and the direction depends on the marker strand (STRAND_DIRECTIONS):
+#
+#        strand       left         right
+#        +            upstream     downstream
+#        -            downstream   upstream
+#        None or .    proximal     distal
+#
+#      ('.' : VISTA and Ensembl Regulatory features loaded as Gene Models,
+#      because seq_coord_cache does not allow nulls)
+#
+#      Any other strand is not classified: its direction & distance are None.
+#
+#  Usage:
+#
+#      import snpdirection
+#
+#      directions, distances = snpdirection.classify(snpLocs, markerStarts, markerEnds, markerStrands)
+#      direction, distance = snpdirection.classifyPair(snpLoc, markerStart, markerEnd, markerStrand)
+#      sql = snpdirection.sqlDirection('s.startCoordinate', 'm.markerStart', 'm.markerEnd', 'm.markerStrand')
+#
+###########################################################################
+
+# marker strand -> (direction of SNPs left of the marker midpoint,
+#                   direction of SNPs right of the marker midpoint)
+STRAND_DIRECTIONS = {
+    '+' : ('upstream', 'downstream'),
+    '-' : ('downstream', 'upstream'),
+    None : ('proximal', 'distal'),
+    '.' : ('proximal', 'distal'),
+}
+
+# directions of a strand that is not classified
+UNCLASSIFIED = (None, None)
+
+# Purpose: Classify a batch of SNP/marker pairs in one call
+#          (the same rules as classifyPair, column by column; the midpoint
+#          test 2 * snpLoc <= markerStart + markerEnd is the same as
+#          snpLoc <= (markerStart + markerEnd) / 2.0)
+# Returns: (list of directions, list of distances), 1 per pair;
+#          None & None for the pairs whose strand is not classified
+# Assumes: the 4 sequences (lists, arrays...) have the same length
+# Effects: Nothing
+# Throws:  Nothing
+
+def classify(snpLocs, markerStarts, markerEnds, markerStrands):
+
+    lefts = [2 * snpLoc <= markerStart + markerEnd
+             for snpLoc, markerStart, markerEnd in zip(snpLocs, markerStarts, markerEnds)]
+
+    directions = [STRAND_DIRECTIONS.get(markerStrand, UNCLASSIFIED)[0 if left else 1]
+                  for left, markerStrand in zip(lefts, markerStrands)]
+
+    distances = [None if direction is None else (markerStart - snpLoc if left else snpLoc - markerEnd)
+                 for direction, left, snpLoc, markerStart, markerEnd
+                 in zip(directions, lefts, snpLocs, markerStarts, markerEnds)]
+
+    return directions, distances
+
+# Purpose: Classify one SNP/marker pair (see classify)
+# Returns: (direction, distance); (None, None) if the strand is not classified
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def classifyPair(snpLoc, markerStart, markerEnd, markerStrand):
+
+    leftDirection, rightDirection = STRAND_DIRECTIONS.get(markerStrand, UNCLASSIFIED)
+
+    if leftDirection is None:
+        return UNCLASSIFIED
+    if 2 * snpLoc <= markerStart + markerEnd:
+        return leftDirection, markerStart - snpLoc
+    return rightDirection, snpLoc - markerEnd
+
+# Purpose: Return the sql expression of the midpoint test (see classify):
+#          true if the SNP is at or left of the marker midpoint
+# Returns: sql string
+# Assumes: the arguments are sql expressions
+# Effects: Nothing
+# Throws:  Nothing
+
+def sqlLeft(snpLoc, markerStart, markerEnd):
+
+    return '2 * %s <= %s + %s' % (snpLoc, markerStart, markerEnd)
+
+# Purpose: Return the sql case expression of the direction of a SNP/marker
+#          pair, built from STRAND_DIRECTIONS (the same rules as classify)
+# Returns: sql string; the expression is null if the strand is not classified
+# Assumes: the arguments are sql expressions
+# Effects: Nothing
+# Throws:  Nothing
+
+def sqlDirection(snpLoc, markerStart, markerEnd, markerStrand):
+
+    left = sqlLeft(snpLoc, markerStart, markerEnd)
+
+    cases = []
+    for strand, (leftDirection, rightDirection) in STRAND_DIRECTIONS.items():
+        if strand is None:
+            test = '%s is null' % (markerStrand)
+        else:
+            test = "%s = '%s'" % (markerStrand, strand)
+        cases.append("when %s and %s then '%s'" % (test, left, leftDirection))
+        cases.append("when %s then '%s'" % (test, rightDirection))
+
+    return 'case %s end' % (' '.join(cases))
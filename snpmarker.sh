@@ -47,8 +47,120 @@ then
         exit 0
 fi
 
+#
+# drop foreign keys & indexes, truncate SNP_ConsensusSnp_Marker
+#
+truncateTable ()
+{
+date | tee -a ${SNPMARKER_LOG}
+${SNP_DBSCHEMADIR}/key/SNP_ConsensusSnp_Marker_drop.object >> ${SNPMARKER_LOG} 2>&1
+${SNP_DBSCHEMADIR}/index/SNP_ConsensusSnp_Marker_drop.object >> ${SNPMARKER_LOG} 2>&1
+${SNP_DBSCHEMADIR}/table/SNP_ConsensusSnp_Marker_truncate.object >> ${SNPMARKER_LOG} 2>&1
+}
+
+#
+# SNPMRK_SHADOW_LOAD=yes : load & index an empty copy of SNP_ConsensusSnp_Marker
+# (SNP_MRK_SHADOW_TABLE) and swap it in at the end; the live table is not touched until then
+# SNPMRK_SHADOW_LOAD=no  : empty & re-load SNP_ConsensusSnp_Marker in place
+#
+prepareTable ()
+{
+if [ "${SNPMRK_SHADOW_LOAD}" = "yes" ]
+then
+    date | tee -a ${SNPMARKER_LOG}
+    echo "Create ${LOAD_TABLE}" | tee -a ${SNPMARKER_LOG}
+    ${PYTHON} ${SNPCACHELOAD}/snpmrkshadow.py create >> ${SNPMARKER_LOG} 2>&1
+    STAT=$?
+    if [ ${STAT} -ne 0 ]
+    then
+	echo "${SNPCACHELOAD}/snpmrkshadow.py create failed" | tee -a ${SNPMARKER_LOG}
+	exit 1
+    fi
+else
+    truncateTable
+fi
+}
+
+LOAD_TABLE=${SNP_MRK_TABLE}
+if [ "${SNPMRK_SHADOW_LOAD}" = "yes" ]
+then
+    LOAD_TABLE=${SNP_MRK_SHADOW_TABLE}
+fi
+
+#
+# SNPMRK_INCREMENTAL=yes & a state file from the last run :
+# snpmrkwithin.py only re-creates the chromosomes whose inputs changed, and their
+# old rows are deleted & the new rows loaded into SNP_ConsensusSnp_Marker in place
+# (the keys & indexes are kept)
+#
+# otherwise the state file no longer matches the table & is removed
+#
+if [ "${SNPMRK_INCREMENTAL}" = "yes" -a -f ${SNPMRK_STATE_FILE} ]
+then
+
+rm -f ${SNPMRK_STATE_FILE}.new ${SNPMRK_MARKER_FILE}.new
+date | tee -a ${SNPMARKER_LOG}
+echo "Processing snpmrkwithin.py to create the changed SNP_ConsensusSnp_Marker bcp files" | tee -a ${SNPMARKER_LOG}
+${PYTHON} ${SNPCACHELOAD}/snpmrkwithin.py >> ${SNPMARKER_LOG} 2>&1
+STAT=$?
+if [ ${STAT} -ne 0 ]
+then
+	echo "${SNPCACHELOAD}/snpmrkwithin.py failed" | tee -a ${SNPMARKER_LOG}
+	exit 1
+fi
+
+cd ${CACHEDATADIR}
+if [ -s ${SNPMRK_DELETE_FILE} ] || ls ${SNP_MRK_FILE}* > /dev/null 2>&1
+then
+    date | tee -a ${SNPMARKER_LOG}
+    echo "Re-loading the changed chromosomes of SNP_ConsensusSnp_Marker"  | tee -a ${SNPMARKER_LOG}
+    ${PYTHON} ${SNPCACHELOAD}/snpmrkload.py -d ${SNPMRK_DELETE_FILE} `ls ${SNP_MRK_FILE}* 2> /dev/null` >> ${SNPMARKER_LOG} 2>&1
+    STAT=$?
+    if [ ${STAT} -ne 0 ]
+    then
+	echo "${SNPCACHELOAD}/snpmrkload.py failed" | tee -a ${SNPMARKER_LOG}
+	exit 1
+    fi
+else
+    echo "No chromosomes changed"  | tee -a ${SNPMARKER_LOG}
+fi
+
+mv ${SNPMRK_STATE_FILE}.new ${SNPMRK_STATE_FILE}
+if [ -f ${SNPMRK_MARKER_FILE}.new ]
+then
+    mv ${SNPMRK_MARKER_FILE}.new ${SNPMRK_MARKER_FILE}
+fi
+date | tee -a ${SNPMARKER_LOG}
+touch ${LASTRUN_FILE}
+rm -rf ${CACHEDATADIR}/lastrun.dump
+exit 0
+
+fi
+
+rm -f ${SNPMRK_STATE_FILE} ${SNPMRK_STATE_FILE}.new ${SNPMRK_MARKER_FILE} ${SNPMRK_MARKER_FILE}.new
+
+#
+# SNPMRK_DIRECT_LOAD=yes : snpmrkwithin.py loads the table itself (COPY),
+# so the table must be emptied first and there are no bcp files to load
+# each chromosome's COPY commits on its own, so only the shadow table may be
+# loaded this way; the live table is never empty or partially loaded
+#
+if [ "${SNPMRK_DIRECT_LOAD}" = "yes" ]
+then
+    if [ "${SNPMRK_SHADOW_LOAD}" != "yes" ]
+    then
+	echo "SNPMRK_DIRECT_LOAD=yes requires SNPMRK_SHADOW_LOAD=yes" | tee -a ${SNPMARKER_LOG}
+	exit 1
+    fi
+    prepareTable
+fi
+
 #
 # create SNP_ConsensusSnp_Marker bcp files
+# SNPMRK_CHECKPOINT=yes : if the last snpmrkwithin.py run failed, the chromosomes
+# (or tiles) it completed (SNPMRK_CHECKPOINT_FILE) are verified & skipped; once
+# snpmrkwithin.py succeeds, its bcp files are handed off to the load and the
+# checkpoint is removed (a failed load re-creates every chromosome)
 # 
 date | tee -a ${SNPMARKER_LOG}
 echo "Processing snpmrkwithin.py to create SNP_ConsensusSnp_Marker bcp files" | tee -a ${SNPMARKER_LOG}
@@ -59,49 +171,73 @@ then
 	echo "${SNPCACHELOAD}/snpmrkwithin.py failed" | tee -a ${SNPMARKER_LOG}
 	exit 1
 fi
+rm -f ${SNPMRK_CHECKPOINT_FILE}
+
+if [ "${SNPMRK_DIRECT_LOAD}" != "yes" ]
+then
+
+prepareTable
+cd ${CACHEDATADIR}
 
 #
-# drop foreign keys & indexes, truncate SNP_ConsensusSnp_Marker
+# load the bcp files into the SNP_ConsensusSnp_Marker table
+# (SNPMRK_LOAD_WORKERS files at a time; the table is empty, so a failed load
+# leaves it to be re-loaded by the next run)
 #
 date | tee -a ${SNPMARKER_LOG}
-cd ${CACHEDATADIR}
-${SNP_DBSCHEMADIR}/key/SNP_ConsensusSnp_Marker_drop.object >> ${SNPMARKER_LOG} 2>&1
-${SNP_DBSCHEMADIR}/index/SNP_ConsensusSnp_Marker_drop.object >> ${SNPMARKER_LOG} 2>&1
-${SNP_DBSCHEMADIR}/table/SNP_ConsensusSnp_Marker_truncate.object >> ${SNPMARKER_LOG} 2>&1
+echo "Loading ${LOAD_TABLE} by Chromosome"  | tee -a ${SNPMARKER_LOG}
+${PYTHON} ${SNPCACHELOAD}/snpmrkload.py -t ${LOAD_TABLE} `ls ${SNP_MRK_FILE}*` >> ${SNPMARKER_LOG} 2>&1
+STAT=$?
+if [ ${STAT} -ne 0 ]
+then
+	echo "${SNPCACHELOAD}/snpmrkload.py failed" | tee -a ${SNPMARKER_LOG}
+	exit 1
+fi
+
+fi
 
 #
-# load each bcp file into the SNP_ConsensusSnp_Marker table
+# re-create foreign keys & indexes
 #
 date | tee -a ${SNPMARKER_LOG}
-echo "Loading SNP_ConsensusSnp_Marker by Chromosome"  | tee -a ${SNPMARKER_LOG}
-for i in `ls ${SNP_MRK_FILE}*`
-do
+echo "Create primary key & index on ${LOAD_TABLE}"  | tee -a ${SNPMARKER_LOG}
+${PYTHON} ${SNPCACHELOAD}/snpmrkindex.py ${LOAD_TABLE} >> ${SNPMARKER_LOG} 2>&1
+STAT=$?
+if [ ${STAT} -ne 0 ]
+then
+	echo "${SNPCACHELOAD}/snpmrkindex.py failed" | tee -a ${SNPMARKER_LOG}
+	exit 1
+fi
+
+#
+# swap the shadow table in (SNP_ConsensusSnp_Marker -> zSNP_ConsensusSnp_Marker,
+# shadow table -> SNP_ConsensusSnp_Marker) in one transaction
+#
+if [ "${SNPMRK_SHADOW_LOAD}" = "yes" ]
+then
     date | tee -a ${SNPMARKER_LOG}
-    echo "Load ${i} into ${SNP_MRK_TABLE} table" | tee -a ${SNPMARKER_LOG}
-    echo "" | tee -a ${SNPMARKER_LOG}
-    ${PG_DBUTILS}/bin/bcpin.csh ${MGD_DBSERVER} ${MGD_DBNAME} ${SNP_MRK_TABLE} ${CACHEDATADIR} ${i} "|" "" snp >> ${SNPMARKER_LOG} 2>&1
+    echo "Swap ${LOAD_TABLE} for ${SNP_MRK_TABLE}"  | tee -a ${SNPMARKER_LOG}
+    ${PYTHON} ${SNPCACHELOAD}/snpmrkshadow.py swap >> ${SNPMARKER_LOG} 2>&1
     STAT=$?
     if [ ${STAT} -ne 0 ]
     then
-    	echo "${PG_DBUTILS}/bin/bcpin.csh failed" | tee -a ${SNPMARKER_LOG}
+	echo "${SNPCACHELOAD}/snpmrkshadow.py swap failed" | tee -a ${SNPMARKER_LOG}
 	exit 1
     fi
-done
+fi
+date | tee -a ${SNPMARKER_LOG}
 
 #
-# re-create foreign keys & indexes
+# SNPMRK_INCREMENTAL=yes : the next run only re-creates the chromosomes that change
 #
-date | tee -a ${SNPMARKER_LOG}
-echo "Create primary key & index on SNP_ConsensusSnp_Marker"  | tee -a ${SNPMARKER_LOG}
-${SNP_DBSCHEMADIR}/key/SNP_ConsensusSnp_Marker_create.object >> ${SNPMARKER_LOG} 2>&1
-${SNP_DBSCHEMADIR}/index/SNP_ConsensusSnp_Marker_create.object >> ${SNPMARKER_LOG} 2>&1
-STAT=$?
-if [ ${STAT} -ne 0 ]
+if [ "${SNPMRK_INCREMENTAL}" = "yes" ]
 then
-	echo "${SNPCACHELOAD}/snpmrkwithin.py failed" | tee -a ${SNPMARKER_LOG}
-	exit 1
+    mv ${SNPMRK_STATE_FILE}.new ${SNPMRK_STATE_FILE}
+    if [ -f ${SNPMRK_MARKER_FILE}.new ]
+    then
+        mv ${SNPMRK_MARKER_FILE}.new ${SNPMRK_MARKER_FILE}
+    fi
 fi
-date | tee -a ${SNPMARKER_LOG}
 
 #
 # Touch the "lastrun" file to note when the load was run.
@@ -0,0 +1,271 @@
+#  snpmrkindex.py
+###########################################################################
+#
+#  Purpose:
+#
+#      Re-create the keys & indexes of SNP_ConsensusSnp_Marker after it
+#      has been loaded, building the indexes concurrently.
+#
+#      The statements are read from the pgsnpdbschema scripts:
+#
+#          ${SNP_DBSCHEMADIR}/key/SNP_ConsensusSnp_Marker_create.object
+#          ${SNP_DBSCHEMADIR}/index/SNP_ConsensusSnp_Marker_create.object
+#
+#      and run in 3 phases:
+#
+#      1) primary key  : one at a time (alter table takes an exclusive lock)
+#      2) create index : SNPMRK_INDEX_WORKERS at a time, 1 connection each
+#                        (create index locks do not conflict with each other)
+#      3) everything else (foreign keys...) : one at a time
+#
+#      Each connection sets maintenance_work_mem & max_parallel_maintenance_workers
+#      (SNPMRK_MAINTENANCE_WORK_MEM, SNPMRK_PARALLEL_MAINT_WORKERS) first.
+#
+#  Usage:
+#
+#      snpmrkindex.py [table]
+#
+#      table : build the keys & indexes on table instead (the shadow table
+#              when SNPMRK_SHADOW_LOAD=yes; see snpmrkshadow.py).
+#              Only the target of the statements (alter table / on) and the
+#              names they create are changed from SNP_MRK_TABLE to table
+#              (see retarget); statements of other tables, e.g. their foreign
+#              keys to SNP_MRK_TABLE, are skipped (snpmrkshadow.py swap
+#              re-creates those against the new table).
+#
+#  Env Vars:
+#
+#      SNP_MRK_TABLE
+#      SNP_DBSCHEMADIR
+#      SNPMRK_INDEX_WORKERS
+#      SNPMRK_MAINTENANCE_WORK_MEM
+#      SNPMRK_PARALLEL_MAINT_WORKERS
+#
+#  Outputs:
+#
+#      keys & indexes on SNP_ConsensusSnp_Marker
+#      build time of each statement
+#
+#  Exit Codes:
+#
+#      0:  Successful completion
+#      1:  A statement failed, or a schema script has no statement on the table
+#
+###########################################################################
+
+import sys
+import os
+import re
+import time
+import multiprocessing
+import multiprocessing.connection
+import db
+
+#
+#  CONSTANTS
+#
+
+SCHEMA_FILES = [
+    os.environ['SNP_DBSCHEMADIR'] + '/key/SNP_ConsensusSnp_Marker_create.object',
+    os.environ['SNP_DBSCHEMADIR'] + '/index/SNP_ConsensusSnp_Marker_create.object',
+]
+
+# number of indexes to build at the same time
+INDEX_WORKERS = int(os.environ.get('SNPMRK_INDEX_WORKERS', '4'))
+# per-connection settings for the index builds
+MAINTENANCE_WORK_MEM = os.environ.get('SNPMRK_MAINTENANCE_WORK_MEM', '1GB')
+PARALLEL_MAINT_WORKERS = int(os.environ.get('SNPMRK_PARALLEL_MAINT_WORKERS', '2'))
+
+# Purpose: Read the sql statements out of a pgsnpdbschema *.object script
+#          i.e. the text of the "cat - <<EOSQL ... EOSQL" here-documents,
+#          without comments, split on ';'
+# Returns: list of statements
+# Assumes: Nothing
+# Effects: Reads a file
+# Throws:  Nothing
+
+def readStatements(fileName):
+
+    statements = []
+    inSql = 0
+    text = []
+
+    for line in open(fileName, 'r'):
+        if not inSql:
+            if re.search(r'<<\s*[\'"]?EOSQL', line):
+                inSql = 1
+            continue
+        if line.strip() == 'EOSQL':
+            inSql = 0
+            continue
+        line = line.split('--')[0]
+        if line.strip().startswith('\\'):
+            continue
+        text.append(os.path.expandvars(line))
+
+    for s in ''.join(text).split(';'):
+        s = ' '.join(s.split())
+        if s:
+            statements.append(s)
+
+    return statements
+
+# Purpose: Change the target table of a statement from fromName to toName:
+#          . alter table [if exists] [only] [schema.]fromName ...
+#          . ... on [only] [schema.]fromName ...
+#          (the schema, if any, is kept)
+#          and the names of the constraint/index it creates, if they start
+#          with fromName (add constraint fromName_..., create index fromName_...)
+#          Whole words only: other tables, columns, and references to fromName
+#          (e.g. another table's foreign key) are not changed.
+# Returns: the new statement, or None if the statement is not on fromName
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def retarget(statement, fromName, toName):
+
+    name = re.escape(fromName)
+
+    statement, count = re.subn(r'(\b(?:alter\s+table(?:\s+if\s+exists)?|on)\s+(?:only\s+)?(?:\w+\.)?)' + name + r'\b', \
+        lambda m: m.group(1) + toName, statement, flags = re.I)
+    if count == 0:
+        return None
+
+    statement = re.sub(r'(\b(?:add\s+constraint|create\s+(?:unique\s+)?index(?:\s+concurrently)?(?:\s+if\s+not\s+exists)?)\s+)' \
+        + name + r'(?=\w)', lambda m: m.group(1) + toName, statement, flags = re.I)
+
+    return statement
+
+# Purpose: Run one statement on its own connection
+#          (the db module may sys.exit() on an error: BaseException is caught)
+# Returns: (statement, seconds, error message or None)
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws:  Nothing
+
+def runStatement(statement):
+
+    startTime = time.time()
+    error = None
+
+    db.useOneConnection(1)
+    try:
+        db.sql("set maintenance_work_mem = '%s'" % (MAINTENANCE_WORK_MEM), None)
+        db.sql('set max_parallel_maintenance_workers = %s' % (PARALLEL_MAINT_WORKERS), None)
+        db.sql(statement, None)
+        db.commit()
+    except BaseException as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    finally:
+        db.useOneConnection(0)
+
+    return (statement, time.time() - startTime, error)
+
+# Purpose: Worker process: run one statement, send the result on conn
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws:  Nothing
+
+def statementWorker(statement, conn):
+
+    conn.send(runStatement(statement))
+    conn.close()
+
+# Purpose: Run the statements, nWorkers at a time
+#          (each in a separate process, so each has its own connection)
+#          A worker that exits without a result (killed, OOM...) is a failed
+#          statement, so the step fails instead of waiting forever.
+# Returns: number of statements that failed
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws:  Nothing
+
+def runStatements(statements, nWorkers):
+
+    failed = 0
+    ctx = multiprocessing.get_context('fork')
+    pending = list(statements)
+    running = {}
+
+    while pending or running:
+        while pending and len(running) < max(1, nWorkers):
+            statement = pending.pop(0)
+            parentConn, childConn = ctx.Pipe(False)
+            p = ctx.Process(target = statementWorker, args = (statement, childConn))
+            p.start()
+            childConn.close()
+            running[p.sentinel] = (p, parentConn, statement, time.time())
+
+        for sentinel in multiprocessing.connection.wait(list(running.keys())):
+            p, conn, statement, startTime = running.pop(sentinel)
+            p.join()
+            try:
+                statement, seconds, error = conn.recv()
+            except EOFError:
+                seconds = time.time() - startTime
+                error = 'worker exited without a result (exit code %s)' % (p.exitcode)
+            conn.close()
+
+            if error is None:
+                print('%.1f sec : %s' % (seconds, statement))
+            else:
+                print('FAILED after %.1f sec : %s\n%s' % (seconds, statement, error))
+                failed = failed + 1
+            sys.stdout.flush()
+
+    return failed
+
+#
+#  MAIN
+#
+
+startTime = time.time()
+
+table = None
+if len(sys.argv) > 1:
+    table = sys.argv[1]
+
+keys = []
+indexes = []
+others = []
+for fileName in SCHEMA_FILES:
+    count = 0
+    for statement in readStatements(fileName):
+        if table:
+            retargeted = retarget(statement, os.environ['SNP_MRK_TABLE'], table)
+            if retargeted is None:
+                print('snpmrkindex.py: not on %s, skipped: %s' % (os.environ['SNP_MRK_TABLE'], statement))
+                continue
+            statement = retargeted
+        count = count + 1
+        if re.search(r'primary\s+key', statement, re.I):
+            keys.append(statement)
+        elif re.match(r'create\s+(unique\s+)?index', statement, re.I):
+            indexes.append(statement)
+        else:
+            others.append(statement)
+    # e.g. DDL the statements could not be matched in: the table must not
+    # be used (or swapped in) without its keys & indexes
+    if count == 0:
+        sys.stderr.write('snpmrkindex.py: %s: no statement on %s\n' % (fileName, table or os.environ['SNP_MRK_TABLE']))
+        sys.exit(1)
+
+print('snpmrkindex.py: %s primary keys, %s indexes (%s workers), %s other statements' \
+    % (len(keys), len(indexes), INDEX_WORKERS, len(others)))
+sys.stdout.flush()
+
+failed = runStatements(keys, 1)
+if not failed:
+    failed = runStatements(indexes, INDEX_WORKERS)
+if not failed:
+    failed = runStatements(others, 1)
+
+print('snpmrkindex.py: %.1f sec' % (time.time() - startTime))
+
+if failed:
+    sys.stderr.write('snpmrkindex.py: %s statements failed\n' % (failed))
+    sys.exit(1)
+
+sys.exit(0)
@@ -0,0 +1,362 @@
+#  snpmrkload.py
+###########################################################################
+#
+#  Purpose:
+#
+#      Load SNP_ConsensusSnp_Marker rows into the SNP_ConsensusSnp_Marker
+#      table using COPY.
+#
+#  Usage:
+#
+#      snpmrkload.py [-t table] [-d deletefile] file ...
+#      snpmrkload.py [-t table] -
+#
+#      -t table      : load table instead of SNP_MRK_TABLE
+#                      (the shadow table when SNPMRK_SHADOW_LOAD=yes; see snpmrkshadow.py)
+#      -d deletefile : first delete the rows whose _ConsensusSnp_Marker_key is
+#                      in one of the "|" delimited first|last key ranges in
+#                      deletefile, as part of the same (all or nothing) load,
+#                      by 1 connection, in 1 transaction
+#                      (SNPMRK_INCREMENTAL=yes; see snpmrkwithin.process)
+#                      first|last|markerKey,... : only delete the rows of
+#                      those markers in the key range (SNPMRK_DELTA=yes)
+#      file ... : the SNP_ConsensusSnp_Marker bcp files (1 per chromosome)
+#                 to load, using SNPMRK_LOAD_WORKERS connections at a time
+#                 (see loadFiles)
+#      -        : read the rows from stdin
+#                 (used by snpmrkwithin.py when SNPMRK_DIRECT_LOAD=yes)
+#
+#  Env Vars:
+#
+#      SNP_MRK_TABLE
+#      SNPMRK_LOAD_WORKERS
+#
+#  Inputs:
+#
+#      "|" delimited SNP_ConsensusSnp_Marker bcp files
+#      or
+#      "|" delimited SNP_ConsensusSnp_Marker rows on stdin, followed by
+#      a line containing only END_OF_DATA.
+#
+#  Outputs:
+#
+#      SNP_ConsensusSnp_Marker rows
+#
+#  Exit Codes:
+#
+#      0:  Successful completion
+#      1:  An exception occurred, a file failed to load, or stdin ended
+#          without END_OF_DATA; nothing is committed.
+#          Only a multi-worker load (no -d: an empty, just truncated or
+#          shadow table) can be left partially loaded, if a commit fails
+#          after another worker's commit; snpmarker.sh then stops, and the
+#          table is re-loaded by the next run (the shadow table is not
+#          swapped in).
+#
+###########################################################################
+
+import sys
+import os
+import time
+import queue
+import multiprocessing
+import db
+
+#
+#  CONSTANTS
+#
+
+DL = '|'
+NULL = ''
+
+# last line of the input; if the writer dies, the input ends without it
+# and the rows are not committed (see snpmrkwithin.BCPWriter)
+END_OF_DATA = '\\.\n'
+
+table = os.environ['SNP_MRK_TABLE']
+
+# number of files to load at the same time (1 connection each)
+LOAD_WORKERS = int(os.environ.get('SNPMRK_LOAD_WORKERS', '4'))
+
+# Purpose: File-like reader of stdin for executeCopyFrom()
+#          Passes the rows through and strips the END_OF_DATA line.
+#          complete is set once END_OF_DATA has been read.
+
+class StdinReader:
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.complete = 0
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            lines = self.fp.readlines()
+        else:
+            lines = self.fp.readlines(size)
+        if lines and lines[-1] == END_OF_DATA:
+            self.complete = 1
+            lines.pop()
+        return ''.join(lines)
+
+    def readline(self, size = -1):
+        line = self.fp.readline(size)
+        if line == END_OF_DATA:
+            self.complete = 1
+            line = ''
+        return line
+
+# Purpose: File-like reader of a bcp file for executeCopyFrom()
+#          that counts the rows it passes through.
+
+class CountingReader:
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.rows = 0
+
+    def read(self, size = -1):
+        data = self.fp.read(size)
+        self.rows = self.rows + data.count('\n')
+        return data
+
+    def readline(self, size = -1):
+        line = self.fp.readline(size)
+        self.rows = self.rows + line.count('\n')
+        return line
+
+# Purpose: COPY the rows on stdin into table
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Loads the database
+# Throws:  Nothing
+
+def loadStdin():
+
+    db.useOneConnection(1)
+
+    reader = StdinReader(sys.stdin)
+    db.executeCopyFrom(reader, table, DL, null = NULL)
+
+    if not reader.complete:
+        sys.stderr.write('snpmrkload.py: input ended before %s; rows not loaded into %s\n' % (END_OF_DATA.strip(), table))
+        db.useOneConnection(0)
+        sys.exit(1)
+
+    db.commit()
+    db.useOneConnection(0)
+
+    return
+
+# Purpose: COPY the bcp files into table, LOAD_WORKERS files at a time
+#
+#          The deletes (key ranges; see readDeletes), then the files,
+#          largest first, are handed out to LOAD_WORKERS worker
+#          processes. Each worker has its own connection and loads all of
+#          its files in one transaction, which it does not commit until
+#          every worker has loaded all of its files; if any file fails,
+#          every worker rolls back.
+#
+#          The workers commit one after another, so if a commit failed
+#          after another worker's commit, table would be partially loaded.
+#          A delete & re-load of a populated table (deletes: the incremental
+#          load) is therefore done by 1 worker (1 transaction, all or
+#          nothing).  Without deletes, table is empty: snpmarker.sh has
+#          truncated it (in its own, committed transaction) or created it
+#          (the shadow table, see snpmrkshadow.py), so a partial load is no
+#          worse than the empty table and LOAD_WORKERS are used; the failure
+#          stops snpmarker.sh (and the shadow table is not swapped in).
+#
+#          Reports rows, rows/sec and wall time for each file and in total.
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Loads the database
+# Throws:  Nothing
+
+def loadFiles(files, deletes = []):
+
+    startTime = time.time()
+
+    files = sorted(files, key = os.path.getsize, reverse = True)
+    nWorkers = max(1, min(LOAD_WORKERS, len(deletes) + len(files)))
+    if deletes and nWorkers > 1:
+        print('loadFiles(): rows deleted from %s: 1 worker (1 transaction)' % (table))
+        nWorkers = 1
+
+    print('loadFiles(): %s key ranges deleted from & %s files loaded into %s, %s workers' % (len(deletes), len(files), table, nWorkers))
+    sys.stdout.flush()
+
+    ctx = multiprocessing.get_context('fork')
+    jobs = ctx.Queue()
+    results = ctx.Queue()
+    jobs.cancel_join_thread()
+    for keyRange in deletes:
+        jobs.put(keyRange)
+    for fileName in files:
+        jobs.put(fileName)
+    for i in range(nWorkers):
+        jobs.put(None)
+
+    workers = []
+    for i in range(nWorkers):
+        parentConn, childConn = ctx.Pipe()
+        p = ctx.Process(target = loadWorker, args = (i, jobs, results, childConn))
+        p.start()
+        workers.append((p, parentConn))
+
+    #
+    # wait for every worker to load its files (or fail)
+    #
+    totalRows = 0
+    loaded = {}
+    failed = []
+    while len(loaded) + len(failed) < nWorkers:
+        try:
+            r = results.get(timeout = 10)
+        except queue.Empty:
+            for i, (p, conn) in enumerate(workers):
+                if not p.is_alive() and i not in loaded and i not in failed:
+                    failed.append(i)
+                    sys.stderr.write('loadFiles(): worker %s exited (%s)\n' % (i, p.exitcode))
+            continue
+
+        if r[0] == 'file':
+            worker, fileName, rows, seconds = r[1:]
+            totalRows = totalRows + rows
+            print('loadFiles(): %s: %s rows in %.1f sec (%.0f rows/sec)' \
+                % (fileName, rows, seconds, rows / max(seconds, 0.001)))
+            sys.stdout.flush()
+        elif r[0] == 'delete':
+            worker, keyRange, seconds = r[1:]
+            if keyRange[2]:
+                print('loadFiles(): deleted keys %s-%s of %s markers in %.1f sec' \
+                    % (keyRange[0], keyRange[1], len(keyRange[2].split(',')), seconds))
+            else:
+                print('loadFiles(): deleted keys %s-%s in %.1f sec' % (keyRange[0], keyRange[1], seconds))
+            sys.stdout.flush()
+        elif r[0] == 'loaded':
+            loaded[r[1]] = 1
+        elif r[0] == 'failed':
+            failed.append(r[1])
+            sys.stderr.write('loadFiles(): %s\n' % (r[2]))
+
+    #
+    # all or nothing
+    #
+    verdict = 'commit'
+    if failed:
+        verdict = 'rollback'
+
+    for i, (p, conn) in enumerate(workers):
+        if i in loaded:
+            conn.send(verdict)
+
+    committed = 0
+    for p, conn in workers:
+        p.join()
+        if p.exitcode == 0 and verdict == 'commit':
+            committed = committed + 1
+
+    if failed:
+        sys.stderr.write('loadFiles(): load failed; nothing committed to %s\n' % (table))
+        sys.exit(1)
+
+    if committed < nWorkers:
+        if committed == 0:
+            sys.stderr.write('loadFiles(): commit failed; nothing committed to %s\n' % (table))
+        else:
+            # a commit failed after others had succeeded (never with deletes: 1 worker)
+            sys.stderr.write('loadFiles(): commit failed; %s is partially loaded and must be re-loaded\n' % (table))
+        sys.exit(1)
+
+    seconds = time.time() - startTime
+    print('loadFiles(): %s rows in %.1f sec (%.0f rows/sec)' % (totalRows, seconds, totalRows / max(seconds, 0.001)))
+    sys.stdout.flush()
+
+    return
+
+# Purpose: Worker process for loadFiles()
+#          Delete the key ranges/COPY the files from jobs until a None is read,
+#          then wait for the verdict ('commit' or 'rollback') on conn.
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Loads the database; exits 0 if the files were committed
+# Throws:  Nothing
+
+def loadWorker(worker, jobs, results, conn):
+
+    db.useOneConnection(1)
+
+    try:
+        fileName = jobs.get()
+        while fileName is not None:
+            startTime = time.time()
+            if isinstance(fileName, tuple):
+                firstKey, lastKey, markerKeys = fileName
+                if markerKeys:
+                    db.sql('delete from %s where _ConsensusSnp_Marker_key between %s and %s and _Marker_key in (%s)' \
+                        % (table, firstKey, lastKey, markerKeys), None)
+                else:
+                    db.sql('delete from %s where _ConsensusSnp_Marker_key between %s and %s' % (table, firstKey, lastKey), None)
+                results.put(('delete', worker, fileName, time.time() - startTime))
+            else:
+                with open(fileName, 'r') as fp:
+                    reader = CountingReader(fp)
+                    db.executeCopyFrom(reader, table, DL, null = NULL)
+                results.put(('file', worker, fileName, reader.rows, time.time() - startTime))
+            fileName = jobs.get()
+    except Exception as e:
+        results.put(('failed', worker, 'worker %s: %s: %s' % (worker, fileName, e)))
+        db.useOneConnection(0)
+        sys.exit(1)
+
+    results.put(('loaded', worker))
+
+    if conn.recv() != 'commit':
+        db.useOneConnection(0)
+        sys.exit(1)
+
+    db.commit()
+    db.useOneConnection(0)
+    sys.exit(0)
+
+# Purpose: Read the key ranges to delete (see -d)
+# Returns: list of (first key, last key, comma-separated _Marker_keys or None)
+# Assumes: Nothing
+# Effects: Reads a file
+# Throws:  Nothing
+
+def readDeletes(fileName):
+
+    deletes = []
+    for line in open(fileName, 'r'):
+        tokens = line[:-1].split(DL)
+        markerKeys = None
+        if len(tokens) > 2:
+            markerKeys = ','.join([str(int(k)) for k in tokens[2].split(',')])
+        deletes.append((int(tokens[0]), int(tokens[1]), markerKeys))
+
+    return deletes
+
+#
+#  MAIN
+#
+
+args = sys.argv[1:]
+deletes = []
+while args[:1] in (['-t'], ['-d']) and len(args) > 1:
+    if args[0] == '-t':
+        table = args[1]
+    else:
+        deletes = readDeletes(args[1])
+    args = args[2:]
+
+if not args and not deletes:
+    sys.stderr.write('Usage: snpmrkload.py [-t table] [-d deletefile] file ... | -\n')
+    sys.exit(1)
+
+if args == ['-']:
+    loadStdin()
+else:
+    loadFiles(args, deletes)
+
+sys.exit(0)
@@ -9,11 +9,22 @@
 #      SNP function class and determine whether the annotation should be
 #      upstream or downstream, depending on the SNP/marker coordinates.
 #
+#      If SNPMRKLOCUS_STREAM=yes, the annotations are read through a
+#      server-side cursor, CLASSIFY_BATCH at a time, by a second process on
+#      its own connection, and the classified rows are piped into one COPY
+#      of the temp table (see streamTempTable): no bcp file, and only one
+#      batch in memory at a time.
+#
 #  Usage:
 #
 #      snpmrklocus.py
 #
-#  Env Vars:  None
+#  Env Vars:
+#
+#      CACHEDATADIR
+#      TMP_FXN_TABLE
+#      TMP_FXN_FILE
+#      SNPMRKLOCUS_STREAM
 #
 #  Inputs:
 #
@@ -25,7 +36,9 @@
 #
 #  Outputs:
 #
-#      A "|" delimited bcp file to load records into a temporary table.
+#      A "|" delimited bcp file to load records into a temporary table
+#      (not if SNPMRKLOCUS_STREAM=yes).
+#      The distance_direction of the locus-region SNP_ConsensusSnp_Marker rows.
 #
 #  Exit Codes:
 #
@@ -62,7 +75,8 @@ import sys
 import os
 import loadlib
 import db
-import io
+import multiprocessing
+import snpdirection
 #
 #  CONSTANTS
 #
@@ -78,6 +92,13 @@ DOWNSTREAM_TERM = 'downstream'
 # _Term_key for 'Locus-Region' function class
 locusRegionKey = 0
 
+# number of annotations classified (and, if STREAM, fetched) at a time
+# (see snpdirection.classify)
+CLASSIFY_BATCH = 100000
+
+# yes = stream the annotations through a cursor & a pipe into the COPY (see streamTempTable)
+STREAM = os.environ.get('SNPMRKLOCUS_STREAM', 'no') == 'yes'
+
 # database environment variables
 server = os.environ['MGD_DBSERVER']
 database = os.environ['MGD_DBNAME']
@@ -113,10 +134,6 @@ def initialize():
     tmpFxnTable = os.environ['TMP_FXN_TABLE']
     tmpFxnFile = dataDir + '/' + os.environ['TMP_FXN_FILE']
 
-    #
-    #  Set up a connection to the mgd database.
-    #
-    db.useOneConnection(1)
     db.setReturnAsMGI(False)
     results = db.sql('''
         SELECT t._Term_key
@@ -126,9 +143,24 @@ def initialize():
         ''' % (LOCUS_REGION_TERM), 'auto')
     locusRegionKey = results[1][0]
 
+    #
+    #  Start the annotation process (see streamTempTable), before the
+    #  connection is set up: it must not share it.
+    #
+    if STREAM:
+        startLocusWorker()
+
+    #
+    #  Set up a connection to the mgd database.
+    #
+    db.useOneConnection(1)
+
     #
     #  Open the bcp file.
     #
+    if STREAM:
+        return
+
     try:
         fpTmpFxn = open(tmpFxnFile,'w')
     except:
@@ -151,21 +183,16 @@ def finalize():
     return
 
 
-# Purpose: Create a bcp file that contains the primary key for each
-#          "locus-region" record, along with the key for the new function
-#          class that should be used to update each record.
-# Returns: Nothing
-# Assumes: Nothing
+# Purpose: Return the query for the locus-region SNP/marker annotations
+#          & the SNP/marker coordinates and marker strand needed to classify them
+# Returns: sql string
+# Assumes: initialize() has been called
 # Effects: Nothing
 # Throws: Nothing
 
-def createBCPFile():
-    global fpTmpFxn
-
-    print('Get locus-region SNP/marker annotations')
-    sys.stdout.flush()
+def locusQuery():
 
-    results = db.sql('''
+    return '''
         SELECT sm._ConsensusSnp_Marker_key, 
                 sc.startCoordinate as snpLoc, 
                 mc.startCoordinate as markerStart, 
@@ -181,64 +208,57 @@ def createBCPFile():
                 AND sm._Fxn_key = %s 
                 AND mc.startCoordinate IS NOT NULL 
                 AND mc.endCoordinate IS NOT NULL 
-                ''' % (locusRegionKey), 'auto')
+                ''' % (locusRegionKey)
 
-    print('Create the bcp file')
-    sys.stdout.flush()
+# Purpose: Classify a batch of locus-region annotations (rows of locusQuery):
+#          upstream/downstream/proximal/distal of the marker midpoint, by strand
+#          (see snpdirection.classify)
+# Returns: the bcp lines (primary key|direction) of the batch;
+#          the annotations that cannot be classified are reported & left out
+# Assumes: Nothing
+# Effects: Nothing
+# Throws: Nothing
+
+def classifyRows(batch):
 
-    for r in results[1]:
-        primaryKey = r[0]
-        snpLoc = r[1]
-        markerStart = r[2]
-        markerEnd = r[3]
-        markerStrand = r[4]
-
-
-        #
-        #  Find the midpoint of the marker.
-        #
-        midPoint = (markerStart + markerEnd) / 2.0
-        #
-        #  If the SNP coordinate is <= the midpoint of the marker on a
-        #  "+" strand, the SNP is considered to be upstream.
-        #
-        if markerStrand == '+' and snpLoc <= midPoint:
-            direction = 'upstream'
-        #
-        #  If the SNP coordinate is > the midpoint of the marker on a
-        #  "+" strand, the SNP is considered to be downstream.
-        #
-        elif markerStrand == '+' and snpLoc > midPoint:
-            direction = 'downstream'
-        #
-        #  If the SNP coordinate is <= the midpoint of the marker on a
-        #  "-" strand, the SNP is considered to be downstream.
-        #
-        elif markerStrand == '-' and snpLoc <= midPoint:
-            direction = 'downstream'
-        #
-        #  If the SNP coordinate is > the midpoint of the marker on a
-        #  "-" strand, the SNP is considered to be upstream.
-        #
-        elif markerStrand == '-' and snpLoc > midPoint:
-            direction = 'upstream'
-        #
-        #  If the SNP coordinate is <= the midpoint of the marker
-        #  and strand is Null, the SNP is considered to be proximal
-        #
-        elif markerStrand == None and snpLoc <= midPoint:
-            direction = 'proximal'
-        #
-        #  If the SNP coordinate is > the midpoint of the marker
-        #  and strand is Null, the SNP is considered to be downstream.
-        #
-        elif markerStrand == None and snpLoc > midPoint:
-            direction = 'distal'
-        else:
+    if not batch:
+        return ''
+
+    primaryKeys, snpLocs, markerStarts, markerEnds, markerStrands = list(zip(*batch))
+    directions, distances = snpdirection.classify(snpLocs, markerStarts, markerEnds, markerStrands)
+
+    lines = []
+    for r, direction in zip(batch, directions):
+        if direction is None:
             print('not covered by algorithm')
-            print('    primaryKey: %s snpLoc: %s markerStart: %s markerEnd: %s markerStrand: %s' % ( primaryKey, snpLoc, markerStart, markerEnd, markerEnd)) 
+            print('    primaryKey: %s snpLoc: %s markerStart: %s markerEnd: %s markerStrand: %s' % (r[0], r[1], r[2], r[3], r[4]))
+            continue
+        lines.append(str(r[0]) + DL + direction + CRT)
+
+    return ''.join(lines)
+
+# Purpose: Create a bcp file that contains the primary key for each
+#          "locus-region" record, along with the key for the new function
+#          class that should be used to update each record.
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Nothing
+# Throws: Nothing
 
-        fpTmpFxn.write(str(primaryKey) + DL + direction + CRT)
+def createBCPFile():
+    global fpTmpFxn
+
+    print('Get locus-region SNP/marker annotations')
+    sys.stdout.flush()
+
+    results = db.sql(locusQuery(), 'auto')
+
+    print('Create the bcp file')
+    sys.stdout.flush()
+
+    rows = results[1]
+    for b in range(0, len(rows), CLASSIFY_BATCH):
+        fpTmpFxn.write(classifyRows(rows[b:b + CLASSIFY_BATCH]))
 
     #
     #  Close the bcp file.
@@ -248,14 +268,14 @@ def createBCPFile():
     return
 
 
-# Purpose: Load the bcp file into a new temp table.
+# Purpose: Create the temp table.
 # Returns: Nothing
 # Assumes: Nothing
 # Effects: Nothing
 # Throws: Nothing
 
-def loadBCPFile():
-    global tmpFxnTable, tmpFxnFile
+def createTempTable():
+    global tmpFxnTable
 
     print('Create the temp table')
     sys.stdout.flush()
@@ -266,6 +286,32 @@ def loadBCPFile():
         )
         ''' % (tmpFxnTable), None)
 
+# Purpose: Index & analyze the loaded temp table for the update
+#          (applyUpdates only joins it by _ConsensusSnp_Marker_key).
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Nothing
+# Throws: Nothing
+
+def indexTempTable():
+    global tmpFxnTable
+
+    print('Create indexes on the temp table')
+    sys.stdout.flush()
+    db.sql('CREATE index idx1 on %s (_ConsensusSnp_Marker_key)' % (tmpFxnTable), None)
+    db.sql('ANALYZE %s' % (tmpFxnTable), None)
+
+# Purpose: Load the bcp file into a new temp table.
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Nothing
+# Throws: Nothing
+
+def loadBCPFile():
+    global tmpFxnTable, tmpFxnFile
+
+    createTempTable()
+
     print('Load the bcp file into the temp table')
     sys.stdout.flush()
 
@@ -273,10 +319,93 @@ def loadBCPFile():
     db.executeCopyFrom(tmpFile, tmpFxnTable, DL)
     db.commit()
 
-    print('Create indexes on the temp table')
+    indexTempTable()
+
+# Purpose: Start the process that reads & classifies the locus-region
+#          annotations for streamTempTable (see locusWorker): a fetch cannot
+#          run on the connection of the temp table while its COPY is in
+#          progress, so the cursor is read on another connection, by another
+#          process, and the rows are passed through a pipe.
+# Returns: Nothing
+# Assumes: the script does not have a (shared) connection yet
+# Effects: Starts a process, opens a pipe (fpLocus: its read end)
+# Throws: Nothing
+
+def startLocusWorker():
+    global locusWorkerProcess, fpLocus
+
+    readFd, writeFd = os.pipe()
+
+    # daemon: if this script fails, the worker does not keep it waiting
+    locusWorkerProcess = multiprocessing.get_context('fork').Process( \
+        target = locusWorker, args = (readFd, writeFd), daemon = True)
+    locusWorkerProcess.start()
+
+    os.close(writeFd)
+    fpLocus = os.fdopen(readFd, 'r')
+
+# Purpose: Worker process: read the annotations (locusQuery) through a
+#          server-side cursor, CLASSIFY_BATCH at a time, and write the bcp
+#          lines of each batch (classifyRows) to the pipe
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Queries a database; exits non-zero if the annotations could not
+#          all be read (the pipe is closed either way)
+# Throws: Nothing
+
+def locusWorker(readFd, writeFd):
+
+    os.close(readFd)
+    fp = os.fdopen(writeFd, 'w')
+
+    db.useOneConnection(1)
+    db.sql('declare locus_cursor no scroll cursor for %s' % (locusQuery()), None)
+
+    rows = 0
+    while True:
+        batch = db.sql('fetch forward %s from locus_cursor' % (CLASSIFY_BATCH), 'auto')[1]
+        if batch:
+            fp.write(classifyRows(batch))
+            rows = rows + len(batch)
+            print('%s annotations' % (rows))
+            sys.stdout.flush()
+        if len(batch) < CLASSIFY_BATCH:
+            break
+
+    db.sql('close locus_cursor', None)
+    db.commit()
+    db.useOneConnection(0)
+    fp.close()
+
+# Purpose: Load the classified locus-region annotations into a new temp
+#          table without a bcp file: the rows written by the annotation
+#          process (see startLocusWorker) are loaded by one COPY, read from
+#          the pipe as they are produced.
+# Returns: Nothing
+# Assumes: startLocusWorker() has been called
+# Effects: Nothing
+# Throws: Nothing
+
+def streamTempTable():
+    global tmpFxnTable
+
+    createTempTable()
+
+    print('Stream the locus-region SNP/marker annotations into the temp table')
     sys.stdout.flush()
-    db.sql('CREATE index idx1 on %s (_ConsensusSnp_Marker_key)' % (tmpFxnTable), None)
-    db.sql('CREATE index idx2 on %s (direction)' % (tmpFxnTable), None)
+
+    db.executeCopyFrom(fpLocus, tmpFxnTable, DL)
+    fpLocus.close()
+
+    # the pipe also ends if the worker fails: its rows may be incomplete
+    locusWorkerProcess.join()
+    if locusWorkerProcess.exitcode != 0:
+        sys.stderr.write('Could not read the locus-region annotations (exit code %s)\n' % (locusWorkerProcess.exitcode))
+        sys.exit(1)
+
+    db.commit()
+
+    indexTempTable()
 
 # Purpose: Update the function classes using the keys in the temp table.
 # Returns: Nothing
@@ -296,19 +425,21 @@ def applyUpdates():
         FROM %s t
         WHERE sm._ConsensusSnp_Marker_key = t._ConsensusSnp_Marker_key
         ''' % (tmpFxnTable), 'auto')
-
-    results = db.sql('''
-        SELECT t.* 
-        FROM SNP_ConsensusSnp_Marker sm, %s t
-        WHERE sm._ConsensusSnp_Marker_key = t._ConsensusSnp_Marker_key
-        ''' % (tmpFxnTable), 'auto')
     db.commit()
+
+    results = db.sql('SELECT count(*) FROM %s' % (tmpFxnTable), 'auto')
+    print('%s locus-region annotations updated' % (results[1][0][0]))
+    sys.stdout.flush()
+
 #
 #  MAIN
 #
 initialize()
-createBCPFile()
-loadBCPFile()
+if STREAM:
+    streamTempTable()
+else:
+    createBCPFile()
+    loadBCPFile()
 applyUpdates()
 finalize()
 
@@ -0,0 +1,223 @@
+#  snpmrkshadow.py
+###########################################################################
+#
+#  Purpose:
+#
+#      Shadow-table load of SNP_ConsensusSnp_Marker (SNPMRK_SHADOW_LOAD=yes)
+#
+#      Instead of truncating the live SNP_ConsensusSnp_Marker and leaving it
+#      empty/unindexed while it is re-loaded, snpmarker.sh:
+#
+#      1) snpmrkshadow.py create : creates an empty copy of the table
+#                                  (SNP_MRK_SHADOW_TABLE)
+#      2) snpmrkload.py          : loads the shadow table
+#      3) snpmrkindex.py         : builds the keys & indexes on the shadow table
+#      4) snpmrkshadow.py swap   : in one transaction:
+#                                  . drops the foreign keys of other tables
+#                                    to SNP_ConsensusSnp_Marker (and to
+#                                    zSNP_ConsensusSnp_Marker)
+#                                  . drops zSNP_ConsensusSnp_Marker
+#                                  . renames SNP_ConsensusSnp_Marker -> zSNP_ConsensusSnp_Marker
+#                                  . renames the shadow table -> SNP_ConsensusSnp_Marker
+#                                  (and their keys/indexes to match)
+#                                  . re-creates the foreign keys of the other
+#                                    tables, on the new SNP_ConsensusSnp_Marker
+#
+#      so readers always see a complete, indexed table and the previous
+#      generation is kept as zSNP_ConsensusSnp_Marker (see snpcheck.py).
+#
+#  Usage:
+#
+#      snpmrkshadow.py create | swap
+#
+#  Env Vars:
+#
+#      SNP_MRK_TABLE
+#      SNP_MRK_SHADOW_TABLE
+#
+#  Exit Codes:
+#
+#      0:  Successful completion
+#      1:  An exception occurred; nothing is changed
+#
+###########################################################################
+
+import sys
+import os
+import db
+
+db.setTrace(True)
+
+table = os.environ['SNP_MRK_TABLE']
+shadowTable = os.environ.get('SNP_MRK_SHADOW_TABLE', table + '_shadow')
+previousTable = 'z' + table
+
+# Purpose: Create the (empty) shadow table, with the same columns, defaults
+#          and grants as the live table, but no keys or indexes
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Creates a table
+# Throws:  Nothing
+
+def create():
+
+    db.sql('drop table if exists %s' % (shadowTable), None)
+    db.sql('create table %s (like %s including defaults including storage)' % (shadowTable, table), None)
+
+    results = db.sql('''
+        select grantee, privilege_type
+        from information_schema.role_table_grants
+        where table_name = lower('%s')
+        and grantee != current_user
+        ''' % (table), 'auto')
+    for r in results:
+        db.sql('grant %s on %s to %s' % (r['privilege_type'], shadowTable, r['grantee']), None)
+
+    db.commit()
+
+    return
+
+# Purpose: Return the names of the constraints and of the (other) indexes of a table
+# Returns: (list of constraint names, list of index names)
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws:  Nothing
+
+def getConstraintsIndexes(tableName):
+
+    constraints = []
+    results = db.sql('''
+        select conname
+        from pg_constraint
+        where conrelid = '%s'::regclass
+        ''' % (tableName), 'auto')
+    for r in results:
+        constraints.append(r['conname'])
+
+    # indexes of primary key/unique constraints are renamed with the constraint
+    indexes = []
+    results = db.sql('''
+        select c.relname
+        from pg_index i, pg_class c
+        where i.indrelid = '%s'::regclass
+        and i.indexrelid = c.oid
+        and not exists (select 1 from pg_constraint p where p.conindid = i.indexrelid)
+        ''' % (tableName), 'auto')
+    for r in results:
+        indexes.append(r['relname'])
+
+    return constraints, indexes
+
+# Purpose: Return the foreign keys of the other tables that reference a table
+#          (a foreign key follows the table it references through a rename,
+#          so these must be re-created on the new table by swap())
+# Returns: list of dictionaries: tablename, conname, definition
+#          (the definition names the referenced table as it is named now);
+#          empty if tableName does not exist
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws:  Nothing
+
+def getReferences(tableName):
+
+    return db.sql('''
+        select conrelid::regclass::text as tablename, conname,
+            pg_get_constraintdef(oid) as definition
+        from pg_constraint
+        where contype = 'f'
+        and confrelid = to_regclass('%s')
+        and conrelid != confrelid
+        order by 1, 2
+        ''' % (tableName), 'auto')
+
+# Purpose: Rename a table and its constraints & indexes, replacing fromName
+#          with toName in their names (or prefixing 'z' if fromName is not
+#          part of the name)
+# Returns: Nothing
+# Assumes: called inside the swap() transaction
+# Effects: Renames database objects
+# Throws:  Nothing
+
+def rename(fromName, toName):
+
+    constraints, indexes = getConstraintsIndexes(fromName)
+
+    for name in constraints:
+        db.sql('alter table %s rename constraint %s to %s' % (fromName, name, renameObject(name, fromName, toName)), None)
+
+    for name in indexes:
+        db.sql('alter index %s rename to %s' % (name, renameObject(name, fromName, toName)), None)
+
+    db.sql('alter table %s rename to %s' % (fromName, toName), None)
+
+    return
+
+# Purpose: Return the new name of a constraint/index for rename()
+# Returns: string
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def renameObject(name, fromName, toName):
+
+    if name.find(fromName.lower()) >= 0:
+        return name.replace(fromName.lower(), toName.lower())
+
+    return 'z' + name
+
+# Purpose: Swap the shadow table in as the live table; the live table becomes
+#          the previous-generation (z) table
+# Returns: Nothing
+# Assumes: the shadow table has been loaded and indexed
+# Effects: Drops/renames tables; re-creates the foreign keys to the table
+# Throws:  Nothing
+
+def swap():
+
+    results = db.sql('select count(*) as rowcount from %s' % (shadowTable), 'auto')
+    print('swap(): %s rows in %s' % (results[0]['rowcount'], shadowTable))
+    if results[0]['rowcount'] == 0:
+        sys.stderr.write('swap(): %s is empty; not swapped\n' % (shadowTable))
+        sys.exit(1)
+
+    db.sql('lock table %s in access exclusive mode' % (table), None)
+
+    # foreign keys left on the previous generation would block its drop
+    for r in getReferences(previousTable):
+        print('swap(): dropping %s.%s (references %s)' % (r['tablename'], r['conname'], previousTable))
+        db.sql('alter table %s drop constraint %s' % (r['tablename'], r['conname']), None)
+
+    references = getReferences(table)
+    for r in references:
+        db.sql('alter table %s drop constraint %s' % (r['tablename'], r['conname']), None)
+
+    db.sql('drop table if exists %s' % (previousTable), None)
+    rename(table, previousTable)
+    rename(shadowTable, table)
+
+    # the definitions name table, which is now the swapped-in table
+    for r in references:
+        print('swap(): re-creating %s.%s on the new %s' % (r['tablename'], r['conname'], table))
+        db.sql('alter table %s add constraint %s %s' % (r['tablename'], r['conname'], r['definition']), None)
+
+    db.commit()
+
+    return
+
+#
+#  MAIN
+#
+
+if len(sys.argv) != 2 or sys.argv[1] not in ('create', 'swap'):
+    sys.stderr.write('Usage: snpmrkshadow.py create | swap\n')
+    sys.exit(1)
+
+db.useOneConnection(1)
+
+if sys.argv[1] == 'create':
+    create()
+else:
+    swap()
+
+db.useOneConnection(0)
+sys.exit(0)
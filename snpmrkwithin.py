@@ -18,11 +18,16 @@
 #
 #  Inputs:
 #      1) Alliance TSV files generated by snpalliance.sh/snpalliance.py
+#         (and their key indexes if SNP_ALLIANCE_KEYS=yes)
 #      2) SNP_Coord_Cache/SNP_Accession
+#         (or, if SNPMRK_SNAPSHOT=yes, a local snapshot of them; see snapshotSNPs)
 #      2) MRK_Location_Cache
 #
 #  Outputs:
 #      "|" delimited bcp files, 1 per chromosome, to load records into the SNP_ConsensusSnp_Marker table.
+#      or, if SNPMRK_DIRECT_LOAD=yes, the same records loaded directly into SNP_ConsensusSnp_Marker (snpmrkload.py)
+#      per-chromosome metrics (SNPMRK_METRICS_FILE; see ChromosomeMetrics) & a summary table
+#      per-chromosome runtimes (SNPMRK_RUNTIME_FILE; the estimates of the next parallel run, see snpschedule.py)
 #
 ###########################################################################
 #
@@ -48,164 +53,2110 @@
 import sys
 import os
 import time
+import bisect
+import glob
+import hashlib
+import io
+import json
+import mmap
+import shutil
+import struct
+import multiprocessing
+import resource
+import subprocess
+from array import array
 import loadlib
 import db
+import snpschedule
+import snpdirection
 
 db.setTrace(True)
 
 WITHIN_COORD_TERM = 'within coordinates of'
 WITHIN_KB_TERM = 'within distance of'
-SNP_NOT_WITHIN  = 'Warning: SNP %s not within %s +/- bp of marker %s,s,%s,%s ' + '- this should never happen'
+SNP_NOT_WITHIN  = 'Warning: SNP %s not within %s +/- bp of marker %s,%s,%s,%s ' + '- this should never happen'
 
 # max number of BP away a SNP can be from a marker to compute a SNP-marker association
 MARKER_PAD = 2000	
 
+# order of the SNPs (snpQuery) and markers (markerQuery) the engines rely on
+SNP_ORDER = 'order by sc.startCoordinate, sc._Coord_Cache_key'
+MARKER_ORDER = 'order by mc.startCoordinate, mc.endCoordinate, mc._Marker_key'
+
 # SNP write format
 snpWrite = '%s|%s|%s|%s|%s|||||%s|%s|\n'
 
-# bcp file name prefix
-snpFile = None
-# alliance input file name
-snpAllianceFile = None
+# bcp file name prefix
+snpFile = None
+# alliance input file name
+snpAllianceFile = None
+
+# file pointer for the bcp file
+fpSnpBCP = None
+# file pointer for the alliance file
+fpSnpAlliance = None
+
+# lookup to resolve function class string to key
+fxnLookup = {}
+# Alliance Lookup by marker: MGI number -> {rs number : [fxnKey, ...]}
+# or, if ALLIANCE_KEYS, _Marker_key -> {_ConsensusSnp_key : [fxnKey, ...]}
+# (a dictionary, or an AllianceIndexMarkers if the Alliance TSV has a binary index)
+allianceMarkerLookup = {}
+# Alliance TSV of allianceMarkerLookup (a worker processing several tiles of a chromosome loads it once)
+allianceLookupFile = None
+# Alliance TSV of ALLIANCE_TMP_TABLE (sql engine: loaded once per connection & chromosome)
+allianceTableFile = None
+
+# list of chromosomes to process
+chrList = snpschedule.chrList
+
+# next available _SNP_ConsensusSnp_Marker_key
+primaryKey = 1
+
+# ChromosomeMetrics of the chromosome being processed (None: nothing is measured)
+metrics = None
+
+# number of worker processes; 1 = process the chromosomes serially
+WORKERS = int(os.environ.get('SNPMRK_WORKERS', '1'))
+
+# number of SNPs to fetch at a time from the SNP cursor (see streamProcess)
+# 0 = query all of the SNPs for a chromosome at once
+FETCH_SIZE = int(os.environ.get('SNPMRK_FETCH_SIZE', '0'))
+
+# number of SNPs to fetch at a time when querying all of the SNPs for a chromosome at once
+MAX_QUERY_BATCH = int(os.environ.get('MAX_QUERY_BATCH', '100000'))
+
+# split each chromosome into tiles of about TILE_SNPS SNPs (see chromosomeTiles)
+# and/or of at most TILE_MEMORY MB of SNPTable; 0 = 1 tile per chromosome
+TILE_SNPS = int(os.environ.get('SNPMRK_TILE_SNPS', '0'))
+TILE_MEMORY = int(os.environ.get('SNPMRK_TILE_MEMORY', '0'))
+
+# runtime of each chromosome in the last run: the estimates of the
+# parallel schedule (see chromosomeEstimates)
+RUNTIME_FILE = os.environ.get('SNPMRK_RUNTIME_FILE')
+# approximate bytes per Alliance TSV row (converts the TSV size to rows)
+ALLIANCE_ROW_BYTES = 64
+
+# SNP-marker join engine
+#   pair  : processSNPmarkerPair() for each SNP-marker pair
+#   batch : joinMarker() for all of the SNPs of each marker at once
+#   sql   : sqlProcess(), one set-based query per chromosome
+ENGINE = os.environ.get('SNPMRK_ENGINE', 'pair')
+# chromosomes processed by the sql engine whatever ENGINE is (see snpbench.py)
+SQL_CHROMOSOMES = os.environ.get('SNPMRK_SQL_CHROMOSOMES', '').split()
+
+# temp table of the Alliance rows of a chromosome (sql engine; see loadAllianceTable)
+ALLIANCE_TMP_TABLE = 'TMP_SNP_Alliance'
+
+# number of bytes the BCPWriter buffers before writing them to the bcp file
+BCP_BUFFER = int(os.environ.get('SNPMRK_BCP_BUFFER', str(8 * 1024 * 1024)))
+# the BCPWriter reports progress every PROGRESS_ROWS rows or PROGRESS_SECONDS seconds
+PROGRESS_ROWS = int(os.environ.get('SNPMRK_PROGRESS_ROWS', '1000000'))
+PROGRESS_SECONDS = int(os.environ.get('SNPMRK_PROGRESS_SECONDS', '60'))
+
+# load the rows straight into SNP_MRK_TABLE (COPY FROM STDIN) instead of writing bcp files
+DIRECT_LOAD = os.environ.get('SNPMRK_DIRECT_LOAD', 'no') == 'yes'
+# table DIRECT_LOAD loads: the shadow table if SNPMRK_SHADOW_LOAD=yes (see snpmrkshadow.py)
+# DIRECT_LOAD requires SHADOW_LOAD: each chromosome's COPY commits on its own, so
+# the live table would be empty, then partially loaded, for the whole run
+SHADOW_LOAD = os.environ.get('SNPMRK_SHADOW_LOAD', 'no') == 'yes'
+LOAD_TABLE = os.environ['SNP_MRK_TABLE']
+if SHADOW_LOAD:
+    LOAD_TABLE = os.environ.get('SNP_MRK_SHADOW_TABLE', LOAD_TABLE + '_shadow')
+# COPY process used by DIRECT_LOAD
+LOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snpmrkload.py')
+# last line sent to the LOADER; it only commits the rows if it receives it
+END_OF_DATA = '\\.\n'
+
+# incremental mode: only re-create the chromosomes whose inputs changed since the last load
+# (see process()); STATE_FILE holds the fingerprint & key range of each loaded chromosome
+INCREMENTAL = os.environ.get('SNPMRK_INCREMENTAL', 'no') == 'yes'
+STATE_FILE = os.environ.get('SNPMRK_STATE_FILE', os.environ['CACHEDATADIR'] + '/snpmrkwithin.state')
+# key ranges of the rows of the re-created chromosomes, to be deleted by snpmrkload.py -d
+DELETE_FILE = os.environ.get('SNPMRK_DELETE_FILE', os.environ['CACHEDATADIR'] + '/snpmrkwithin.delete')
+# delta mode (INCREMENTAL): if only the markers of a chromosome changed, only re-create the
+# rows of the markers that were added/removed/changed (see deltaChromosome) if there
+# are at most DELTA_MAX_MARKERS of them; MARKER_FILE holds the markers of the last load
+DELTA = os.environ.get('SNPMRK_DELTA', 'no') == 'yes'
+DELTA_MAX_MARKERS = int(os.environ.get('SNPMRK_DELTA_MAX_MARKERS', '1000'))
+MARKER_FILE = os.environ.get('SNPMRK_MARKER_FILE', os.environ['CACHEDATADIR'] + '/snpmrkwithin.markers')
+
+# checkpoint mode (full runs that write bcp files): CHECKPOINT_FILE lists each
+# completed chromosome or tile, in the order they finish (see writeCheckpoint);
+# a re-run after a failure skips them and only runs the others (see readCheckpoint)
+CHECKPOINT = os.environ.get('SNPMRK_CHECKPOINT', 'no') == 'yes'
+CHECKPOINT_FILE = os.environ.get('SNPMRK_CHECKPOINT_FILE', os.environ['CACHEDATADIR'] + '/snpmrkwithin.checkpoint')
+
+# snapshot mode: keep the SNPs of each chromosome in SNAPSHOT_FILE.<chr> and memory-map
+# them instead of querying them, as long as the SNP_Coord_Cache checksum still matches
+# (see snapshotSNPs)
+SNAPSHOT = os.environ.get('SNPMRK_SNAPSHOT', 'no') == 'yes'
+SNAPSHOT_FILE = os.environ.get('SNPMRK_SNAPSHOT_FILE', os.environ['CACHEDATADIR'] + '/snpmrkwithin.snps')
+# SNP snapshot header: magic, number of SNPs, accid bytes, validation (see snpChecksum)
+SNAPSHOT_MAGIC = b'SNPSNP2\0'
+SNAPSHOT_HEADER = '<8s14q'
+
+# per-chromosome metrics, 1 JSON object per line (see ChromosomeMetrics)
+METRICS_FILE = os.environ.get('SNPMRK_METRICS_FILE', os.environ['CACHEDATADIR'] + '/snpmrkwithin.metrics.jsonl')
+# phases of the metrics, in the order they are reported
+#   alliance : Alliance lookup (sql engine: + Alliance temp table)
+#   maxcoord : max SNP coordinate query
+#   snps     : SNPlist query/fetches (or SNP snapshot)
+#   markers  : marker query
+#   join     : SNP-marker join (sql engine: pair query)
+#   write    : bcp file writes (direct load: COPY)
+#   renumber : copy of the worker bcp file into the final bcp file (SNPMRK_WORKERS > 1)
+#   other    : everything else
+PHASES = ['alliance', 'maxcoord', 'snps', 'markers', 'join', 'write', 'renumber', 'other']
+
+# binary Alliance index header (see snpalliance.writeIndex)
+ALLIANCE_INDEX_MAGIC = b'SNPALX1\0'
+ALLIANCE_INDEX_HEADER = '<8sQQ'
+# yes = match the Alliance rows by _Marker_key/_ConsensusSnp_key, using the key index
+# snpalliance.py writes (TSV.keys, same format as TSV.idx), so the SNP and marker
+# queries do not need the SNP_Accession/ACC_Accession joins; they keep their
+# filters as "exists" subqueries (SNPs with an rs ID, markers with a preferred
+# MGI ID; see snpQuery & markerQuery), so the output is the same as with "no",
+# except for a SNP with several rs IDs: 1 set of rows instead of 1 per rs ID
+ALLIANCE_KEYS = os.environ.get('SNP_ALLIANCE_KEYS', 'no') == 'yes'
+ALLIANCE_KEYS_MAGIC = b'SNPALK1\0'
+
+# SNPTable bytes per SNP: 5 (4 if ALLIANCE_KEYS) int64 columns + the accid (~12 bytes)
+if ALLIANCE_KEYS:
+    SNP_TABLE_BYTES = 32
+else:
+    SNP_TABLE_BYTES = 52
+if TILE_MEMORY > 0:
+    TILE_SNPS = min([n for n in (TILE_SNPS, TILE_MEMORY * 1024 * 1024 // SNP_TABLE_BYTES) if n > 0])
+
+# Purpose: Columnar table of SNPs, ordered by coordinate
+#          Replaces a list of db.sql() dictionaries: each column is a
+#          contiguous array (8 bytes per SNP per column) and the accids are
+#          packed into one bytearray, addressed by their end offsets.
+#          The coordinate column can be searched with bisect.
+#
+#          snpKeys        : _ConsensusSnp_key
+#          coordCacheKeys : _Coord_Cache_key
+#          coords         : startCoordinate
+#          accids         : SNP_Accession.accid (use accid(i)); not queried if ALLIANCE_KEYS
+#          allianceKeys   : the allianceMarkerLookup key of the SNP: the accid rs number
+#                           (-1 if the accid is not rs<n>), or if ALLIANCE_KEYS,
+#                           the _ConsensusSnp_key
+
+class SNPTable:
+
+    def __init__(self):
+        self.snpKeys = array('q')
+        self.coordCacheKeys = array('q')
+        self.coords = array('q')
+        self.accids = bytearray()
+        self.accidEnds = array('q')
+        self.allianceKeys = array('q')
+
+    def __len__(self):
+        return len(self.coords)
+
+    # Purpose: Append db.sql() results (in coordinate order) to the table
+    # Returns: Nothing
+
+    def extend(self, results):
+        for r in results:
+            self.snpKeys.append(r['_consensussnp_key'])
+            self.coordCacheKeys.append(r['_coord_cache_key'])
+            self.coords.append(r['startCoordinate'])
+            if ALLIANCE_KEYS:
+                self.allianceKeys.append(r['_consensussnp_key'])
+                continue
+            self.accids.extend(r['accid'].encode('ascii'))
+            self.accidEnds.append(len(self.accids))
+            rsNumber = accidNumber(r['accid'], 'rs')
+            if rsNumber is None:
+                rsNumber = -1
+            self.allianceKeys.append(rsNumber)
+
+    # Purpose: Return the accid of SNP i
+    # Returns: string, or None if the accids were not queried (ALLIANCE_KEYS)
+
+    def accid(self, i):
+        if not self.accidEnds:
+            return None
+        if i == 0:
+            start = 0
+        else:
+            start = self.accidEnds[i-1]
+        return bytes(self.accids[start:self.accidEnds[i]]).decode('ascii')
+
+    # Purpose: Remove the first n SNPs from the table
+    # Returns: Nothing
+
+    def trim(self, n):
+        if n <= 0:
+            return
+        del self.snpKeys[:n]
+        del self.coordCacheKeys[:n]
+        del self.coords[:n]
+        del self.allianceKeys[:n]
+        if not self.accidEnds:
+            return
+        accidStart = self.accidEnds[n-1]
+        del self.accids[:accidStart]
+        del self.accidEnds[:n]
+        for i in range(len(self.accidEnds)):
+            self.accidEnds[i] = self.accidEnds[i] - accidStart
+
+    # Purpose: Return SNP i as a tuple (for messages)
+    # Returns: (_ConsensusSnp_key, _Coord_Cache_key, startCoordinate, accid)
+
+    def row(self, i):
+        return (self.snpKeys[i], self.coordCacheKeys[i], self.coords[i], self.accid(i))
+
+# Purpose: Writer of a SNP snapshot file (see mapSNPSnapshot)
+#          The columns of each SNPTable added are appended to a temporary file
+#          per column; close() writes the header & the columns to fileName.new,
+#          then renames it to fileName, so a snapshot is never partial.
+
+class SNPSnapshotWriter:
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.columnFiles = ['%s.new.%s' % (fileName, i) for i in range(6)]
+        self.columns = [open(f, 'wb') for f in self.columnFiles]
+        self.n = 0
+        self.m = 0
+
+    # Purpose: Append the SNPs of snps (which follow those already added)
+    # Returns: Nothing
+
+    def add(self, snps):
+        snps.snpKeys.tofile(self.columns[0])
+        snps.coordCacheKeys.tofile(self.columns[1])
+        snps.coords.tofile(self.columns[2])
+        snps.allianceKeys.tofile(self.columns[3])
+        array('q', [end + self.m for end in snps.accidEnds]).tofile(self.columns[4])
+        self.columns[5].write(snps.accids)
+        self.n = self.n + len(snps)
+        self.m = self.m + len(snps.accids)
+
+    # Purpose: Write fileName; validation is stored in the header
+    # Returns: Nothing
+
+    def close(self, validation):
+        for fp in self.columns:
+            fp.close()
+        with open(self.fileName + '.new', 'wb') as fp:
+            fp.write(struct.pack(SNAPSHOT_HEADER, SNAPSHOT_MAGIC, self.n, self.m, *validation))
+            for columnFile in self.columnFiles:
+                with open(columnFile, 'rb') as column:
+                    shutil.copyfileobj(column, fp, BCP_BUFFER)
+                os.remove(columnFile)
+        os.rename(self.fileName + '.new', self.fileName)
+
+# Purpose: Buffered writer for SNP_ConsensusSnp_Marker bcp files
+#          Rows are collected in memory and written to the file in blocks of
+#          (at least) BCP_BUFFER bytes, instead of one write() per row.
+#          Progress (rows written) is printed every PROGRESS_ROWS rows or,
+#          when a block is written, if PROGRESS_SECONDS have passed.
+#
+#          If directLoad is true, no bcp file is written: the rows are piped
+#          to a snpmrkload.py process that COPYs them into LOAD_TABLE
+#          as they arrive.
+
+class BCPWriter:
+
+    def __init__(self, fileName, directLoad = 0):
+        self.fileName = fileName
+        self.loader = None
+        if directLoad:
+            self.fileName = LOAD_TABLE + ' (' + os.path.basename(fileName) + ')'
+            self.loader = subprocess.Popen([sys.executable, LOADER, '-t', LOAD_TABLE, '-'], stdin = subprocess.PIPE, text = True)
+            self.fp = self.loader.stdin
+        else:
+            self.fp = open(fileName, 'w')
+        self.buffer = []
+        self.bufferSize = 0
+        self.rows = 0
+        self.bytes = 0
+        self.nextProgressRows = PROGRESS_ROWS
+        self.lastProgressTime = time.time()
+
+    # Purpose: Add one SNP_ConsensusSnp_Marker row
+    # Returns: Nothing
+
+    def addRow(self, primaryKey, snpKey, markerKey, fxnKey, coordCacheKey, distance, direction):
+        self.write(snpWrite % (primaryKey, snpKey, markerKey, fxnKey, coordCacheKey, distance, direction))
+
+    # Purpose: Add one or more complete (newline terminated) rows
+    # Returns: Nothing
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.bufferSize = self.bufferSize + len(text)
+        self.rows = self.rows + text.count('\n')
+
+        if self.bufferSize >= BCP_BUFFER:
+            self.flush()
+
+        if self.rows >= self.nextProgressRows:
+            self.progress()
+
+    # Purpose: Write the buffered rows to the bcp file
+    # Returns: Nothing
+
+    def flush(self):
+        if self.buffer:
+            startPhase('write')
+            self.fp.write(''.join(self.buffer))
+            stopPhase()
+            self.bytes = self.bytes + self.bufferSize
+            self.buffer = []
+            self.bufferSize = 0
+
+        if time.time() - self.lastProgressTime >= PROGRESS_SECONDS:
+            self.progress()
+
+    # Purpose: Print the number of rows written so far
+    # Returns: Nothing
+
+    def progress(self):
+        print('BCPWriter: %s: %s rows' % (self.fileName, self.rows))
+        sys.stdout.flush()
+        self.nextProgressRows = self.rows + PROGRESS_ROWS
+        self.lastProgressTime = time.time()
+
+    # Purpose: Write the buffered rows and close the bcp file
+    #          (direct load: and wait for the COPY to finish)
+    # Returns: Nothing
+    # Throws:  RuntimeError if the COPY failed
+
+    def close(self):
+        self.flush()
+        startPhase('write')
+        if self.loader is not None:
+            self.fp.write(END_OF_DATA)
+        self.fp.close()
+        print('BCPWriter: %s: %s rows, %s bytes' % (self.fileName, self.rows, self.bytes))
+        sys.stdout.flush()
+
+        status = 0
+        if self.loader is not None:
+            status = self.loader.wait()
+        stopPhase()
+
+        if status != 0:
+            raise RuntimeError('COPY into %s failed' % (self.fileName))
+
+# Purpose: Wall & CPU time of each phase (PHASES) of one chromosome, and its
+#          row counts, for the metrics file & summary (see writeMetrics).
+#          Phases nest (startPhase/stopPhase): time spent in an inner phase
+#          (e.g. a bcp write during the join) is not counted in the outer one,
+#          so the phases add up to the total; time outside of any phase is 'other'.
+
+class ChromosomeMetrics:
+
+    def __init__(self, chr, engine):
+        self.chr = chr
+        self.engine = engine
+        self.phases = {}
+        self.counts = {}
+        self.stack = []
+        self.startWall = self.lastWall = time.time()
+        self.startCpu = self.lastCpu = time.process_time()
+
+    # Purpose: Charge the time since the last call to the current phase
+    # Returns: Nothing
+
+    def charge(self):
+        wall = time.time()
+        cpu = time.process_time()
+        phase = self.stack[-1] if self.stack else 'other'
+        total = self.phases.setdefault(phase, [0.0, 0.0])
+        total[0] = total[0] + wall - self.lastWall
+        total[1] = total[1] + cpu - self.lastCpu
+        self.lastWall = wall
+        self.lastCpu = cpu
+
+    def start(self, phase):
+        self.charge()
+        self.stack.append(phase)
+
+    def stop(self):
+        self.charge()
+        self.stack.pop()
+
+    def count(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    # Purpose: Return the metrics of the chromosome, once its bcp file is closed
+    # Returns: dictionary (1 line of the metrics file)
+
+    def record(self, fp):
+        self.charge()
+        wall = time.time() - self.startWall
+        return {'chr' : self.chr,
+                'engine' : self.engine,
+                'wall' : round(wall, 3),
+                'cpu' : round(time.process_time() - self.startCpu, 3),
+                'snps' : self.counts.get('snps'),
+                'markers' : self.counts.get('markers'),
+                'pairs' : fp.rows,
+                'pairsPerSec' : round(fp.rows / max(wall, 0.001), 1),
+                'bytes' : fp.bytes,
+                # high-water mark of the process so far
+                'peakRssKb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'phases' : dict([(phase, {'wall' : round(w, 3), 'cpu' : round(c, 3)}) \
+                    for phase, (w, c) in self.phases.items()])}
+
+# Purpose: Read-only, memory-mapped binary Alliance index of a chromosome
+#          (written by snpalliance.writeIndex)
+#          Keys are MGI number << 32 | rs number (or, in a key index,
+#          _Marker_key << 32 | _ConsensusSnp_key), so the rows of a marker are
+#          a contiguous range of keys; all lookups are binary searches of the
+#          mapped file, nothing is parsed.
+
+class AllianceIndex:
+
+    def __init__(self, fileName, indexMagic = ALLIANCE_INDEX_MAGIC):
+        with open(fileName, 'rb') as fp:
+            self.mm = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, n, m = struct.unpack_from(ALLIANCE_INDEX_HEADER, self.mm)
+        if magic != indexMagic:
+            raise ValueError('%s is not an Alliance index' % (fileName))
+        view = memoryview(self.mm)
+        pos = struct.calcsize(ALLIANCE_INDEX_HEADER)
+        self.keys = view[pos:pos + 8 * n].cast('Q')
+        pos = pos + 8 * n
+        self.offsets = view[pos:pos + 4 * (n + 1)].cast('I')
+        pos = pos + 4 * (n + 1)
+        self.fxnKeys = view[pos:pos + 4 * m].cast('I')
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Purpose: Return the range of keys of a marker
+    # Returns: (lo, hi); lo == hi if the marker has no rows
+    # Assumes: Nothing
+    # Effects: Nothing
+    # Throws:  Nothing
+
+    def markerRange(self, markerNumber):
+        lo = bisect.bisect_left(self.keys, markerNumber << 32)
+        hi = bisect.bisect_left(self.keys, (markerNumber + 1) << 32, lo)
+        return lo, hi
+
+    # Purpose: Return the fxn keys of a SNP within the key range of a marker
+    # Returns: list of fxn keys or None
+    # Assumes: Nothing
+    # Effects: Nothing
+    # Throws:  Nothing
+
+    def find(self, lo, hi, key):
+        i = bisect.bisect_left(self.keys, key, lo, hi)
+        if i < hi and self.keys[i] == key:
+            return self.fxnKeys[self.offsets[i]:self.offsets[i + 1]].tolist()
+        return None
+
+# Purpose: allianceMarkerLookup view of an AllianceIndex
+#          get(markerNumber) works like allianceMarkerLookup.get(): it returns
+#          an AllianceIndexMarker (or None if the marker has no rows)
+
+class AllianceIndexMarkers:
+
+    def __init__(self, index):
+        self.index = index
+
+    def get(self, markerNumber, default = None):
+        lo, hi = self.index.markerRange(markerNumber)
+        if lo == hi:
+            return default
+        return AllianceIndexMarker(self.index, markerNumber, lo, hi)
+
+# Purpose: The Alliance rows of one marker in an AllianceIndex
+#          get(snpNumber) works like allianceMarkerLookup[markerNumber].get()
+
+class AllianceIndexMarker:
+
+    def __init__(self, index, markerNumber, lo, hi):
+        self.index = index
+        self.markerKey = markerNumber << 32
+        self.lo = lo
+        self.hi = hi
+
+    def get(self, snpNumber, default = None):
+        if snpNumber < 0:
+            return default
+        fxnKeys = self.index.find(self.lo, self.hi, self.markerKey | snpNumber)
+        if fxnKeys is None:
+            return default
+        return fxnKeys
+
+# Purpose: Return the number of an accid (rs<n>, MGI:<n>)
+# Returns: integer, or None if accid is not prefix<n> or n does not fit an AllianceIndex
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def accidNumber(accid, prefix):
+
+    if not accid.startswith(prefix):
+        return None
+    number = accid[len(prefix):]
+    if not number.isdigit() or int(number) >= 2**32:
+        return None
+    return int(number)
+
+# Purpose: Return the allianceMarkerLookup entry of a marker
+#          (by its MGI number, or if ALLIANCE_KEYS, its _Marker_key)
+# Returns: {SNP number : [fxnKey, ...]} (or AllianceIndexMarker), or None
+# Assumes: createAllianceLookup() has been called
+# Effects: Nothing
+# Throws:  Nothing
+
+def getMarkerAlliance(marker):
+
+    if ALLIANCE_KEYS:
+        return allianceMarkerLookup.get(marker['_marker_key'])
+
+    markerNumber = accidNumber(marker['markerId'], 'MGI:')
+    if markerNumber is None:
+        return None
+    return allianceMarkerLookup.get(markerNumber)
+
+# Purpose: Start/stop timing a phase (PHASES) of the current chromosome,
+#          count rows of the current chromosome (see ChromosomeMetrics)
+# Returns: Nothing
+# Assumes: startPhase/stopPhase calls are paired
+# Effects: Nothing
+# Throws:  Nothing
+
+def startPhase(phase):
+    if metrics is not None:
+        metrics.start(phase)
+
+def stopPhase():
+    if metrics is not None:
+        metrics.stop()
+
+def countRows(name, n):
+    if metrics is not None:
+        metrics.count(name, n)
+
+# Purpose: Return the metrics record of a chromosome that was not processed
+#          by this run because an earlier run completed it (see readCheckpoint):
+#          its rows & bcp file size, no time (only its renumbering was done by this run)
+# Returns: dictionary (the keys of ChromosomeMetrics.record)
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def skippedRecord(chr, keyRange):
+
+    firstKey, lastKey = keyRange
+
+    return {'chr' : chr,
+            'engine' : 'skipped',
+            'reason' : 'checkpoint',
+            'wall' : 0.0,
+            'cpu' : 0.0,
+            'snps' : None,
+            'markers' : None,
+            'pairs' : lastKey - firstKey + 1,
+            'pairsPerSec' : 0.0,
+            'bytes' : snpschedule.fileSize(bcpFileName(chr)),
+            'peakRssKb' : 0,
+            'phases' : {}}
+
+# Purpose: Write the metrics of the chromosomes of this run to METRICS_FILE
+#          (1 JSON object per chromosome, + 1 for the whole run) and print a
+#          summary table; the chromosomes skipped by a checkpoint resume
+#          (engine 'skipped', see skippedRecord) are listed but not counted
+#          in the total
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Writes METRICS_FILE
+# Throws:  Nothing
+
+def writeMetrics(records, startTime, startCpu):
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall = time.time() - startTime
+    processed = [r for r in records if r['engine'] != 'skipped']
+    pairs = sum([r['pairs'] for r in processed])
+    total = {'chr' : 'total',
+             'engine' : ENGINE,
+             'wall' : round(wall, 3),
+             'cpu' : round(time.process_time() - startCpu + children.ru_utime + children.ru_stime, 3),
+             'pairs' : pairs,
+             'pairsPerSec' : round(pairs / max(wall, 0.001), 1),
+             'bytes' : sum([r['bytes'] for r in processed]),
+             'peakRssKb' : max(usage.ru_maxrss, children.ru_maxrss),
+             'workers' : WORKERS,
+             'skipped' : len(records) - len(processed)}
+
+    with open(METRICS_FILE, 'w') as fp:
+        for r in records + [total]:
+            fp.write(json.dumps(r, sort_keys = True) + '\n')
+
+    print('\nwriteMetrics(): %s' % (METRICS_FILE))
+    print('%-5s %-7s %10s %8s %10s %8s %8s %10s %8s %8s  %s' % ('chr', 'engine', 'snps', 'markers', 'pairs', \
+        'wall', 'cpu', 'pairs/sec', 'MB', 'rss MB', ' '.join(['%8s' % (phase) for phase in PHASES])))
+    for r in records + [total]:
+        phases = r.get('phases', {})
+        print('%-5s %-7s %10s %8s %10s %8.1f %8.1f %10.0f %8.1f %8.1f  %s' % (r['chr'], r['engine'], \
+            '-' if r.get('snps') is None else r['snps'], '-' if r.get('markers') is None else r['markers'], \
+            r['pairs'], r['wall'], r['cpu'], r['pairsPerSec'], r['bytes'] / 1048576.0, r['peakRssKb'] / 1024.0, \
+            ' '.join(['%8.2f' % (phases[phase]['wall']) if phase in phases else '%8s' % ('-') for phase in PHASES])))
+    sys.stdout.flush()
+
+    return
+
+# Purpose: Perform initialization for the script.
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Queries databases
+# Throws: Nothing
+
+def initialize():
+    #
+    # The following globals will be initialized
+    #
+    global fxnLookup   # create lookup to resolve function class string to key
+
+    print('initialize(): perform initialization')
+    sys.stdout.flush()
+
+    #
+    #  Create a lookup for within* function class terms
+    #
+    results = db.sql('''
+            select t._term_key, t.term 
+            from VOC_Term t 
+            where t._Vocab_key = 49
+            and t.term LIKE 'within % of' 
+            ''', 'auto')
+    for r in results:
+        fxnLookup[r['term']] = r['_term_key']
+
+    return
+
+# Purpose: For each Chromosome, create a bcp file with annotations for SNP/marker pairs where the SNP is within 2 kb of the marker
+#          If WORKERS > 1, the chromosomes are processed in parallel (see parallelProcess)
+#
+#          If INCREMENTAL and STATE_FILE exists (i.e. the table was loaded by
+#          an earlier INCREMENTAL run), only the chromosomes whose fingerprint
+#          (see fingerprintChromosome) changed are processed:
+#          . their bcp files get new keys, starting after the last key in STATE_FILE
+#          . the key ranges of their old rows are written to DELETE_FILE
+#          . the bcp files of the other chromosomes are removed
+#          snpmarker.sh then deletes & re-loads just those rows.
+#
+#          If DELTA and only the markers of a chromosome changed, only the
+#          rows of the changed markers are deleted & re-created (see deltaChromosome).
+#
+#          If INCREMENTAL, STATE_FILE.new (and, if DELTA, MARKER_FILE.new) is
+#          written; snpmarker.sh replaces STATE_FILE with it once the rows are loaded.
+#
+#          If CHECKPOINT (and all of the chromosomes are re-created into bcp files),
+#          the fingerprint of every chromosome is computed, the chromosomes
+#          (or tiles) completed by an earlier, failed run with the same inputs
+#          are skipped (see readCheckpoint), and each chromosome (or tile) is
+#          added to CHECKPOINT_FILE (with its fingerprint) as soon as its
+#          temporary bcp file is complete; the keys are assigned once they are
+#          all complete (see parallelProcess, also used if WORKERS is 1);
+#          snpmarker.sh removes CHECKPOINT_FILE once this script succeeds.
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Queries a database, Outputs to BCP file represented by fpSnpBCP
+# Throws:  Nothing
+
+def process():
+    global primaryKey
+    global DIRECT_LOAD
+
+    #
+    #  Process one chromosome at a time to break up the size of the results set.
+    #   Create one bcp file per chromosome
+    #
+
+    startTime = time.time()
+    startCpu = time.process_time()
+
+    chromosomes = chrList
+    deltas = {}
+    fingerprints = {}
+    markers = {}
+    records = []
+    state = None
+
+    if INCREMENTAL:
+        fingerprints, markers = fingerprintChromosomes()
+        state = readState()
+
+    if state is not None:
+        snapshot = {}
+        if DELTA:
+            snapshot = readMarkers()
+
+        chromosomes = []
+        for chr in chrList:
+            if chr in state and state[chr][0] == fingerprints[chr]:
+                continue
+            if chr in state and chr in snapshot \
+                    and state[chr][0].split('|')[1:] == fingerprints[chr].split('|')[1:]:
+                changed = diffMarkers(snapshot[chr], markers[chr])
+                if len(changed) <= DELTA_MAX_MARKERS:
+                    deltas[chr] = changed
+                    continue
+            chromosomes.append(chr)
+        print('process(): incremental: %s of %s chromosomes changed: %s' % (len(chromosomes), len(chrList), ' '.join(chromosomes)))
+        print('process(): delta: %s chromosomes: %s' \
+            % (len(deltas), ' '.join(['%s (%s markers)' % (chr, len(deltas[chr])) for chr in chrList if chr in deltas])))
+        sys.stdout.flush()
+
+        primaryKey = max([lastKey for fingerprint, keyRanges in list(state.values()) for firstKey, lastKey in keyRanges] + [0]) + 1
+        # the old rows must be deleted first; see snpmarker.sh
+        DIRECT_LOAD = 0
+
+        fp = open(DELETE_FILE, 'w')
+        for chr in chrList:
+            if chr in chromosomes and chr in state:
+                for firstKey, lastKey in state[chr][1]:
+                    fp.write('%s|%s\n' % (firstKey, lastKey))
+            elif chr in deltas and deltas[chr]:
+                for firstKey, lastKey in state[chr][1]:
+                    fp.write('%s|%s|%s\n' % (firstKey, lastKey, ','.join(deltas[chr])))
+        fp.close()
+
+        for chr in chrList:
+            if os.path.exists(bcpFileName(chr)):
+                os.remove(bcpFileName(chr))
+
+    if DIRECT_LOAD and not SHADOW_LOAD:
+        sys.stderr.write('process(): SNPMRK_DIRECT_LOAD=yes requires SNPMRK_SHADOW_LOAD=yes\n')
+        sys.exit(1)
+
+    checkpoint = CHECKPOINT and state is None and not DIRECT_LOAD
+    completed = {}
+    if checkpoint:
+        # the checkpoint is only valid for the same inputs (see readCheckpoint)
+        if not fingerprints:
+            fingerprints, markers = fingerprintChromosomes()
+        completed = readCheckpoint(fingerprints)
+        print('process(): checkpoint: %s jobs completed' % (len(completed)))
+        sys.stdout.flush()
+
+    # a checkpointed run always goes through the tmp files (see parallelProcess)
+    if WORKERS > 1 or checkpoint:
+        ranges, records = parallelProcess(chromosomes, checkpoint, fingerprints, completed)
+    else:
+        ranges = {}
+        db.useOneConnection(1)
+        for chr in chromosomes:
+            firstKey = primaryKey
+            records.append(processChromosome(chr, bcpFileName(chr), DIRECT_LOAD))
+            ranges[chr] = (firstKey, primaryKey - 1)
+        db.useOneConnection(0)
+
+    processed = set([r['chr'] for r in records])
+    skipped = [skippedRecord(chr, ranges[chr]) for chr in chromosomes if chr not in processed]
+
+    if INCREMENTAL:
+        keyRanges = {}
+        for chr in chrList:
+            if chr in ranges:
+                keyRanges[chr] = [ranges[chr]]
+            else:
+                keyRanges[chr] = state[chr][1]
+
+        if deltas:
+            db.useOneConnection(1)
+            for chr in chrList:
+                if chr in deltas and deltas[chr]:
+                    firstKey = primaryKey
+                    records.append(deltaChromosome(chr, deltas[chr], markers[chr]))
+                    keyRanges[chr] = keyRanges[chr] + [(firstKey, primaryKey - 1)]
+            db.useOneConnection(0)
+
+        writeState(fingerprints, keyRanges)
+        if DELTA:
+            writeMarkers(markers)
+
+    writeMetrics(skipped + records, startTime, startCpu)
+    snpschedule.saveRuntimes(RUNTIME_FILE, dict([(r['chr'], r['wall']) for r in records if r['engine'] != 'delta']))
+
+    return
+
+# Purpose: Delta engine: create the bcp file of the rows of the given markers
+#          of one chromosome whose SNPs & Alliance TSV did not change
+#
+#          Only the SNPs within MARKER_PAD of the markers that still exist
+#          are queried (1 query per group of overlapping markers), and joined
+#          with those markers only (see joinSNPregion).
+#          The rows of every marker in markerKeys are deleted (see process).
+# Returns: metrics of the chromosome (see ChromosomeMetrics)
+# Assumes: Nothing
+# Effects: Queries a database, Outputs to BCP file
+# Throws:  Nothing
+
+def deltaChromosome(chr, markerKeys, Markers):
+    global fpSnpAlliance
+    global SNPlist
+    global metrics
+
+    print('\ndeltaChromosome(): chromosome: %s markers: %s' % (chr, len(markerKeys)))
+
+    metrics = ChromosomeMetrics(chr, 'delta')
+    markerKeys = set(markerKeys)
+    Markers = [m for m in Markers if str(m['_marker_key']) in markerKeys]
+    countRows('markers', len(Markers))
+
+    snpAllianceFile = os.environ['SNP_ALLIANCE_TSV'] + '.' + str(chr) + '.tsv'
+    try:
+        fpSnpAlliance = open(snpAllianceFile, 'r')
+        fp = BCPWriter(bcpFileName(chr))
+    except:
+        sys.stderr.write('Cannot Read SNP Alliance File: %s\n' % snpAllianceFile)
+        sys.stderr.write('Cannot Write SNP File: %s\n' % bcpFileName(chr))
+        sys.exit(1)
+
+    startPhase('alliance')
+    createAllianceLookup(fpSnpAlliance)
+    stopPhase()
+    fpSnpAlliance.close()
+
+    #
+    # group the markers whose SNP windows overlap
+    #
+    groups = []
+    for m in Markers:
+        start = min(m['markerStart'], m['markerEnd']) - MARKER_PAD
+        end = max(m['markerStart'], m['markerEnd']) + MARKER_PAD
+        if groups and start <= groups[-1][1]:
+            groups[-1][1] = max(groups[-1][1], end)
+            groups[-1][2].append(m)
+        else:
+            groups.append([start, end, [m]])
+
+    for start, end, group in groups:
+        SNPlist = SNPTable()
+        declareSNPCursor(chr, start, end)
+        while fetchSNPs(SNPlist, MAX_QUERY_BATCH) == MAX_QUERY_BATCH:
+            pass
+        closeSNPCursor()
+        startPhase('join')
+        joinSNPregion(fp, SNPlist, group)
+        stopPhase()
+
+    print('deltaChromosome(): %s groups of markers' % (len(groups)))
+    fp.close()
+
+    record = metrics.record(fp)
+    metrics = None
+
+    return record
+
+# Purpose: Compare the markers of a chromosome with those of the last load
+# Returns: list of the _Marker_keys (as strings) that were added, removed or changed
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def diffMarkers(snapshot, Markers):
+
+    current = {}
+    for m in Markers:
+        current[str(m['_marker_key'])] = markerSnapshot(m)
+
+    changed = []
+    for markerKey in current:
+        if snapshot.get(markerKey) != current[markerKey]:
+            changed.append(markerKey)
+    for markerKey in snapshot:
+        if markerKey not in current:
+            changed.append(markerKey)
+
+    return changed
+
+# Purpose: Return the values of a marker that its rows depend on
+# Returns: tuple of strings (markerId ('' if ALLIANCE_KEYS), start, end, strand)
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def markerSnapshot(m):
+
+    return (str(m.get('markerId', '')), str(m['markerStart']), str(m['markerEnd']), str(m['markerStrand']))
+
+# Purpose: Read MARKER_FILE
+#          one line per marker: chromosome, _Marker_key, markerId, start, end, strand (tab-delimited)
+# Returns: dictionary of chromosome -> {_Marker_key : markerSnapshot()}
+# Assumes: Nothing
+# Effects: Reads a file
+# Throws:  Nothing
+
+def readMarkers():
+
+    snapshot = {}
+
+    if not os.path.exists(MARKER_FILE):
+        return snapshot
+
+    for line in open(MARKER_FILE, 'r'):
+        tokens = line[:-1].split('\t')
+        if tokens[0] not in snapshot:
+            snapshot[tokens[0]] = {}
+        snapshot[tokens[0]][tokens[1]] = tuple(tokens[2:])
+
+    return snapshot
+
+# Purpose: Write MARKER_FILE.new (see readMarkers)
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Writes a file
+# Throws:  Nothing
+
+def writeMarkers(markers):
+
+    fp = open(MARKER_FILE + '.new', 'w')
+    for chr in chrList:
+        for m in markers[chr]:
+            fp.write('%s\t%s\t%s\n' % (chr, m['_marker_key'], '\t'.join(markerSnapshot(m))))
+    fp.close()
+
+    return
+
+# Purpose: Return the max SNP coordinate of the given chromosome
+# Returns: integer
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws:  Nothing
+
+def maxCoordinate(chr):
+
+    results = db.sql('''
+            select max(startCoordinate) as maxCoord 
+            from SNP_Coord_Cache 
+            where chromosome = '%s' 
+            ''' % (chr), 'auto')
+
+    return results[0]['maxCoord']
+
+# Purpose: Compute the fingerprint of the inputs of one chromosome:
+#          . the marker set (markerQuery) : row count & checksum
+#          . the SNP set (snpQuery)       : row count & checksum
+#          . the Alliance TSV             : md5 (of its key index if ALLIANCE_KEYS)
+#          . MARKER_PAD, ALLIANCE_KEYS & fxnLookup
+#          The checksums are computed by the database (sum of the row hashes),
+#          so the rows are not fetched.
+#          If DELTA, the markers themselves are also returned (see diffMarkers).
+# Returns: (fingerprint string, list of marker dictionaries or None)
+# Assumes: Nothing
+# Effects: Queries a database, Reads the Alliance TSV
+# Throws:  Nothing
+
+def fingerprintChromosome(chr):
+
+    maxCoord = maxCoordinate(chr)
+
+    # the accids are only queried (and only matter) if not ALLIANCE_KEYS
+    markerId = 'q.markerId, '
+    accid = ', q.accid'
+    allianceFile = os.environ['SNP_ALLIANCE_TSV'] + '.' + str(chr) + '.tsv'
+    if ALLIANCE_KEYS:
+        markerId = ''
+        accid = ''
+        allianceFile = allianceFile + '.keys'
+
+    results = db.sql('''
+            select count(*) as rowcount,
+                   sum(hashtextextended(concat_ws(',', %sq._marker_key, q.markerStart, q.markerEnd, q.markerStrand), 0)) as checksum
+            from (%s) q
+            ''' % (markerId, markerQuery(chr, 1, maxCoord)), 'auto')
+    markers = '%s:%s' % (results[0]['rowcount'], results[0]['checksum'])
+
+    results = db.sql('''
+            select count(*) as rowcount,
+                   sum(hashtextextended(concat_ws(',', q._ConsensusSnp_key, q._Coord_Cache_key, q.startCoordinate%s), 0)) as checksum
+            from (%s) q
+            ''' % (accid, snpQuery(chr, 1, maxCoord)), 'auto')
+    snps = '%s:%s' % (results[0]['rowcount'], results[0]['checksum'])
+
+
+    settings = hashlib.md5(str((MARKER_PAD, ALLIANCE_KEYS, sorted(fxnLookup.items()))).encode())
+
+    Markers = None
+    if DELTA:
+        Markers = db.sql('%s %s' % (markerQuery(chr, 1, maxCoord), MARKER_ORDER), 'auto')
+
+    return ('%s|%s|%s|%s' % (markers, snps, fileChecksum(allianceFile), settings.hexdigest()), Markers)
+
+# Purpose: Compute the fingerprint of every chromosome in chrList
+#          (WORKERS at a time)
+# Returns: (dictionary of chromosome -> fingerprint,
+#           dictionary of chromosome -> list of marker dictionaries or None)
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws:  Nothing
+
+def fingerprintChromosomes():
+
+    print('fingerprintChromosomes(): start time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
+    sys.stdout.flush()
+
+    if WORKERS > 1:
+        pool = multiprocessing.get_context('fork').Pool(WORKERS)
+        try:
+            fingerprints = pool.map(fingerprintWorker, chrList, 1)
+        except Exception as e:
+            sys.stderr.write('fingerprintChromosomes(): failed: %s\n' % (e))
+            pool.terminate()
+            sys.exit(1)
+        pool.close()
+        pool.join()
+    else:
+        db.useOneConnection(1)
+        fingerprints = [fingerprintChromosome(chr) for chr in chrList]
+        db.commit()
+        db.useOneConnection(0)
+
+    print('fingerprintChromosomes(): end time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
+    sys.stdout.flush()
+
+    return dict([(chr, f[0]) for chr, f in zip(chrList, fingerprints)]), \
+           dict([(chr, f[1]) for chr, f in zip(chrList, fingerprints)])
+
+# Purpose: Worker process: compute the fingerprint of one chromosome
+# Returns: see fingerprintChromosome
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws:  RuntimeError if the fingerprint could not be computed
+
+def fingerprintWorker(chr):
+
+    db.useOneConnection(1)
+    try:
+        fingerprint = fingerprintChromosome(chr)
+        db.commit()
+    except SystemExit:
+        raise RuntimeError('chromosome %s failed' % (chr))
+    finally:
+        db.useOneConnection(0)
+
+    return fingerprint
+
+# Purpose: Read STATE_FILE
+#          one line per chromosome: chromosome, fingerprint, key ranges (tab-delimited)
+#          key ranges: comma-separated first-last key ranges of the chromosome's rows
+# Returns: dictionary of chromosome -> (fingerprint, list of (first key, last key))
+#          or None if STATE_FILE does not exist
+# Assumes: Nothing
+# Effects: Reads a file
+# Throws:  Nothing
+
+def readState():
+
+    if not os.path.exists(STATE_FILE):
+        print('readState(): %s does not exist; processing every chromosome' % (STATE_FILE))
+        return None
+
+    state = {}
+    for line in open(STATE_FILE, 'r'):
+        chr, fingerprint, keyRanges = line[:-1].split('\t')
+        state[chr] = (fingerprint, [])
+        for keyRange in keyRanges.split(','):
+            if keyRange:
+                firstKey, lastKey = keyRange.split('-')
+                state[chr][1].append((int(firstKey), int(lastKey)))
+
+    return state
+
+# Purpose: Write STATE_FILE.new (see readState)
+#          empty key ranges (chromosomes/markers without rows) are left out
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Writes a file
+# Throws:  Nothing
+
+def writeState(fingerprints, keyRanges):
+
+    fp = open(STATE_FILE + '.new', 'w')
+    for chr in chrList:
+        ranges = ['%s-%s' % (firstKey, lastKey) for firstKey, lastKey in keyRanges[chr] if firstKey <= lastKey]
+        fp.write('%s\t%s\t%s\n' % (chr, fingerprints[chr], ','.join(ranges)))
+    fp.close()
+
+    return
+
+# Purpose: Read CHECKPOINT_FILE & verify the jobs completed by an earlier run
+#          one line per job (a chromosome or a tile of one, see parallelProcess):
+#          chromosome, tile (0 = the whole chromosome), startCoord-endCoord of
+#          the tile ('-' if 0), temporary bcp file (see tmpFileName), row count,
+#          md5 of the file, fingerprint of the inputs of the chromosome
+#          (tab-delimited; see fingerprintChromosome)
+#
+#          If the fingerprint of any chromosome in CHECKPOINT_FILE does not
+#          match that of its current inputs (markers, SNPs, Alliance TSV,
+#          settings), the bcp files are stale: the whole checkpoint is
+#          discarded and every chromosome is re-created.
+#          Otherwise every job whose temporary bcp file still exists & is
+#          unchanged (md5) is complete, in any order: the files have keys
+#          starting at 1 and only get their key offsets once every job is
+#          done (see parallelProcess).  CHECKPOINT_FILE is rewritten with the
+#          verified jobs only.
+# Returns: dictionary of job (chr, None or (tile, startCoord, endCoord)) -> rows
+# Assumes: fingerprints: dictionary of chromosome -> fingerprint of every chromosome
+# Effects: Reads the temporary bcp files, Reads/writes CHECKPOINT_FILE
+# Throws:  Nothing
+
+def readCheckpoint(fingerprints):
+
+    completed = {}
+
+    if not os.path.exists(CHECKPOINT_FILE):
+        print('readCheckpoint(): %s does not exist; processing every chromosome' % (CHECKPOINT_FILE))
+        return completed
+
+    entries = []
+    for line in open(CHECKPOINT_FILE, 'r'):
+        entries.append(line[:-1].split('\t'))
+
+    stale = [entry[0] for entry in entries if len(entry) != 7 or entry[6] != fingerprints.get(entry[0])]
+    if stale:
+        print('readCheckpoint(): inputs changed (chromosomes %s); checkpoint discarded' % (' '.join(stale)))
+        entries = []
+
+    lines = []
+    for entry in entries:
+        chr, tile, coords, fileName, rows, checksum, fingerprint = entry
+        if int(tile):
+            startCoord, endCoord = [int(coord) for coord in coords.split('-')]
+            job = (chr, (int(tile), startCoord, endCoord))
+        else:
+            job = (chr, None)
+        if fileName != tmpFileName(chr, int(tile)) or not os.path.exists(fileName):
+            print('readCheckpoint(): chromosome %s tile %s: %s is missing' % (chr, tile, fileName))
+            continue
+        if fileChecksum(fileName) != checksum:
+            print('readCheckpoint(): chromosome %s tile %s: %s changed' % (chr, tile, fileName))
+            continue
+        print('readCheckpoint(): chromosome %s tile %s: %s rows: complete' % (chr, tile, rows))
+        completed[job] = int(rows)
+        lines.append('\t'.join(entry) + '\n')
+
+    fp = open(CHECKPOINT_FILE + '.new', 'w')
+    fp.write(''.join(lines))
+    fp.close()
+    os.replace(CHECKPOINT_FILE + '.new', CHECKPOINT_FILE)
+    sys.stdout.flush()
+
+    return completed
+
+# Purpose: Add a completed job (see readCheckpoint) to CHECKPOINT_FILE
+#          The line is synced to disk, so that it survives the failure of a later job.
+# Returns: Nothing
+# Assumes: the temporary bcp file of the job is complete & closed
+# Effects: Reads the temporary bcp file, Appends to CHECKPOINT_FILE
+# Throws:  Nothing
+
+def writeCheckpoint(job, rows, fingerprint):
+
+    chr, tile = job
+    if tile is None:
+        tile, coords = 0, '-'
+    else:
+        tile, coords = tile[0], '%s-%s' % (tile[1], tile[2])
+    fileName = tmpFileName(chr, tile)
+
+    fp = open(CHECKPOINT_FILE, 'a')
+    fp.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\n' \
+        % (chr, tile, coords, fileName, rows, fileChecksum(fileName), fingerprint))
+    fp.flush()
+    os.fsync(fp.fileno())
+    fp.close()
+
+    return
+
+# Purpose: Compute the md5 of a file
+# Returns: hex digest
+# Assumes: Nothing
+# Effects: Reads the file
+# Throws:  Nothing
+
+def fileChecksum(fileName):
+
+    checksum = hashlib.md5()
+    with open(fileName, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            checksum.update(block)
+
+    return checksum.hexdigest()
+
+# Purpose: Return the name of the bcp file for the given chromosome
+# Returns: bcp file name
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def bcpFileName(chr):
+    return os.environ['CACHEDATADIR'] + '/' + os.environ['SNP_MRK_FILE'] + '.' + str(chr)
+
+# Purpose: Return the name of the temporary (not yet renumbered) bcp file for the given chromosome
+#          (prefixed, so that it is never picked up by the ${SNP_MRK_FILE}* load in snpmarker.sh)
+# Returns: bcp file name
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def tmpFileName(chr, tile = 0):
+    if tile:
+        return os.environ['CACHEDATADIR'] + '/tmp.' + os.environ['SNP_MRK_FILE'] + '.' + str(chr) + '.' + str(tile)
+    return os.environ['CACHEDATADIR'] + '/tmp.' + os.environ['SNP_MRK_FILE'] + '.' + str(chr)
+
+# Purpose: Create the bcp file for one chromosome, one tile at a time
+#          (tiles: list of (tile, startCoord, endCoord); default: chromosomeTiles())
+#          primaryKeys are assigned starting from the current value of primaryKey
+#          If directLoad is true, the rows are loaded into LOAD_TABLE instead
+# Returns: metrics of the chromosome (see ChromosomeMetrics)
+# Assumes: Nothing
+# Effects: Queries a database, Outputs to BCP file snpFile
+# Throws:  Nothing
+
+def processChromosome(chr, snpFile, directLoad = 0, tiles = None):
+    global snpAllianceFile  # get alliance input file
+    global fpSnpBCP
+    global fpSnpAlliance
+    global metrics
+
+    print('\nprocess(): chromosome: %s' % (chr))
+
+    if ENGINE == 'sql' or chr in SQL_CHROMOSOMES:
+        metrics = ChromosomeMetrics(chr, 'sql')
+    else:
+        metrics = ChromosomeMetrics(chr, ENGINE)
+
+    try:
+        print('process(): create read/write files')
+        snpAllianceFile = os.environ['SNP_ALLIANCE_TSV'] + '.' + str(chr) + '.tsv'
+        fpSnpAlliance = open("%s" % (snpAllianceFile),'r')
+        fpSnpBCP = BCPWriter(snpFile, directLoad)
+    except:
+        sys.stderr.write('Cannot Read SNP Alliance File: %s\n' % snpAllianceFile)
+        sys.stderr.write('Cannot Write SNP File: %s\n' % snpFile)
+        sys.exit(1)
+        
+    startPhase('alliance')
+    createAllianceLookup(fpSnpAlliance)
+    stopPhase()
+
+    if tiles is None:
+        startPhase('maxcoord')
+        tiles = chromosomeTiles(chr)
+        stopPhase()
+
+    for tile, startCoord, endCoord in tiles:
+        if tile:
+            print('process(): tile %s: coord %s - %s' % (tile, startCoord, endCoord))
+        binProcess(chr, startCoord, endCoord, tile)
+        sys.stdout.flush()
+
+    fpSnpAlliance.close()
+    fpSnpBCP.close()
+
+    record = metrics.record(fpSnpBCP)
+    record['tiles'] = len(tiles)
+    metrics = None
+
+    return record
+
+# Purpose: Split a chromosome into tiles (coordinate ranges) of about TILE_SNPS
+#          SNPs each, so that only the SNPs (and markers) of one tile are in
+#          memory at a time, and the tiles can be processed by different workers.
+#
+#          The tiles partition the SNPs: tile n is startCoord-endCoord, tile n+1
+#          starts at endCoord+1 (SNPs that share a coordinate are in the same
+#          tile).  Each tile is processed like a whole chromosome (binProcess):
+#          its SNPs are joined with every marker within MARKER_PAD of them,
+#          including the markers that overlap the next or previous tile, so
+#          every SNP-marker pair is computed exactly once, by the tile of the SNP.
+#          Only the order of the rows (and so their primaryKeys) depends on the tiles.
+#
+#          The tile boundaries are every TILE_SNPS-th SNP coordinate, computed
+#          by the database from the chromosome/startCoordinate index.
+# Returns: list of (tile, startCoord, endCoord), tiles numbered from 1;
+#          if TILE_SNPS is 0: [(0, 1, max SNP coordinate)]
+# Assumes: Nothing
+# Effects: Queries a database, Removes the SNP snapshots of other tiles
+# Throws:  Nothing
+
+def chromosomeTiles(chr):
+
+    print('process(): query for max SNP coordinate')
+    maxCoord = maxCoordinate(chr)
+    print('process(): max coord: %s' % (maxCoord))
+    sys.stdout.flush()
+
+    if TILE_SNPS <= 0 or maxCoord is None:
+        tiles = [(0, 1, maxCoord)]
+        removeSnapshots(chr, tiles)
+        return tiles
+
+    results = db.sql('''
+            select startCoordinate
+            from (select startCoordinate, row_number() over (order by startCoordinate) as snpNumber
+                  from SNP_Coord_Cache
+                  where chromosome = '%s') s
+            where snpNumber %% %s = 0
+            order by startCoordinate
+            ''' % (chr, TILE_SNPS), 'auto')
+
+    tiles = []
+    startCoord = 1
+    for r in results:
+        endCoord = r['startCoordinate']
+        if endCoord >= startCoord and endCoord < maxCoord:
+            tiles.append((len(tiles) + 1, startCoord, endCoord))
+            startCoord = endCoord + 1
+    tiles.append((len(tiles) + 1, startCoord, maxCoord))
+
+    print('process(): %s tiles of %s SNPs' % (len(tiles), TILE_SNPS))
+    sys.stdout.flush()
+
+    removeSnapshots(chr, tiles)
+
+    return tiles
+
+# Purpose: Remove the SNP snapshots of a chromosome that are not those of its
+#          current tiles (SNAPSHOT_FILE.<chr> when not tiling,
+#          SNAPSHOT_FILE.<chr>.<tile> otherwise), e.g. left by a run with
+#          another TILE_SNPS, or by tiles that no longer exist
+# Returns: Nothing
+# Assumes: tiles: list of (tile, startCoord, endCoord) (see chromosomeTiles)
+# Effects: Removes files
+# Throws:  Nothing
+
+def removeSnapshots(chr, tiles):
+
+    if not SNAPSHOT:
+        return
+
+    prefix = SNAPSHOT_FILE + '.' + str(chr)
+    current = set([snapshotFileName(chr, tile) for tile, startCoord, endCoord in tiles])
+
+    for fileName in [prefix] + glob.glob(glob.escape(prefix) + '.*'):
+        if fileName != prefix and not fileName[len(prefix) + 1:].isdigit():
+            continue
+        if fileName not in current and os.path.exists(fileName):
+            print('process(): remove SNP snapshot of another tile: %s' % (fileName))
+            os.remove(fileName)
+
+    return
+
+# Purpose: Worker process: compute the tiles of one chromosome
+# Returns: list of (tile, startCoord, endCoord) (see chromosomeTiles)
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws:  Nothing
+
+def tileWorker(chr):
+
+    db.useOneConnection(1)
+    try:
+        tiles = chromosomeTiles(chr)
+    finally:
+        db.useOneConnection(0)
+
+    return tiles
+
+# Purpose: Create allianceMarkerLookup for the Alliance TSV of a chromosome:
+#          MGI number -> {rs number : [fxnKey, ...]}
+#          so that each marker is looked up once (getMarkerAlliance) and each of
+#          its SNPs by an integer (SNPTable.allianceKeys), with no per-pair string keys.
+#          Rows whose IDs are not MGI:<n>/rs<n> can never match a marker/ConsensusSnp
+#          accid and are left out.
+#          If the TSV has an up to date binary index (TSV.idx), the index is
+#          memory-mapped (see AllianceIndex) instead of parsing the TSV.
+#          If ALLIANCE_KEYS, the key index (TSV.keys) is memory-mapped instead:
+#          _Marker_key -> {_ConsensusSnp_key : [fxnKey, ...]}
+#          Nothing is done if allianceMarkerLookup is already that of the TSV.
+# Returns: Nothing
+# Assumes: fp is the open Alliance TSV
+# Effects: Reads the Alliance TSV
+# Throws:  Nothing
+
+def createAllianceLookup(fp):
+    global allianceMarkerLookup
+    global allianceLookupFile
+
+    if fp.name == allianceLookupFile:
+        print('process(): Alliance lookup: already loaded: %s' % (fp.name))
+        return
+    allianceLookupFile = fp.name
+
+    if ALLIANCE_KEYS:
+        keysFile = fp.name + '.keys'
+        if not os.path.exists(keysFile) or os.path.getmtime(keysFile) < os.path.getmtime(fp.name):
+            sys.stderr.write('Missing or out of date SNP Alliance key index: %s (run snpalliance.sh)\n' % keysFile)
+            sys.exit(1)
+        print('process(): open Alliance key index: %s' % (keysFile))
+        index = AllianceIndex(keysFile, ALLIANCE_KEYS_MAGIC)
+        allianceMarkerLookup = AllianceIndexMarkers(index)
+        print('process(): Alliance lookup: ' + str(len(index)))
+        return
+
+    indexFile = fp.name + '.idx'
+    if os.path.exists(indexFile) and os.path.getmtime(indexFile) >= os.path.getmtime(fp.name):
+        print('process(): open Alliance index: %s' % (indexFile))
+        index = AllianceIndex(indexFile)
+        allianceMarkerLookup = AllianceIndexMarkers(index)
+        print('process(): Alliance lookup: ' + str(len(index)))
+        return
+
+    print('process(): create Alliance lookup')
+    allianceMarkerLookup = {}
+    count = 0
+    for line in fp:
+        tokens = line[:-1].split('|')
+        rsNumber = accidNumber(tokens[0], 'rs')
+        markerNumber = accidNumber(tokens[1], 'MGI:')
+        if rsNumber is None or markerNumber is None:
+            continue
+        if markerNumber not in allianceMarkerLookup:
+            allianceMarkerLookup[markerNumber] = {}
+        if rsNumber not in allianceMarkerLookup[markerNumber]:
+            allianceMarkerLookup[markerNumber][rsNumber] = []
+            count = count + 1
+        allianceMarkerLookup[markerNumber][rsNumber].append(tokens[4])
+    print('process(): Alliance lookup: ' + str(count))
+
+    return
+
+# Purpose: Process the chromosomes in a pool of WORKERS processes
+#          Each worker uses its own database connection and writes
+#          tmp.SNP_ConsensusSnp_Marker.bcp.<chr> with primaryKeys starting at 1.
+#          The jobs (chromosomes or tiles) are dispatched largest first,
+#          as estimated by chromosomeEstimates; a tile is estimated by its
+#          runtime in RUNTIME_FILE (job <chr>.<tile>) or, without one, by its
+#          share of the chromosome (see snpschedule.estimate), and the tile
+#          runtimes of this run are saved for the next one.
+#          Once every job is done, the per-job row counts are used to compute
+#          each chromosome's key offset (in chromosomes order, starting at
+#          primaryKey) and the tmp files are renumbered into
+#          SNP_ConsensusSnp_Marker.bcp.<chr>.
+#          The result is identical to a serial run.
+#
+#          If checkpoint, each job is added to CHECKPOINT_FILE (see
+#          writeCheckpoint) as soon as its worker returns, in whatever order
+#          the jobs finish, and the jobs in completed (see readCheckpoint) are
+#          not run again: their tmp files are renumbered with the others.
+#          The tmp files are kept until every chromosome is renumbered.
+#          A checkpointed run with WORKERS = 1 runs its jobs in this process.
+# Returns: dictionary of chromosome -> (first key, last key),
+#          list of metrics of the chromosomes processed (at least in part) by this run
+# Assumes: fingerprints: dictionary of chromosome -> fingerprint, if checkpoint
+#          completed: dictionary of job -> rows (see readCheckpoint)
+# Effects: Queries a database, Outputs to BCP files, Appends to CHECKPOINT_FILE
+# Throws:  Nothing
+
+def parallelProcess(chromosomes, checkpoint = 0, fingerprints = {}, completed = {}):
+    global primaryKey
+
+    print('parallelProcess(): %s workers' % (WORKERS))
+    sys.stdout.flush()
+
+    # processWorker sets primaryKey (in this process if there is no pool)
+    firstKey = primaryKey
+
+    # a chromosome completed as a whole needs no tiles (nor estimate)
+    pending = [chr for chr in chromosomes if (chr, None) not in completed]
+
+    # before the fork: the workers must not share the connection
+    estimates = chromosomeEstimates(pending)
+    order = snpschedule.largestFirst(pending, estimates)
+
+    # fork, so that the workers inherit fxnLookup from initialize()
+    pool = None
+    if WORKERS > 1:
+        pool = multiprocessing.get_context('fork').Pool(WORKERS)
+
+    try:
+        #
+        # 1 job per tile (see chromosomeTiles) or, if not tiling, per chromosome
+        #
+        jobs = []
+        jobEstimates = {}
+        jobNames = {}
+        if TILE_SNPS > 0:
+            if pool is None:
+                chrTiles = dict(zip(order, map(tileWorker, order)))
+            else:
+                chrTiles = dict(zip(order, pool.map(tileWorker, order, 1)))
+            shares = {}
+            for chr in chromosomes:
+                if chr not in chrTiles:
+                    jobs.append((chr, None))
+                    continue
+                for tile in chrTiles[chr]:
+                    jobs.append((chr, tile))
+                    jobNames[(chr, tile)] = '%s.%s' % (chr, tile[0])
+                    shares[jobNames[(chr, tile)]] = estimates[chr] / len(chrTiles[chr])
+            tileEstimates = snpschedule.estimate(list(shares.keys()), shares, \
+                snpschedule.readRuntimes(RUNTIME_FILE))
+            for job in jobNames:
+                jobEstimates[job] = tileEstimates[jobNames[job]]
+            print('parallelProcess(): %s tiles' % (len(jobNames)))
+            sys.stdout.flush()
+        else:
+            for chr in chromosomes:
+                jobs.append((chr, None))
+                jobNames[(chr, None)] = chr
+                if chr in estimates:
+                    jobEstimates[(chr, None)] = estimates[chr]
+
+        todo = [job for job in jobs if job not in completed]
+        if completed:
+            print('parallelProcess(): checkpoint: %s of %s jobs completed' % (len(jobs) - len(todo), len(jobs)))
+
+        # largest first: a worker takes the next job as soon as it is free
+        schedule = snpschedule.largestFirst(todo, jobEstimates)
+        snpschedule.printSchedule('parallelProcess()', [jobNames[job] for job in schedule], \
+            dict([(jobNames[job], jobEstimates[job]) for job in todo]))
+        if pool is None:
+            results = map(processWorker, schedule)
+        else:
+            results = pool.imap_unordered(processWorker, schedule, 1)
+        counts = dict(completed)
+        jobRecords = {}
+        for job, count, record in results:
+            counts[job] = count
+            jobRecords[job] = record
+            if checkpoint:
+                writeCheckpoint(job, count, fingerprints[job[0]])
+        if TILE_SNPS > 0:
+            snpschedule.saveRuntimes(RUNTIME_FILE, \
+                dict([(jobNames[job], jobRecords[job]['wall']) for job in todo if job[1] is not None]))
+
+        # the rows of each chromosome get consecutive keys, tile by tile
+        tileOffsets = {}
+        tileRecords = {}
+        ranges = {}
+        offset = firstKey - 1
+        for chr, tile in jobs:
+            count = counts[(chr, tile)]
+            if chr not in ranges:
+                ranges[chr] = (offset + 1, offset)
+                tileOffsets[chr] = []
+                tileRecords[chr] = []
+            ranges[chr] = (ranges[chr][0], offset + count)
+            tileOffsets[chr].append((tile[0] if tile else 0, offset))
+            if (chr, tile) in jobRecords:
+                tileRecords[chr].append(jobRecords[(chr, tile)])
+            offset = offset + count
+        for chr in chromosomes:
+            print('parallelProcess(): chromosome: %s rows: %s first key: %s' \
+                % (chr, ranges[chr][1] - ranges[chr][0] + 1, ranges[chr][0]))
+        sys.stdout.flush()
+        primaryKey = offset + 1
+
+        renumberJobs = [(chr, tileOffsets[chr], not checkpoint) for chr in chromosomes]
+        if pool is None:
+            times = dict(zip(chromosomes, map(renumberWorker, renumberJobs)))
+        else:
+            times = dict(zip(chromosomes, pool.map(renumberWorker, renumberJobs, 1)))
+        if checkpoint:
+            # + those of other tiles (of an earlier run) or of a failed job
+            for chr in chromosomes:
+                for tmpFile in glob.glob(tmpFileName(chr)) + glob.glob(tmpFileName(chr) + '.*'):
+                    os.remove(tmpFile)
+
+        records = []
+        for chr in chromosomes:
+            if not tileRecords[chr]:
+                continue
+            record = mergeMetrics(tileRecords[chr])
+            wall, cpu = times[chr]
+            record['phases']['renumber'] = {'wall' : round(wall, 3), 'cpu' : round(cpu, 3)}
+            record['wall'] = round(record['wall'] + wall, 3)
+            record['cpu'] = round(record['cpu'] + cpu, 3)
+            record['pairsPerSec'] = round(record['pairs'] / max(record['wall'], 0.001), 1)
+            records.append(record)
+    except Exception as e:
+        sys.stderr.write('parallelProcess(): failed: %s\n' % (e))
+        if pool is not None:
+            pool.terminate()
+        sys.exit(1)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return ranges, records
+
+# Purpose: Estimate the cost (seconds) of each chromosome for the parallel
+#          schedule: its runtime in RUNTIME_FILE or, for the chromosomes
+#          without one, the number of rows it reads (SNPs + markers + Alliance
+#          TSV rows) scaled by the others (see snpschedule.estimate)
+#          The statistics are only queried if a chromosome has no runtime.
+# Returns: dictionary chromosome -> estimate
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws:  Nothing
+
+def chromosomeEstimates(chromosomes):
+
+    runtimes = snpschedule.readRuntimes(RUNTIME_FILE)
+    if not [chr for chr in chromosomes if chr not in runtimes]:
+        return snpschedule.estimate(chromosomes, {}, runtimes)
+
+    stats = snpschedule.chromosomeStats()
+
+    costs = {}
+    for chr in chromosomes:
+        allianceFile = os.environ['SNP_ALLIANCE_TSV'] + '.' + str(chr) + '.tsv'
+        costs[chr] = stats.get(chr, {}).get('snps', 0) + stats.get(chr, {}).get('markers', 0) \
+            + snpschedule.fileSize(allianceFile) // ALLIANCE_ROW_BYTES
+
+    return snpschedule.estimate(chromosomes, costs, runtimes)
+
+# Purpose: Worker process: create the (temporary) bcp file for one chromosome
+#          or, if tile is not None, for one tile (tile, startCoord, endCoord) of it
+# Returns: job, number of rows written to the bcp file, metrics of the chromosome/tile
+#          (the job, as the results are returned in the order the jobs finish)
+# Assumes: Nothing
+# Effects: Queries a database, Outputs to BCP file
+# Throws:  RuntimeError if the chromosome could not be processed
+
+def processWorker(job):
+    global primaryKey
+
+    chr, tile = job
+    primaryKey = 1
+
+    db.useOneConnection(1)
+    try:
+        if tile is None:
+            record = processChromosome(chr, tmpFileName(chr))
+        else:
+            record = processChromosome(chr, tmpFileName(chr, tile[0]), 0, [tile])
+    except SystemExit:
+        # sys.exit() would kill the worker & leave the pool waiting forever
+        raise RuntimeError('chromosome %s failed' % (chr))
+    finally:
+        db.useOneConnection(0)
+
+    return job, primaryKey - 1, record
+
+# Purpose: Merge the metrics of the tiles of a chromosome (processed by
+#          different workers): times & counts are added, peak RSS is the max
+# Returns: metrics of the chromosome (see ChromosomeMetrics)
+# Assumes: records is not empty
+# Effects: Nothing
+# Throws:  Nothing
+
+def mergeMetrics(records):
+
+    if len(records) == 1:
+        return records[0]
+
+    merged = dict(records[0])
+    merged['phases'] = {}
+    for name in ('wall', 'cpu', 'snps', 'markers', 'pairs', 'bytes', 'tiles'):
+        values = [r[name] for r in records if r.get(name) is not None]
+        merged[name] = sum(values) if values else None
+    merged['wall'] = round(merged['wall'], 3)
+    merged['cpu'] = round(merged['cpu'], 3)
+    merged['peakRssKb'] = max([r['peakRssKb'] for r in records])
+    merged['pairsPerSec'] = round(merged['pairs'] / max(merged['wall'], 0.001), 1)
+    for r in records:
+        for phase, t in r['phases'].items():
+            total = merged['phases'].setdefault(phase, {'wall' : 0.0, 'cpu' : 0.0})
+            total['wall'] = round(total['wall'] + t['wall'], 3)
+            total['cpu'] = round(total['cpu'] + t['cpu'], 3)
+
+    return merged
+
+# Purpose: Copy the temporary bcp files of the tiles of one chromosome (in
+#          tile order) into its final bcp file (or, if DIRECT_LOAD, into
+#          LOAD_TABLE), adding the offset of the tile to each primaryKey.
+#          If remove, the temporary bcp files are removed once copied.
+# Returns: wall & CPU seconds of the copy
+# Assumes: the first column of each row is the primaryKey
+#          tileOffsets: list of (tile, offset); tile 0 = the whole chromosome
+# Effects: Outputs to BCP file, removes the temporary bcp files
+# Throws:  Nothing
+
+def renumberBCPFile(chr, tileOffsets, remove = 1):
+
+    startTime = time.time()
+    startCpu = time.process_time()
+
+    fpOut = BCPWriter(bcpFileName(chr), DIRECT_LOAD)
+    for tile, offset in tileOffsets:
+        tmpFile = tmpFileName(chr, tile)
+        with open(tmpFile, 'r') as fpIn:
+            for line in fpIn:
+                idx = line.index('|')
+                fpOut.write(str(int(line[:idx]) + offset) + line[idx:])
+        if remove:
+            os.remove(tmpFile)
+    fpOut.close()
+
+    return time.time() - startTime, time.process_time() - startCpu
+
+# Purpose: Worker process: renumberBCPFile(chr, tileOffsets, remove)
+# Returns: see renumberBCPFile
+# Assumes: job: (chr, tileOffsets, remove)
+# Effects: see renumberBCPFile
+# Throws:  Nothing
+
+def renumberWorker(job):
+
+    return renumberBCPFile(*job)
+
+# Purpose: Process all SNPs within the startCoord-endCoord range on the given
+#	   chr - by using binary search to find sub-regions to process at a time
+#	   "Process" means: Create a bcp file with annotations for SNP/marker
+#	   pairs where the SNP is within 2 kb of the marker and there is no existing annotation for the SNP/marker.
+#	   tile: the number of the range (see chromosomeTiles), 0 = the whole chromosome
+# Returns: Nothing
+# Assumes: startCoord and endCoord are integers
+# Effects: Outputs to BCP file represented by fpSnpBCP
+# Throws:  Nothing
+
+def binProcess(chr, startCoord, endCoord, tile = 0):
+    global SNPlist
+
+    if ENGINE == 'sql' or chr in SQL_CHROMOSOMES:
+        sqlProcess(fpSnpBCP, chr, startCoord, endCoord)
+        return
+
+    if SNAPSHOT:
+        SNPlist = snapshotSNPs(chr, startCoord, endCoord, tile)
+        processSNPregion(fpSnpBCP, chr, startCoord, endCoord)
+        SNPlist = SNPTable()
+        return
+
+    if FETCH_SIZE > 0:
+        streamProcess(fpSnpBCP, chr, startCoord, endCoord)
+        return
+
+    print('binProcess(): SNPlist query start time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
+    sys.stdout.flush()
+
+    # query to fill SNPlist
+    SNPlist = SNPTable()
+    declareSNPCursor(chr, startCoord, endCoord)
+    while fetchSNPs(SNPlist, MAX_QUERY_BATCH) == MAX_QUERY_BATCH:
+        pass
+    closeSNPCursor()
+
+    print('binProcess(): total snp coordinates between coord %s and %s is %s' % (startCoord, endCoord, str(len(SNPlist))))
+    print('binProcess(): SNPlist query end time: %s' % time.strftime("%H.%M.%S.%m.%d.%y",  time.localtime(time.time())))
+    sys.stdout.flush()
+    processSNPregion(fpSnpBCP, chr, startCoord, endCoord)
+
+# Purpose: Return the SNPs within the startCoord-endCoord range on the given chr
+#          from the snapshot file of the chr (SNAPSHOT_FILE.<chr>, or of the tile:
+#          SNAPSHOT_FILE.<chr>.<tile>), memory-mapped.
+#          If the snapshot is missing or out of date (its validation does not
+#          match snpChecksum()), it is re-created first from the SNP cursor,
+#          FETCH_SIZE (or MAX_QUERY_BATCH) SNPs at a time.
+# Returns: SNPTable, ordered by coordinate
+# Assumes: the current process is using one connection (db.useOneConnection)
+# Effects: Queries a database, Reads/writes the snapshot file
+# Throws:  Nothing
+
+def snapshotSNPs(chr, startCoord, endCoord, tile = 0):
+
+    fileName = snapshotFileName(chr, tile)
+    startPhase('snps')
+    validation = snpChecksum(chr, startCoord, endCoord)
+
+    snps = mapSNPSnapshot(fileName, validation)
+    if snps is not None:
+        stopPhase()
+        countRows('snps', len(snps))
+        print('binProcess(): mapped SNP snapshot: %s: %s SNPs' % (fileName, len(snps)))
+        sys.stdout.flush()
+        return snps
+
+    print('binProcess(): SNP snapshot missing or out of date; re-create %s' % (fileName))
+    print('binProcess(): SNPlist query start time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
+    sys.stdout.flush()
+
+    batch = FETCH_SIZE or MAX_QUERY_BATCH
+    writer = SNPSnapshotWriter(fileName)
+    declareSNPCursor(chr, startCoord, endCoord)
+    while 1:
+        snps = SNPTable()
+        count = fetchSNPs(snps, batch)
+        writer.add(snps)
+        if count < batch:
+            break
+    closeSNPCursor()
+    writer.close(validation)
+    stopPhase()
 
-# file pointer for the bcp file
-fpSnpBCP = None
-# file pointer for the alliance file
-fpSnpAlliance = None
+    print('binProcess(): total snp coordinates between coord %s and %s is %s' % (startCoord, endCoord, writer.n))
+    print('binProcess(): SNPlist query end time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
+    sys.stdout.flush()
 
-# lookup to resolve function class string to key
-fxnLookup = {}
-# Alliance Lookup
-allianceLookup = {}
+    return mapSNPSnapshot(fileName, validation)
 
-# list of chromosomes to process
-chrList = [
-'1','2','3','4','5','6','7','8','9','10',
-'11','12','13','14','15','16','17','18','19',
-'X','Y','MT'
-]
+# Purpose: Return the name of the SNP snapshot of a chr (tile 0) or of one of its tiles
+# Returns: SNAPSHOT_FILE.<chr> or SNAPSHOT_FILE.<chr>.<tile>
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
 
-# next available _SNP_ConsensusSnp_Marker_key
-primaryKey = 1
+def snapshotFileName(chr, tile = 0):
 
-# Purpose: Perform initialization for the script.
-# Returns: Nothing
+    if tile:
+        return SNAPSHOT_FILE + '.' + str(chr) + '.' + str(tile)
+
+    return SNAPSHOT_FILE + '.' + str(chr)
+
+# Purpose: Compute the validation of the SNP snapshot of a chr range:
+#          ALLIANCE_KEYS, the range, and a checksum of SNP_Coord_Cache computed
+#          by the database (row count, min/max/sum of _Coord_Cache_key, max
+#          _ConsensusSnp_key, max/sum of startCoordinate), so no SNP is fetched.
+#          SNP_Coord_Cache gets new keys whenever dbSNP or the build is re-loaded;
+#          the coordinate sum also catches coordinates remapped in place.
+#          The SNP IDs are checksummed too (row count & sum of hashtext(accid)
+#          of the SNP_Accession rows of the range), so a SNP ID changed in
+#          place (or, if ALLIANCE_KEYS, added or removed: see snpQuery) also
+#          re-creates the snapshot.
+# Returns: tuple of integers
 # Assumes: Nothing
-# Effects: Queries databases
-# Throws: Nothing
+# Effects: Queries a database
+# Throws:  Nothing
 
-def initialize():
-    #
-    # The following globals will be initialized
-    #
-    global fxnLookup   # create lookup to resolve function class string to key
+def snpChecksum(chr, startCoord, endCoord):
 
-    print('initialize(): perform initialization')
-    sys.stdout.flush()
+    results = db.sql('''
+        select count(*) as snpcount,
+               coalesce(min(sc._Coord_Cache_key), 0) as mincoordcachekey,
+               coalesce(max(sc._Coord_Cache_key), 0) as maxcoordcachekey,
+               coalesce(sum(sc._Coord_Cache_key), 0) as sumcoordcachekey,
+               coalesce(max(sc._ConsensusSnp_key), 0) as maxsnpkey,
+               coalesce(max(sc.startCoordinate), 0) as maxcoord,
+               coalesce(sum(sc.startCoordinate), 0) as sumcoord
+        from SNP_Coord_Cache sc
+        where sc.chromosome = '%s' 
+        and sc.startCoordinate between %s and %s 
+        ''' % (chr, startCoord, endCoord), 'auto')
+    r = results[0]
 
-    #
-    #  Create a lookup for within* function class terms
-    #
     results = db.sql('''
-            select t._term_key, t.term 
-            from VOC_Term t 
-            where t._Vocab_key = 49
-            and t.term LIKE 'within % of' 
-            ''', 'auto')
-    for r in results:
-        fxnLookup[r['term']] = r['_term_key']
+        select count(*) as accidcount,
+               coalesce(sum(hashtext(a.accid)::bigint), 0) as accidsum
+        from SNP_Coord_Cache sc, SNP_Accession a
+        where sc.chromosome = '%s' 
+        and sc.startCoordinate between %s and %s 
+        and sc._consensussnp_key = a._object_key
+        and a._mgitype_key = 30
+        ''' % (chr, startCoord, endCoord), 'auto')
+    accidCount = int(results[0]['accidcount'])
+    accidSum = int(results[0]['accidsum'])
 
-    return
+    return (int(ALLIANCE_KEYS), int(startCoord), int(endCoord), int(r['snpcount']),
+        int(r['mincoordcachekey']), int(r['maxcoordcachekey']), int(r['sumcoordcachekey']),
+        int(r['maxsnpkey']), int(r['maxcoord']), int(r['sumcoord']), accidCount, accidSum)
 
-# Purpose: For each Chromosome, create a bcp file with annotations for SNP/marker pairs where the SNP is within 2 kb of the marker
-# Returns: Nothing
+# Purpose: Memory-map a SNP snapshot file (written by SNPSnapshotWriter)
+#
+#          header         : SNAPSHOT_MAGIC, N (number of SNPs), M (accid bytes), validation
+#          snpKeys        : N int64
+#          coordCacheKeys : N int64
+#          coords         : N int64
+#          allianceKeys   : N int64
+#          accidEnds      : N int64 (none if ALLIANCE_KEYS)
+#          accids         : M bytes
+#          (native byte order)
+#
+# Returns: SNPTable whose columns are views of the mapped file,
+#          or None if the file does not exist or its validation does not match
 # Assumes: Nothing
-# Effects: Queries a database, Outputs to BCP file represented by fpSnpBCP
+# Effects: Reads a file
 # Throws:  Nothing
 
-def process():
-    #
-    #  Process one chromosome at a time to break up the size of the results set.
-    #   Create one bcp file per chromosome
-    #
-    global snpAllianceFile  # get alliance input file
-    global fpSnpBCP
-    global fpSnpAlliance
-    global allianceLookup
-
-    for chr in chrList:
+def mapSNPSnapshot(fileName, validation):
 
-        print('\nprocess(): chromosome: %s' % (chr))
+    if not os.path.exists(fileName) or os.path.getsize(fileName) < struct.calcsize(SNAPSHOT_HEADER):
+        return None
 
-        try:
-            print('process(): create read/write files')
-            snpAllianceFile = os.environ['SNP_ALLIANCE_TSV'] + '.' + str(chr) + '.tsv'
-            fpSnpAlliance = open("%s" % (snpAllianceFile),'r')
-            snpFile = os.environ['CACHEDATADIR'] + '/' + os.environ['SNP_MRK_FILE'] + '.' + str(chr)
-            fpSnpBCP = open("%s" % (snpFile),'w')
-        except:
-            sys.stderr.write('Cannot Read SNP Alliance File: %s\n' % snpAllianceFile)
-            sys.stderr.write('Cannot Write SNP File: %s\n' % snpFile)
-            sys.exit(1)
-            
-        print('process(): create Alliance lookup')
-        allianceLookup = {}
-        for line in fpSnpAlliance:
-            tokens = line[:-1].split('|')
-            key = tokens[0] + ':' + tokens[1]
-            if key not in allianceLookup:
-                allianceLookup[key] = []
-            allianceLookup[key].append(tokens)
-        print('process(): Alliance lookup: ' + str(len(allianceLookup)))
-        #print(allianceLookup)
-
-        print('process(): query for max SNP coordinate')
-        results = db.sql('''
-                select max(startCoordinate) as maxCoord 
-                from SNP_Coord_Cache 
-                where chromosome = '%s' 
-                ''' % (chr), 'auto')
-        maxCoord = results[0]['maxCoord']
-        print('process(): max coord: %s' % (maxCoord))
-        sys.stdout.flush()
-        binProcess(chr, 1, maxCoord)
-        sys.stdout.flush()
+    with open(fileName, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+    header = struct.unpack_from(SNAPSHOT_HEADER, mm)
+    if header[0] != SNAPSHOT_MAGIC or tuple(header[3:]) != tuple(validation):
+        mm.close()
+        return None
+    n = header[1]
+    m = header[2]
 
-        fpSnpAlliance.close()
-        fpSnpBCP.close()
+    snps = SNPTable()
+    view = memoryview(mm)
+    pos = struct.calcsize(SNAPSHOT_HEADER)
+    snps.snpKeys = view[pos:pos + 8 * n].cast('q')
+    pos = pos + 8 * n
+    snps.coordCacheKeys = view[pos:pos + 8 * n].cast('q')
+    pos = pos + 8 * n
+    snps.coords = view[pos:pos + 8 * n].cast('q')
+    pos = pos + 8 * n
+    snps.allianceKeys = view[pos:pos + 8 * n].cast('q')
+    pos = pos + 8 * n
+    if not ALLIANCE_KEYS:
+        snps.accidEnds = view[pos:pos + 8 * n].cast('q')
+        pos = pos + 8 * n
+    snps.accids = view[pos:pos + m]
 
-    return
+    return snps
 
-# Purpose: Process all SNPs within the startCoord-endCoord range on the given
-#	   chr - by using binary search to find sub-regions to process at a time
-#	   "Process" means: Create a bcp file with annotations for SNP/marker
-#	   pairs where the SNP is within 2 kb of the marker and there is no existing annotation for the SNP/marker.
-# Returns: Nothing
-# Assumes: startCoord and endCoord are integers
-# Effects: Outputs to BCP file represented by fpSnpBCP
+# Purpose: Return the query for the SNPs within the startCoord-endCoord range on the given chr
+#          (unordered; see SNP_ORDER)
+#          If ALLIANCE_KEYS, the SNP ID (accid) is not needed and not queried;
+#          the SNPs without one are still left out (exists), but a SNP with
+#          several SNP IDs is returned once instead of once per SNP ID.
+# Returns: sql string
+# Assumes: Nothing
+# Effects: Nothing
 # Throws:  Nothing
 
-def binProcess(chr, startCoord, endCoord):
-    global SNPlist
+def snpQuery(chr, startCoord, endCoord):
 
-    print('binProcess(): SNPlist query start time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
-    sys.stdout.flush()
+    if ALLIANCE_KEYS:
+        return '''
+        select sc._ConsensusSnp_key, sc._Coord_Cache_key, sc.startCoordinate
+        from SNP_Coord_Cache sc
+        where sc.chromosome = '%s' 
+        and sc.startCoordinate between %s and %s 
+        and exists (select 1 from SNP_Accession a
+                    where sc._consensussnp_key = a._object_key
+                    and a._mgitype_key = 30)
+        ''' % (chr, startCoord, endCoord)
 
-    # query to fill SNPlist
-    SNPlist = db.sql('''
+    return '''
         select sc._ConsensusSnp_key, sc._Coord_Cache_key, sc.startCoordinate, a.accid
         from SNP_Coord_Cache sc, SNP_Accession a
         where sc.chromosome = '%s' 
         and sc.startCoordinate between %s and %s 
         and sc._consensussnp_key = a._object_key
         and a._mgitype_key = 30
-        order by sc.startCoordinate
-        ''' % (chr, startCoord, endCoord), 'auto')
+        ''' % (chr, startCoord, endCoord)
 
-    print('binProcess(): total snp coordinates between coord %s and %s is %s' % (startCoord, endCoord, str(len(SNPlist))))
-    print('binProcess(): SNPlist query end time: %s' % time.strftime("%H.%M.%S.%m.%d.%y",  time.localtime(time.time())))
+# Purpose: Open the server-side cursor snp_cursor on snpQuery()
+# Returns: Nothing
+# Assumes: the current process is using one connection (db.useOneConnection)
+#	   so that the cursor stays open between fetches
+# Effects: Queries a database
+# Throws:  Nothing
+
+def declareSNPCursor(chr, startCoord, endCoord):
+
+    startPhase('snps')
+    db.sql('declare snp_cursor no scroll cursor for %s %s' % (snpQuery(chr, startCoord, endCoord), SNP_ORDER), None)
+    stopPhase()
+
+    return
+
+# Purpose: Fetch the next (at most) n SNPs from snp_cursor into the SNPTable snps
+# Returns: number of SNPs fetched; < n once the cursor is exhausted
+# Assumes: declareSNPCursor() has been called
+# Effects: Queries a database
+# Throws:  Nothing
+
+def fetchSNPs(snps, n):
+
+    startPhase('snps')
+    results = db.sql('fetch forward %s from snp_cursor' % (n), 'auto')
+    snps.extend(results)
+    stopPhase()
+    countRows('snps', len(results))
+
+    return len(results)
+
+# Purpose: Close snp_cursor and end its transaction
+# Returns: Nothing
+# Assumes: declareSNPCursor() has been called
+# Effects: Queries a database
+# Throws:  Nothing
+
+def closeSNPCursor():
+
+    db.sql('close snp_cursor', None)
+    db.commit()
+
+    return
+
+# Purpose: Process all SNPs within the startCoord-endCoord range on the given chr
+#          without holding all of them in memory at once.
+#	   The SNPs are read in coordinate order through a server-side cursor,
+#	   FETCH_SIZE rows at a time, and the markers (also in coordinate order)
+#	   are merged against them: SNPlist only holds the window of SNPs that the
+#	   current and following markers can still reach.
+#	   Writes the same bcp rows as binProcess()/processSNPregion().
+# Returns: Nothing
+# Assumes: the current process is using one connection (db.useOneConnection)
+#	   so that the cursor stays open between fetches
+# Effects: Queries a database, Outputs to BCP file
+# Throws:  Nothing
+
+def streamProcess(fp, chr, startCoord, endCoord):
+    global SNPlist
+
+    Markers = queryMarkers(chr, startCoord, endCoord)
+
+    print('streamProcess(): process SNP cursor start time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
+    sys.stdout.flush()
+
+    declareSNPCursor(chr, startCoord, endCoord)
+    startPhase('join')
+
+    SNPlist = SNPTable()
+    totalSnps = 0
+    exhausted = 0
+
+    for marker in Markers:
+        leftmostCoord = marker['markerStart']-MARKER_PAD
+        rightmostCoord = marker['markerEnd']+MARKER_PAD
+
+        # markers are ordered by markerStart, so SNPs left of this marker
+        # cannot be reached by any of the markers that follow.
+        # (the table is compacted once a fetch worth of them has built up)
+        firstIdx = bisect.bisect_left(SNPlist.coords, leftmostCoord)
+        if firstIdx >= FETCH_SIZE:
+            SNPlist.trim(firstIdx)
+
+        # read ahead until the window holds every SNP <= rightmostCoord
+        while not exhausted and (len(SNPlist) == 0 or SNPlist.coords[-1] <= rightmostCoord):
+            count = fetchSNPs(SNPlist, FETCH_SIZE)
+            if count < FETCH_SIZE:
+                exhausted = 1
+            totalSnps = totalSnps + count
+
+        firstIdx = bisect.bisect_left(SNPlist.coords, leftmostCoord)
+
+        if ENGINE == 'batch':
+            rows = joinMarker(SNPlist, marker, firstIdx)
+            if rows:
+                fp.write(''.join(rows))
+            continue
+
+        snpIdx = listBinarySearch(SNPlist.coords, rightmostCoord, firstIdx, len(SNPlist)-1)
+        markerAlliance = getMarkerAlliance(marker)
+        i = snpIdx
+        while (i >= firstIdx):
+            processSNPmarkerPair(fp, SNPlist, i, marker, markerAlliance)
+            i = i-1
+
+    stopPhase()
+    closeSNPCursor()
+    SNPlist = SNPTable()
+
+    print('streamProcess(): total snp coordinates fetched between coord %s and %s is %s' % (startCoord, endCoord, totalSnps))
+    print('streamProcess(): process SNP cursor end time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
     sys.stdout.flush()
-    processSNPregion(fpSnpBCP, chr, startCoord, endCoord)
+
+    return
 
 # Purpose: Process all SNPs within the startCoord-endCoord range on the given chromosome. 
 #	   "Process" means: Write to a bcp file annotations for SNP/marker pairs 
@@ -260,57 +2211,38 @@ def processSNPregion(fp, chr, startCoord, endCoord):
         # 
         # The Data Structures:
         #
-        # * SNPlist is the list of all Consensus_SNPs that lie in the coord
+        # * SNPlist is the SNPTable of all Consensus_SNPs that lie in the coord
         #	range - ORDERED BY SNP coord.
         # 	Each SNP on SNPlist is
-        #	(_ConsensusSnp_key, _Coord_Cache_key, startCoordinate)
+        #	(_ConsensusSnp_key, _Coord_Cache_key, startCoordinate, accid)
         #	- populated by SQL query
         #
         # * Markers is the list of all Markers (w/ coordinates) in MarkerRegion
         # 	Each Marker on Markers is
         #	(_Marker_key, markerStart, markerEnd, markerStrand)
         #	- populated by SQL query
-        #	- For now, order is unimportant. Could order by increasing
-        #	  endCoordinate, then as we process markers, we could
-        #	  increase the start coord of the binary search for SNPs.
+        #	- ordered by coordinate (then key) so that the bcp rows and
+        #	  their primaryKeys are the same from run to run, whether the
+        #	  chromosomes are processed serially or in parallel.
         #
 
-        print('processSNPregion(): marker query start time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
-        sys.stdout.flush()
-
-        # query to fill Markers
-        # exclude: withdrawn markers, marker type QTL and Cytogenetic, feature type heritable phenotypic
-        Markers = db.sql('''
-                select a.accid as markerId,
-                       mc._marker_key, 
-                       mc.startCoordinate as markerStart,
-                       mc.endCoordinate as markerEnd, 
-                       mc.strand as markerStrand 
-                from MRK_Location_Cache mc, MRK_Marker m, MRK_MCV_Cache mcv, ACC_Accession a
-                where mc._Marker_Type_key not in (3, 6) 
-                and mc._Organism_key = 1
-                and mc.genomicchromosome = '%s' 
-                and mc.endCoordinate >= %s 
-                and mc.startCoordinate <= %s
-                and mc._Marker_key = m._Marker_key
-                and m._Marker_Status_key = 1
-                and m._Marker_key = mcv._Marker_key
-                and mcv.qualifier = 'D'
-                and mcv._mcvTerm_key != 6238170
-                and mc._Marker_key = a._Object_key
-                and a._MGIType_key = 2
-                and a._LogicalDB_key = 1
-                and a.preferred = 1
-                ''' % (chr, startCoord-MARKER_PAD, endCoord+MARKER_PAD), 'auto')
-
-        print('processSNPregion(): marker query end time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
-        sys.stdout.flush()
+        Markers = queryMarkers(chr, startCoord, endCoord)
 
         #
         #  Process each SNP on SNPlist
         #
         print('processSNPregion(): process SNPlist start time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
         sys.stdout.flush()
+
+        startPhase('join')
+
+        if ENGINE == 'batch':
+            joinSNPregion(fp, SNPlist, Markers)
+            stopPhase()
+            print('processSNPregion(): process SNPlist end time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))	
+            sys.stdout.flush()
+            return
+
         idxLastSnp = len(SNPlist)-1	# index of last SNP in SNPlist
         prevSnpIdx = 0			    # index of SNP found on prev iteration (start binary search from there)
 
@@ -319,66 +2251,462 @@ def processSNPregion(fp, chr, startCoord, endCoord):
             markerEnd = marker['markerEnd']
 
             # use binary search to find the index in SNPlist of the farthest "right" SNP to consider for this marker
-            snpIdx = listBinarySearch(SNPlist, markerEnd+MARKER_PAD, prevSnpIdx, idxLastSnp)
+            snpIdx = listBinarySearch(SNPlist.coords, markerEnd+MARKER_PAD, prevSnpIdx, idxLastSnp)
 
             # iterate backward through the SNPs from snpIdx and process SNP-Marker pairs.
             # (deal w/ boundary condition, no SNP is within range?)
             i = snpIdx
             leftmostCoord = markerStart-MARKER_PAD
-            while (i >= 0 and SNPlist[i]['startCoordinate'] >= leftmostCoord):
-                processSNPmarkerPair(fp, SNPlist[i], marker)
+            markerAlliance = getMarkerAlliance(marker)
+            while (i >= 0 and SNPlist.coords[i] >= leftmostCoord):
+                processSNPmarkerPair(fp, SNPlist, i, marker, markerAlliance)
                 i = i-1
 
         # prevSnpIdx = snpIdx end SNP loop
+        stopPhase()
         print('processSNPregion(): process SNPlist end time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))	
         sys.stdout.flush()
         return
 
 
+# Purpose: Batch join engine: write the bcp rows for every SNP-marker pair
+#	   within MARKER_PAD of each other, one marker (block of rows) at a time
+#	   (see joinMarker).
+#	   Writes the same rows, in the same order, as processSNPregion()'s
+#	   processSNPmarkerPair() loop.
+# Returns: Nothing
+# Assumes: snps and Markers are ordered by coordinate
+# Effects: Outputs to BCP file
+# Throws: Nothing
+
+def joinSNPregion(fp, snps, Markers):
+
+    for marker in Markers:
+        rows = joinMarker(snps, marker, 0)
+        if rows:
+            fp.write(''.join(rows))
+
+    return
+
+# Purpose: Compute the bcp rows for one marker and all of the SNPs in snps within MARKER_PAD of it.
+#
+#	   The SNPs within reach of the marker are a contiguous range of snps,
+#	   found by binary search on markerStart-MARKER_PAD & markerEnd+MARKER_PAD.
+#	   That range splits (again by binary search) into 3 sub-ranges:
+#
+#	   . left   : SNP < markerStart, so SNP <= the marker midpoint
+#	   . within : markerStart <= SNP <= markerEnd
+#	   . right  : SNP > markerEnd, so SNP > the marker midpoint
+#
+#	   so the fxn class and direction are the same for a whole sub-range
+#	   (snpdirection.STRAND_DIRECTIONS) and only the distance varies by SNP.
+#	   Alliance rows still take precedence over within/distance rows.
+#
+#	   Rows are returned in descending SNP order, like processSNPregion()
+#	   and primaryKeys are assigned in that order.
+# Returns: list of bcp rows
+# Assumes: snps is ordered by coordinate
+# Effects: Nothing
+# Throws: Nothing
+
+def joinMarker(snps,      # SNPTable
+               marker,    # dictionary as returned by queryMarkers()
+               bottomIdx):# lowest index in snps to search
+
+    global primaryKey
+
+    markerKey = marker['_marker_key']
+    markerStart = marker['markerStart']
+    markerEnd = marker['markerEnd']
+    markerStrand = marker['markerStrand']
+    coords = snps.coords
+    snpKeys = snps.snpKeys
+    coordCacheKeys = snps.coordCacheKeys
+    allianceKeys = snps.allianceKeys
+
+    lo = bisect.bisect_left(coords, markerStart-MARKER_PAD, bottomIdx)
+    hi = bisect.bisect_right(coords, markerEnd+MARKER_PAD, lo)
+    if lo == hi:
+        return []
+
+    if markerStart <= markerEnd:
+        loWithin = bisect.bisect_left(coords, markerStart, lo, hi)
+        hiWithin = bisect.bisect_right(coords, markerEnd, loWithin, hi)
+    else:
+        # no SNP is within the marker; split at the midpoint as getKBTerm() does
+        loWithin = hiWithin = bisect.bisect_right(coords, (markerStart + markerEnd) / 2.0, lo, hi)
+
+    withinKey = fxnLookup[WITHIN_COORD_TERM]
+    kbKey = fxnLookup[WITHIN_KB_TERM]
+    leftDirection, rightDirection = snpdirection.STRAND_DIRECTIONS.get(markerStrand, snpdirection.UNCLASSIFIED)
+    markerAlliance = getMarkerAlliance(marker)
+
+    #
+    # no Alliance rows for this marker: build each sub-range in one pass
+    #
+    if markerAlliance is None and leftDirection is not None:
+        pk = primaryKey
+        rows = [snpWrite % (pk + n, snpKeys[i], markerKey, kbKey, coordCacheKeys[i], coords[i] - markerEnd, rightDirection)
+                for n, i in enumerate(range(hi-1, hiWithin-1, -1))]
+        pk = pk + len(rows)
+        rows.extend([snpWrite % (pk + n, snpKeys[i], markerKey, withinKey, coordCacheKeys[i], 0, 'not applicable')
+                for n, i in enumerate(range(hiWithin-1, loWithin-1, -1))])
+        pk = primaryKey + len(rows)
+        rows.extend([snpWrite % (pk + n, snpKeys[i], markerKey, kbKey, coordCacheKeys[i], markerStart - coords[i], leftDirection)
+                for n, i in enumerate(range(loWithin-1, lo-1, -1))])
+        primaryKey = primaryKey + len(rows)
+        return rows
+
+    #
+    # otherwise check each SNP against the Alliance rows for this marker
+    #
+    rows = []
+    pk = primaryKey
+    for i in range(hi-1, lo-1, -1):
+        if markerAlliance is not None:
+            fxnKeys = markerAlliance.get(allianceKeys[i])
+            if fxnKeys is not None:
+                for fxnKey in fxnKeys:
+                    rows.append(snpWrite % (pk, snpKeys[i], markerKey, fxnKey, coordCacheKeys[i], 0, 'not applicable'))
+                    pk = pk + 1
+                continue
+
+        if i >= hiWithin:
+            direction = rightDirection
+            distance = coords[i] - markerEnd
+        elif i >= loWithin:
+            rows.append(snpWrite % (pk, snpKeys[i], markerKey, withinKey, coordCacheKeys[i], 0, 'not applicable'))
+            pk = pk + 1
+            continue
+        else:
+            direction = leftDirection
+            distance = markerStart - coords[i]
+
+        if direction is None:
+            print(SNP_NOT_WITHIN % (str(snps.row(i)), MARKER_PAD, marker, coords[i], markerStart, markerEnd))
+            continue
+
+        rows.append(snpWrite % (pk, snpKeys[i], markerKey, kbKey, coordCacheKeys[i], distance, direction))
+        pk = pk + 1
+
+    primaryKey = pk
+
+    return rows
+
+# Purpose: SQL engine: compute the SNP-marker pairs of the startCoord-endCoord
+#          range on the given chr with one set-based query (see pairQuery):
+#          the markers range-joined to the SNPs within MARKER_PAD of them,
+#          left-joined to the Alliance rows (ALLIANCE_TMP_TABLE), with the
+#          within/kb classification of processSNPmarkerPair()/getKBTerm()
+#          done, and the bcp row formatted, by the database.
+#          The rows are fetched from a server-side cursor in the order the pair
+#          engine writes them and only get their primaryKeys here (rows are
+#          written a fetch at a time), so the bcp file is the same as the
+#          other engines'.  (The db module only wraps COPY FROM, so the rows
+#          cannot be read with COPY (...) TO STDOUT.)
+# Returns: Nothing
+# Assumes: the current process is using one connection (db.useOneConnection);
+#          createAllianceLookup() has been called
+# Effects: Queries a database, Outputs to BCP file
+# Throws:  Nothing
+
+def sqlProcess(fp, chr, startCoord, endCoord):
+    global primaryKey
+
+    print('sqlProcess(): pair query start time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
+    sys.stdout.flush()
+
+    startPhase('alliance')
+    loadAllianceTable()
+    stopPhase()
+
+    startPhase('join')
+    batch = FETCH_SIZE or MAX_QUERY_BATCH
+    total = 0
+    db.sql('declare pair_cursor no scroll cursor for %s' % (pairQuery(chr, startCoord, endCoord)), None)
+    while 1:
+        results = db.sql('fetch forward %s from pair_cursor' % (batch), 'auto')
+        rows = []
+        for r in results:
+            if r['line'] is None:
+                print(SNP_NOT_WITHIN % (str((r['_consensussnp_key'], r['_coord_cache_key'], r['snpLoc'])), \
+                    MARKER_PAD, r['_marker_key'], r['snpLoc'], r['markerStart'], r['markerEnd']))
+                continue
+            rows.append(str(primaryKey) + r['line'])
+            primaryKey = primaryKey + 1
+        if rows:
+            fp.write(''.join(rows))
+        total = total + len(results)
+        if len(results) < batch:
+            break
+    db.sql('close pair_cursor', None)
+    db.commit()
+    stopPhase()
+
+    print('sqlProcess(): total SNP-marker pairs between coord %s and %s is %s' % (startCoord, endCoord, total))
+    print('sqlProcess(): pair query end time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
+    sys.stdout.flush()
+
+    return
+
+# Purpose: Return the SNP-marker pair query of the sql engine (see sqlProcess)
+#          One row per pair (per Alliance fxn key if the pair has Alliance rows),
+#          with its bcp row without the primaryKey (line: "|snpKey|...|\n", as
+#          snpWrite); line is null if getKBTerm() would not classify the pair
+#          (unknown strand).
+#          Ordered as the pair engine writes them: markers in MARKER_ORDER,
+#          then their SNPs from right to left, then the Alliance rows in TSV order.
+# Returns: sql string
+# Assumes: ALLIANCE_TMP_TABLE has been loaded
+# Effects: Nothing
+# Throws:  Nothing
+
+def pairQuery(chr, startCoord, endCoord):
+
+    if ALLIANCE_KEYS:
+        allianceJoin = 'a.markerKey = m._marker_key and a.snpKey = s._ConsensusSnp_key'
+    else:
+        allianceJoin = 'a.markerKey = m.markerId and a.snpKey = s.accid'
+
+    within = 's.startCoordinate >= m.markerStart and s.startCoordinate <= m.markerEnd'
+    left = snpdirection.sqlLeft('s.startCoordinate', 'm.markerStart', 'm.markerEnd')
+    direction = snpdirection.sqlDirection('s.startCoordinate', 'm.markerStart', 'm.markerEnd', 'm.markerStrand')
+
+    return '''
+        select q._ConsensusSnp_key, q._Coord_Cache_key, q.snpLoc,
+               q._marker_key, q.markerStart, q.markerEnd,
+               '|' || q._ConsensusSnp_key || '|' || q._marker_key || '|' || q._term_key
+                   || '|' || q._Coord_Cache_key || '|||||' || trunc(q.distance)::bigint
+                   || '|' || q.direction || E'|\\n' as line
+        from (
+        select s._ConsensusSnp_key, s._Coord_Cache_key, s.startCoordinate as snpLoc,
+               m._marker_key, m.markerStart, m.markerEnd, a.seq,
+               case when a._Term_key is not null then a._Term_key
+                    when %s then %s
+                    else %s
+               end as _term_key,
+               case when a._Term_key is not null or (%s) then 'not applicable'
+                    else %s
+               end as direction,
+               case when a._Term_key is not null or (%s) then 0
+                    when %s then m.markerStart - s.startCoordinate
+                    else s.startCoordinate - m.markerEnd
+               end as distance
+        from (%s) m
+        join (%s) s on s.startCoordinate between m.markerStart - %s and m.markerEnd + %s
+        left join %s a on %s
+        ) q
+        order by q.markerStart, q.markerEnd, q._marker_key,
+                 q.snpLoc desc, q._Coord_Cache_key desc, q.seq
+        ''' % (within, fxnLookup[WITHIN_COORD_TERM], fxnLookup[WITHIN_KB_TERM],
+               within, direction, within, left,
+               markerQuery(chr, startCoord, endCoord), snpQuery(chr, startCoord, endCoord),
+               MARKER_PAD, MARKER_PAD, ALLIANCE_TMP_TABLE, allianceJoin)
+
+# Purpose: Load the Alliance rows of the chromosome (allianceMarkerLookup)
+#          into the temp table ALLIANCE_TMP_TABLE, for the sql engine:
+#          markerKey, snpKey : MGI ID, SNP ID (or, if ALLIANCE_KEYS, _Marker_key,
+#                              _ConsensusSnp_key)
+#          _Term_key, seq    : fxn key, order of the row in the Alliance TSV
+# Returns: Nothing
+# Assumes: the current process is using one connection (db.useOneConnection);
+#          createAllianceLookup() has been called
+# Effects: Creates & loads a temp table, unless it was already loaded with
+#          the rows of allianceLookupFile on this connection
+# Throws:  Nothing
+
+def loadAllianceTable():
+    global allianceTableFile
+
+    # the tiles of a chromosome (on the same connection) use the same rows
+    if allianceTableFile == allianceLookupFile:
+        results = db.sql("select to_regclass('pg_temp.%s') is not null as loaded" % (ALLIANCE_TMP_TABLE), 'auto')
+        if results[0]['loaded']:
+            return
+
+    if ALLIANCE_KEYS:
+        keyType = 'int'
+        rowFormat = '%s|%s|%s|%s\n'
+    else:
+        keyType = 'text'
+        rowFormat = 'MGI:%s|rs%s|%s|%s\n'
+
+    db.sql('drop table if exists %s' % (ALLIANCE_TMP_TABLE), None)
+    db.sql('''
+        create temporary table %s
+        (markerKey %s not null,
+         snpKey %s not null,
+         _Term_key int not null,
+         seq int not null
+        )
+        ''' % (ALLIANCE_TMP_TABLE, keyType, keyType), None)
+
+    fp = io.StringIO()
+    seq = 0
+    for markerNumber, snpNumber, fxnKey in allianceRows():
+        fp.write(rowFormat % (markerNumber, snpNumber, fxnKey, seq))
+        seq = seq + 1
+    fp.seek(0)
+
+    db.executeCopyFrom(fp, ALLIANCE_TMP_TABLE, '|')
+    db.sql('create index idx_%s on %s (markerKey, snpKey)' % (ALLIANCE_TMP_TABLE, ALLIANCE_TMP_TABLE), None)
+    db.sql('analyze %s' % (ALLIANCE_TMP_TABLE), None)
+    db.commit()
+
+    allianceTableFile = allianceLookupFile
+    print('sqlProcess(): %s Alliance rows' % (seq))
+
+    return
+
+# Purpose: Iterate over the rows of allianceMarkerLookup
+# Returns: generator of (marker number, SNP number, fxnKey), in TSV order
+#          for each marker/SNP
+# Assumes: createAllianceLookup() has been called
+# Effects: Nothing
+# Throws:  Nothing
+
+def allianceRows():
+
+    if isinstance(allianceMarkerLookup, AllianceIndexMarkers):
+        index = allianceMarkerLookup.index
+        for i in range(len(index)):
+            key = index.keys[i]
+            for fxnKey in index.fxnKeys[index.offsets[i]:index.offsets[i + 1]]:
+                yield (key >> 32, key & 0xffffffff, fxnKey)
+        return
+
+    for markerNumber in allianceMarkerLookup:
+        markerAlliance = allianceMarkerLookup[markerNumber]
+        for snpNumber in markerAlliance:
+            for fxnKey in markerAlliance[snpNumber]:
+                yield (markerNumber, snpNumber, fxnKey)
+
+# Purpose: Query for the markers that are within MARKER_PAD of the startCoord-endCoord range on the given chr
+# Returns: list of marker dictionaries, ordered by coordinate
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws: Nothing
+
+def queryMarkers(chr, startCoord, endCoord):
+
+    print('queryMarkers(): marker query start time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
+    sys.stdout.flush()
+
+    # query to fill Markers
+    startPhase('markers')
+    Markers = db.sql('%s %s' % (markerQuery(chr, startCoord, endCoord), MARKER_ORDER), 'auto')
+    stopPhase()
+    countRows('markers', len(Markers))
+
+    print('queryMarkers(): marker query end time: %s' % time.strftime("%H.%M.%S.%m.%d.%y", time.localtime(time.time())))
+    sys.stdout.flush()
+
+    return Markers
+
+# Purpose: Return the query for the markers within MARKER_PAD BP of the
+#          startCoord-endCoord range on the given chr (unordered; see MARKER_ORDER)
+#          exclude: withdrawn markers, marker type QTL and Cytogenetic, feature type heritable phenotypic
+#          If ALLIANCE_KEYS, the MGI ID (markerId) is not needed and not queried;
+#          the markers without a preferred MGI ID are still left out (exists;
+#          a marker has at most 1, so the markers are the same).
+# Returns: sql string
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def markerQuery(chr, startCoord, endCoord):
+
+    if ALLIANCE_KEYS:
+        return '''
+        select mc._marker_key, 
+               mc.startCoordinate as markerStart,
+               mc.endCoordinate as markerEnd, 
+               mc.strand as markerStrand 
+        from MRK_Location_Cache mc, MRK_Marker m, MRK_MCV_Cache mcv
+        where mc._Marker_Type_key not in (3, 6) 
+        and mc._Organism_key = 1
+        and mc.genomicchromosome = '%s' 
+        and mc.endCoordinate >= %s 
+        and mc.startCoordinate <= %s
+        and mc._Marker_key = m._Marker_key
+        and m._Marker_Status_key = 1
+        and m._Marker_key = mcv._Marker_key
+        and mcv.qualifier = 'D'
+        and mcv._mcvTerm_key != 6238170
+        and exists (select 1 from ACC_Accession a
+                    where mc._Marker_key = a._Object_key
+                    and a._MGIType_key = 2
+                    and a._LogicalDB_key = 1
+                    and a.preferred = 1)
+        ''' % (chr, startCoord-MARKER_PAD, endCoord+MARKER_PAD)
+
+    return '''
+        select a.accid as markerId,
+               mc._marker_key, 
+               mc.startCoordinate as markerStart,
+               mc.endCoordinate as markerEnd, 
+               mc.strand as markerStrand 
+        from MRK_Location_Cache mc, MRK_Marker m, MRK_MCV_Cache mcv, ACC_Accession a
+        where mc._Marker_Type_key not in (3, 6) 
+        and mc._Organism_key = 1
+        and mc.genomicchromosome = '%s' 
+        and mc.endCoordinate >= %s 
+        and mc.startCoordinate <= %s
+        and mc._Marker_key = m._Marker_key
+        and m._Marker_Status_key = 1
+        and m._Marker_key = mcv._Marker_key
+        and mcv.qualifier = 'D'
+        and mcv._mcvTerm_key != 6238170
+        and mc._Marker_key = a._Object_key
+        and a._MGIType_key = 2
+        and a._LogicalDB_key = 1
+        and a.preferred = 1
+        ''' % (chr, startCoord-MARKER_PAD, endCoord+MARKER_PAD)
+
 # Purpose: Process a SNP-marker pair where the SNP and marker are within
 #	   MARKER_PAD BP of each other.
 #	   "Process" means: compute the appropriate fxn class for the
 #	   for the relationship and output the record representing the
 #	   relationship to the BCP file.
 # Returns: Nothing
-# Assumes: fp is an open filepointer to the BCP file.
+# Assumes: fp is an open BCPWriter
 # Effects: Outputs to BCP file
 # Throws: Nothing
 
-def processSNPmarkerPair(fp,      # file pointer of output file
-                         snp,	  # dictionary w/ keys as above
-                         marker): # dictionary w/ keys as above
+def processSNPmarkerPair(fp,      # BCPWriter of output file
+                         snps,	  # SNPTable
+                         snpIdx,  # index of the SNP in snps
+                         marker,  # dictionary w/ keys as above
+                         markerAlliance): # allianceMarkerLookup of the marker (or None)
 
     # next available _SNP_ConsensusSnp_Marker_key
     global primaryKey
 
-    markerId = marker['markerId']
     markerKey = marker['_marker_key']
     markerStart = marker['markerStart']
     markerEnd = marker['markerEnd']
     markerStrand = marker['markerStrand']
-    snpLoc = snp['startCoordinate']
-    snpKey = snp['_consensussnp_key']
-    coordCacheKey = snp['_coord_cache_key']
-    snpId = snp['accid']
+    snpLoc = snps.coords[snpIdx]
+    snpKey = snps.snpKeys[snpIdx]
+    coordCacheKey = snps.coordCacheKeys[snpIdx]
     fxnKey = -1
     dirDist = []
 
     #
     # if SNP exists in the Alliane file
-    #   then set the fxnKey from the allianceLookup
+    #   then set the fxnKey from the allianceMarkerLookup
     #   there may be > 1 fxnKey
     #
-    allianceKey = snpId + ':' + markerId
-    if allianceKey in allianceLookup:
+    fxnKeys = None
+    if markerAlliance is not None:
+        fxnKeys = markerAlliance.get(snps.allianceKeys[snpIdx])
+    if fxnKeys is not None:
         dirDist = ['not applicable', 0]
         direction = dirDist[0]
         distance = int(dirDist[1])
-        for f in allianceLookup[allianceKey]:
-            fxnKey = f[4]
-            fp.write(snpWrite % (primaryKey, snpKey, markerKey, fxnKey, coordCacheKey, distance, direction))
+        for fxnKey in fxnKeys:
+            fp.addRow(primaryKey, snpKey, markerKey, fxnKey, coordCacheKey, distance, direction)
             primaryKey = primaryKey + 1
-        sys.stdout.flush()
         return
 
     #
@@ -387,7 +2715,6 @@ def processSNPmarkerPair(fp,      # file pointer of output file
     elif snpLoc >= markerStart and snpLoc <= markerEnd:
         fxnKey = fxnLookup[WITHIN_COORD_TERM]
         dirDist = ['not applicable', 0]
-        sys.stdout.flush()
     
     #
     # the SNP must be located within one of the pre-defined "KB" distances from the marker. 
@@ -395,10 +2722,9 @@ def processSNPmarkerPair(fp,      # file pointer of output file
     #
     else:
         dirDist = getKBTerm(snpLoc, markerStart, markerEnd, markerStrand)
-        sys.stdout.flush()
     
     if dirDist == []:
-        print(SNP_NOT_WITHIN % (snp, MARKER_PAD, marker, snpLoc, markerStart, markerEnd))
+        print(SNP_NOT_WITHIN % (str(snps.row(snpIdx)), MARKER_PAD, marker, snpLoc, markerStart, markerEnd))
         sys.stdout.flush()
         return
 
@@ -409,15 +2735,16 @@ def processSNPmarkerPair(fp,      # file pointer of output file
         direction = dirDist[0]
         distance = int(dirDist[1])
 
-    fp.write(snpWrite % (primaryKey, snpKey, markerKey, fxnKey, coordCacheKey, distance, direction))
+    fp.addRow(primaryKey, snpKey, markerKey, fxnKey, coordCacheKey, distance, direction)
     primaryKey = primaryKey + 1
-    sys.stdout.flush()
     return
 
 # Purpose: Use the SNP/marker coordinates and marker strand to determine
 #          if the SNP is within a MARKER_PAD distance from the marker.
-#          if it is, the appropriate term is returned for the annotation.
-# Returns: The term key or -1 (if the SNP is not within the distance)
+#          if it is, the direction & distance are returned for the annotation
+#          (see snpdirection.classifyPair).
+# Returns: [direction, distance], or [] (if the SNP is not within the distance
+#          or the strand is not classified)
 # Assumes: Nothing
 # Effects: Nothing
 # Throws: Nothing
@@ -431,96 +2758,40 @@ def getKBTerm(snpLoc, markerStart, markerEnd, markerStrand):
         return []
 
     #
-    #  Find the midpoint of the marker.
-    #
-    midPoint = (markerStart + markerEnd) / 2.0
-
-    #
-    #  If the SNP coordinate is <= the midpoint of the marker on a "+" strand, 
-    #   the SNP is considered to be upstream.
-    #
-    if markerStrand == '+' and snpLoc <= midPoint:
-        direction = 'upstream'
-        distance = markerStart - snpLoc
-    #
-    #  If the SNP coordinate is > the midpoint of the marker on a "+" strand, 
-    #   the SNP is considered to be downstream.
-    #
-    elif markerStrand == '+' and snpLoc > midPoint:
-        direction = 'downstream'
-        distance = snpLoc - markerEnd
-    #
-    #  If the SNP coordinate is <= the midpoint of the marker on a "-" strand, 
-    #   the SNP is considered to be downstream.
-    #
-    elif markerStrand == '-' and snpLoc <= midPoint:
-        direction = 'downstream'
-        distance = markerStart - snpLoc
-    #
-    #  If the SNP coordinate is > the midpoint of the marker on a "-" strand, 
-    #   the SNP is considered to be upstream.
+    #  upstream/downstream/proximal/distal of the marker midpoint, by strand
     #
-    elif markerStrand == '-' and snpLoc > midPoint:
-        direction = 'upstream'
-        distance = snpLoc - markerEnd
-    #
-    #  If the SNP coordinate is <= the midpoint of the marker and strand is Null, 
-    #   the SNP is considered to be proximal '.' strand 
-    #   for VISTA and Ensembl Regulatory features loaded as Gene Models because seq_coord_cache does not allow nulls
-    elif (markerStrand == None or markerStrand == '.') and snpLoc <= midPoint:
-        direction = 'proximal'
-        distance = markerStart - snpLoc
-    #
-    #  If the SNP coordinate is > the midpoint of the marker and strand is Null, 
-    #   the SNP is considered to be downstream.
-    #
-    elif (markerStrand == None or markerStrand == '.') and snpLoc > midPoint:
-        direction = 'distal'
-        distance = snpLoc - markerEnd
-    else:
+    direction, distance = snpdirection.classifyPair(snpLoc, markerStart, markerEnd, markerStrand)
+    if direction is None:
         return []
 
     dirDistList = [direction, distance]
     return dirDistList
 
-# Purpose: Do binary search through a list of dictionaries as typically returned from a call to db.sql()
-#          The list should be sorted in increasing order on some dict key.
-# Returns: Index in the list of a dictionary item whose key = the searchKey.
-#	   Or if no dictionary item matches that key,
-#	   Returns the max index of the list item whose key is < searchKey.
-#	   Returns -1 if searchKey < all dictionary item keys.
-# Assumes: list is sorted in increasing order of the keyField
+# Purpose: Do binary search through a list of coordinates (the coords column of a SNPTable)
+#          The list should be sorted in increasing order.
+# Returns: Index in the list of the last item = the searchKey.
+#	   Or if no item matches that key,
+#	   Returns the max index of the list item that is < searchKey.
+#	   Returns bottomIdx-1 if searchKey < all items in the range.
+#	   (i.e. the max index of the list item that is <= searchKey;
+#	   several SNPs may share a coordinate, and the caller scans backward
+#	   from this index, so it must not stop at the first match it finds)
+# Assumes: list is sorted in increasing order
 # Effects: Nothing
 # Throws: Nothing
 
-def listBinarySearch(list,	# the list to search, sorted by keyField
+def listBinarySearch(list,	# the list to search, sorted
                      searchKey, # the value to look for
                      bottomIdx, # lowest index in list[] to search
                      topIdx):	# max index in list[] to search
 
-    found = 0
-
-    while (bottomIdx != topIdx+1 and not found):
-        # check that (0+1)/2 = 0, (3+4)/2 = 3, etc.
-        midIdx = int((bottomIdx+topIdx)/2)		# integer division?
-        listvalue = list[midIdx]['startCoordinate']
-        if searchKey == listvalue:
-            found = 1
-        elif searchKey < listvalue:
-            topIdx = midIdx -1
-        else:
-            bottomIdx = midIdx +1
-    # end while
-
-    if found:
-        return midIdx
-    else:
-        return topIdx
+    return bisect.bisect_right(list, searchKey, bottomIdx, topIdx+1) - 1
 
 #
 #  MAIN
 #
-initialize()
-process()
-sys.exit(0)
+if __name__ == '__main__':
+    initialize()
+    process()
+    sys.exit(0)
 
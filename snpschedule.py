@@ -0,0 +1,209 @@
+#  snpschedule.py
+###########################################################################
+#
+#  Purpose:
+#
+#      Schedule the per-chromosome (or per-tile) jobs of snpmrkwithin.py
+#      and snpalliance.py on a worker pool, largest job first.
+#
+#      Processed in karyotype order, chromosome 1 or X can start last and
+#      keep one worker busy long after the others are idle.  Dispatching the
+#      most expensive jobs first (longest processing time first) keeps the
+#      pool busy until the end.
+#
+#      The cost of a job is estimated from:
+#
+#      1) its runtime in the last run (the runtime file of the script), or
+#      2) cheap statistics (SNPs & markers per chromosome estimated from the
+#         planner statistics, Alliance TSV or VCF file size; see
+#         chromosomeStats), scaled to seconds by the jobs that do have a
+#         runtime; only needed for the jobs without a runtime
+#
+#      After a run, the script saves the actual runtimes (saveRuntimes)
+#      to be used as the estimates of the next run.
+#
+#  Usage:
+#
+#      import snpschedule
+#
+#      estimates = snpschedule.estimate(jobs, stats, snpschedule.readRuntimes(fileName))
+#      for job in snpschedule.largestFirst(jobs, estimates): ...
+#      snpschedule.saveRuntimes(fileName, {job : seconds, ...})
+#
+#  Outputs:
+#
+#      the runtime file: 1 "job|seconds" line per job
+#
+###########################################################################
+
+import sys
+import os
+import db
+
+# list of chromosomes, in karyotype order
+chrList = [
+'1','2','3','4','5','6','7','8','9','10',
+'11','12','13','14','15','16','17','18','19',
+'X','Y','MT'
+]
+
+# Purpose: Read the runtimes of the last run
+# Returns: dictionary job -> seconds; empty if fileName does not exist
+# Assumes: Nothing
+# Effects: Reads fileName
+# Throws:  Nothing
+
+def readRuntimes(fileName):
+
+    runtimes = {}
+
+    if not fileName or not os.path.exists(fileName):
+        return runtimes
+
+    with open(fileName, 'r') as fp:
+        for line in fp:
+            job, seconds = line.rstrip('\n').split('|')
+            runtimes[job] = float(seconds)
+
+    return runtimes
+
+# Purpose: Save the runtimes of this run, keeping those of the jobs that did
+#          not run (e.g. the unchanged chromosomes of an incremental run)
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Writes fileName (through fileName.new, so that it is never partial)
+# Throws:  Nothing
+
+def saveRuntimes(fileName, runtimes):
+
+    if not fileName:
+        return
+
+    saved = readRuntimes(fileName)
+    saved.update(runtimes)
+
+    with open(fileName + '.new', 'w') as fp:
+        for job in sorted(saved):
+            fp.write('%s|%.3f\n' % (job, saved[job]))
+    os.replace(fileName + '.new', fileName)
+
+    return
+
+# Purpose: Estimate the statistics used to estimate the cost of each chromosome:
+#          its number of SNPs (SNP_Coord_Cache) & markers (MRK_Location_Cache)
+#          from the planner statistics (see columnCounts), so no table is scanned
+# Returns: dictionary chromosome -> {'snps' : n, 'markers' : n}
+# Assumes: Nothing
+# Effects: Queries a database
+# Throws:  Nothing
+
+def chromosomeStats():
+
+    snps = columnCounts('SNP_Coord_Cache', 'chromosome')
+    markers = columnCounts('MRK_Location_Cache', 'genomicchromosome')
+
+    stats = {}
+    for chr in chrList:
+        stats[chr] = {'snps' : snps.get(chr, 0), 'markers' : markers.get(chr, 0)}
+
+    return stats
+
+# Purpose: Estimate the number of rows of a table per value of a column:
+#          pg_class.reltuples times the frequency of the value in the
+#          most common values of the column (pg_stats), as of the last
+#          ANALYZE.  A column with few values (e.g. chromosome) has all of
+#          them in its most common values.  Approximate: e.g. the markers of
+#          every organism and marker type are counted.
+# Returns: dictionary value -> estimated rows; empty if the column has no statistics
+# Assumes: the values do not contain commas, quotes or braces
+# Effects: Queries a database
+# Throws:  Nothing
+
+def columnCounts(tableName, columnName):
+
+    counts = {}
+
+    results = db.sql('''
+            select s.most_common_vals::text as vals, s.most_common_freqs::text as freqs,
+                   greatest(c.reltuples, 0) as reltuples
+            from pg_stats s, pg_class c, pg_namespace n
+            where s.tablename = lower('%s')
+            and s.attname = lower('%s')
+            and c.relname = s.tablename
+            and c.relnamespace = n.oid
+            and n.nspname = s.schemaname
+            ''' % (tableName, columnName), 'auto')
+
+    for r in results[:1]:
+        if r['vals'] is None or r['freqs'] is None:
+            break
+        values = r['vals'].strip('{}').split(',')
+        freqs = r['freqs'].strip('{}').split(',')
+        for value, freq in zip(values, freqs):
+            counts[value] = int(float(r['reltuples']) * float(freq))
+
+    return counts
+
+# Purpose: Size of a file, 0 if it does not exist
+# Returns: number of bytes
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  Nothing
+
+def fileSize(fileName):
+
+    try:
+        return os.path.getsize(fileName)
+    except OSError:
+        return 0
+
+# Purpose: Estimate the cost (seconds) of each job:
+#          its runtime in the last run if there is one; otherwise its
+#          statistical cost times the seconds per unit of cost of the jobs
+#          that have a runtime (or, if none has, the cost itself).
+# Returns: dictionary job -> estimate
+# Assumes: costs: dictionary job -> statistical cost (any unit, > 0 for real work)
+# Effects: Nothing
+# Throws:  Nothing
+
+def estimate(jobs, costs, runtimes):
+
+    known = [job for job in jobs if job in runtimes and costs.get(job, 0) > 0]
+    if known:
+        rate = sum([runtimes[job] for job in known]) / sum([costs[job] for job in known])
+    else:
+        rate = 1.0
+
+    estimates = {}
+    for job in jobs:
+        if job in runtimes:
+            estimates[job] = runtimes[job]
+        else:
+            estimates[job] = costs.get(job, 0) * rate
+
+    return estimates
+
+# Purpose: Order the jobs largest (estimated) first; jobs with the same
+#          estimate keep their order
+# Returns: list of jobs
+# Assumes: estimates: dictionary job -> estimate (see estimate)
+# Effects: Nothing
+# Throws:  Nothing
+
+def largestFirst(jobs, estimates):
+
+    return sorted(jobs, key = lambda job: -estimates.get(job, 0))
+
+# Purpose: Print the schedule: each job and its estimate, in dispatch order
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Outputs to stdout
+# Throws:  Nothing
+
+def printSchedule(name, jobs, estimates):
+
+    print('%s: schedule (largest first): %s' \
+        % (name, ' '.join(['%s (%.1f)' % (job, estimates.get(job, 0)) for job in jobs])))
+    sys.stdout.flush()
+
+    return
@@ -0,0 +1,440 @@
+#  snpsynthbench.py
+###########################################################################
+#
+#  Purpose:
+#
+#      Offline benchmark of the snpmrkwithin.py SNP-marker join & bcp writer
+#      (processSNPregion/streamProcess, listBinarySearch, processSNPmarkerPair,
+#      getKBTerm, joinMarker, BCPWriter), without a database.
+#
+#      A synthetic genome is generated from a seed:
+#
+#      . SNPs at a given density, uniformly placed, some sharing a coordinate
+#      . markers with log-normal lengths and a given strand mix
+#        (+, -, '.' and None, i.e. the MIT/VISTA/Ensembl regulatory cases)
+#      . an Alliance TSV per chromosome, with rows for a given fraction of
+#        the SNPs within a marker (1 or 2 fxn classes each)
+#
+#      snpmrkwithin.py is then run on each chromosome, once per engine and
+#      fetch size, with a stand-in for the db module (SyntheticDB) that
+#      answers its queries from the generated data.  Each run is a separate
+#      process, so its memory use is its own.
+#
+#      For each run: pairs, wall & CPU time, pairs/sec, peak RSS (and its
+#      growth during the run), and the md5 of the bcp file.  The runs must
+#      all create the same bcp file.
+#
+#      The sql engine (sqlProcess, whose join runs in the database) is not
+#      covered: SyntheticDB cannot answer its query.  snpbench.py checks it
+#      against the pair & batch engines (and times it) on a database.
+#
+#      With -b, the results are compared with (or, if the file does not
+#      exist yet, saved as) a baseline: a different md5 is a correctness
+#      regression, pairs/sec more than the tolerance below the baseline a
+#      speed regression.
+#
+#  Usage:
+#
+#      snpsynthbench.py [options]
+#
+#      -c chr,...      chromosomes (default: 1)
+#      -l bp           length of each chromosome (default: 5000000)
+#      -d n            SNPs per Mb (default: 30000)
+#      -k n            markers per Mb (default: 20)
+#      -m bp           median marker length (default: 10000)
+#      -g sigma        sigma of the log-normal marker length (default: 1.5)
+#      -s mix          strand mix, strand:weight,... (default: +:45,-:45,.:5,none:5)
+#      -a fraction     fraction of the SNPs within a marker that have Alliance rows (default: 0.05)
+#      -u fraction     fraction of the SNPs that share the coordinate of the previous SNP (default: 0.01)
+#      -r seed         random seed (default: 1)
+#      -e engine,...   SNPMRK_ENGINE values to run (default: pair,batch)
+#      -f n,...        SNPMRK_FETCH_SIZE values to run (default: 0)
+#      -b file         baseline results (JSON)
+#      -t fraction     speed regression tolerance (default: 0.25)
+#      -o dir          work directory (default: a temporary directory, removed when done)
+#      -v              keep the snpmrkwithin.py output
+#
+#  Outputs:
+#
+#      one line per chromosome & run; baseline file (-b)
+#
+#  Exit Codes:
+#
+#      0:  Successful completion
+#      1:  A run failed, the runs created different bcp files, or a regression
+#          against the baseline
+#
+###########################################################################
+
+import sys
+import os
+import re
+import bisect
+import getopt
+import hashlib
+import itertools
+import json
+import math
+import random
+import resource
+import shutil
+import tempfile
+import types
+import multiprocessing
+
+#
+#  CONSTANTS
+#
+
+USAGE = 'Usage: snpsynthbench.py [-c chr,...] [-l bp] [-d snps/Mb] [-k markers/Mb] [-m bp] [-g sigma]\n' + \
+        '       [-s strand:weight,...] [-a fraction] [-u fraction] [-r seed]\n' + \
+        '       [-e engine,...] [-f n,...] [-b baseline] [-t fraction] [-o dir] [-v]\n'
+
+WITHIN_COORD_KEY = 1
+WITHIN_KB_KEY = 2
+
+# Alliance fxn classes: (consequence, _Term_key, term)
+ALLIANCE_FXN = [
+    ('missense_variant', 3, 'missense'),
+    ('intron_variant', 4, 'intron'),
+    ('synonymous_variant', 5, 'synonymous'),
+    ('3_prime_UTR_variant', 6, 'utr-3'),
+    ('splice_region_variant', 7, 'splice-site'),
+]
+
+# keys of each chromosome start at chromosome number * KEY_BLOCK
+KEY_BLOCK = 100000000
+
+# generated data, by chromosome: {'snps' : [...], 'coords' : [...], 'markers' : [...]}
+genome = {}
+
+# Purpose: Stand-in for the db module: answers the queries snpmrkwithin.py
+#          makes to process a chromosome (initialize, maxCoordinate,
+#          snp_cursor, queryMarkers) from genome.  Any other query is an error.
+
+class SyntheticDB:
+
+    def __init__(self):
+        self.cursor = None
+
+    def sql(self, q, fmt = 'auto'):
+        q = ' '.join(q.split())
+
+        if q.startswith('fetch forward'):
+            n = int(q.split()[2])
+            return list(itertools.islice(self.cursor, n))
+
+        if q.startswith('declare snp_cursor'):
+            chr, start, end = self.range(q, r'sc\.chromosome = \'([^\']*)\'', r'between (-?\d+) and (-?\d+)')
+            g = genome[chr]
+            lo = bisect.bisect_left(g['coords'], start)
+            hi = bisect.bisect_right(g['coords'], end)
+            self.cursor = iter(g['snps'][lo:hi])
+            return None
+
+        if q.startswith('close snp_cursor'):
+            self.cursor = None
+            return None
+
+        if 'from VOC_Term' in q:
+            return [{'_term_key' : WITHIN_COORD_KEY, 'term' : 'within coordinates of'},
+                    {'_term_key' : WITHIN_KB_KEY, 'term' : 'within distance of'}]
+
+        if 'max(startCoordinate)' in q:
+            chr = re.search(r'chromosome = \'([^\']*)\'', q).group(1)
+            return [{'maxCoord' : genome[chr]['coords'][-1] if genome[chr]['coords'] else None}]
+
+        if 'from MRK_Location_Cache' in q:
+            chr = re.search(r'genomicchromosome = \'([^\']*)\'', q).group(1)
+            start = int(re.search(r'mc\.endCoordinate >= (-?\d+)', q).group(1))
+            end = int(re.search(r'mc\.startCoordinate <= (-?\d+)', q).group(1))
+            return [m for m in genome[chr]['markers'] if m['markerEnd'] >= start and m['markerStart'] <= end]
+
+        raise ValueError('SyntheticDB: unexpected query: %s' % (q))
+
+    def range(self, q, chrPattern, rangePattern):
+        m = re.search(rangePattern, q)
+        return re.search(chrPattern, q).group(1), int(m.group(1)), int(m.group(2))
+
+# Purpose: Install SyntheticDB as the db module (and an empty loadlib if
+#          there is none), so that snpmrkwithin.py can be imported
+# Returns: Nothing
+# Assumes: snpmrkwithin.py has not been imported yet
+# Effects: sys.modules
+# Throws:  Nothing
+
+def installSyntheticDB():
+
+    stub = SyntheticDB()
+    module = types.ModuleType('db')
+    module.sql = stub.sql
+    module.setTrace = lambda *args: None
+    module.useOneConnection = lambda *args: None
+    module.commit = lambda: None
+    sys.modules['db'] = module
+
+    try:
+        import loadlib
+    except ImportError:
+        sys.modules['loadlib'] = types.ModuleType('loadlib')
+
+    return
+
+# Purpose: Parse a strand mix: strand:weight,... ('none' is a null strand)
+# Returns: list of strands, list of cumulative weights
+# Assumes: Nothing
+# Effects: Nothing
+# Throws:  ValueError if the mix cannot be parsed
+
+def parseStrandMix(mix):
+
+    strands = []
+    weights = []
+    total = 0.0
+    for item in mix.split(','):
+        strand, weight = item.rsplit(':', 1)
+        if strand == 'none':
+            strand = None
+        total = total + float(weight)
+        strands.append(strand)
+        weights.append(total)
+
+    return strands, weights
+
+# Purpose: Generate the SNPs, markers & Alliance TSV of one chromosome
+# Returns: Nothing
+# Assumes: Nothing
+# Effects: Adds the chromosome to genome, writes its Alliance TSV
+# Throws:  Nothing
+
+def generateChromosome(rng, chrNumber, chr, settings, tsvFile):
+
+    length = settings['length']
+    keyBase = chrNumber * KEY_BLOCK
+    strands, weights = parseStrandMix(settings['strands'])
+
+    #
+    # SNPs, in SNP_ORDER
+    #
+    coords = sorted([rng.randint(1, length) for i in range(int(length / 1000000.0 * settings['density']))])
+    for i in range(1, len(coords)):
+        if rng.random() < settings['duplicates']:
+            coords[i] = coords[i-1]
+
+    snps = []
+    for i in range(len(coords)):
+        snps.append({'_consensussnp_key' : keyBase + i,
+                     '_coord_cache_key' : keyBase + i,
+                     'startCoordinate' : coords[i],
+                     'accid' : 'rs%s' % (keyBase + i)})
+
+    #
+    # markers, in MARKER_ORDER
+    #
+    markers = []
+    for i in range(int(length / 1000000.0 * settings['markers'])):
+        markerLength = max(1, int(rng.lognormvariate(math.log(settings['median']), settings['sigma'])))
+        start = rng.randint(1, length)
+        strand = strands[bisect.bisect_left(weights, rng.random() * weights[-1])]
+        markers.append({'markerId' : 'MGI:%s' % (keyBase + i),
+                        '_marker_key' : keyBase + i,
+                        'markerStart' : start,
+                        'markerEnd' : min(length, start + markerLength - 1),
+                        'markerStrand' : strand})
+    markers.sort(key = lambda m: (m['markerStart'], m['markerEnd'], m['_marker_key']))
+
+    #
+    # Alliance rows for some of the SNPs within each marker
+    #
+    rows = 0
+    with open(tsvFile, 'w') as fp:
+        for m in markers:
+            lo = bisect.bisect_left(coords, m['markerStart'])
+            hi = bisect.bisect_right(coords, m['markerEnd'])
+            for i in range(lo, hi):
+                if rng.random() >= settings['overlap']:
+                    continue
+                for consequence, fxnKey, term in rng.sample(ALLIANCE_FXN, 1 + (rng.random() < 0.3)):
+                    fp.write('%s|%s|Sym%s|%s|%s|%s\n' % (snps[i]['accid'], m['markerId'], m['_marker_key'], consequence, fxnKey, term))
+                    rows = rows + 1
+
+    genome[chr] = {'snps' : snps, 'coords' : coords, 'markers' : markers}
+
+    print('chromosome %s: %s SNPs, %s markers, %s Alliance rows' % (chr, len(snps), len(markers), rows))
+    sys.stdout.flush()
+
+    return
+
+# Purpose: Run snpmrkwithin.py on one chromosome with one engine & fetch size
+#          (in a child process)
+# Returns: metrics of the chromosome (see snpmrkwithin.ChromosomeMetrics)
+#          + the RSS at the start of the run and the md5 of the bcp file
+# Assumes: generateChromosome() has been called for chr
+# Effects: creates & removes bcpFile
+# Throws:  Nothing
+
+def runBench(chr, engine, fetchSize, bcpFile, verbose):
+
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+
+    snpmrkwithin.ENGINE = engine
+    snpmrkwithin.FETCH_SIZE = fetchSize
+    snpmrkwithin.primaryKey = 1
+
+    startRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    record = snpmrkwithin.processChromosome(chr, bcpFile)
+    record['startRssKb'] = startRss
+
+    md5 = hashlib.md5()
+    with open(bcpFile, 'rb') as fp:
+        for block in iter(lambda: fp.read(1048576), b''):
+            md5.update(block)
+    os.remove(bcpFile)
+    record['md5'] = md5.hexdigest()
+
+    sys.stdout.flush()
+
+    return record
+
+#
+#  MAIN
+#
+
+settings = {'chromosomes' : '1',
+            'length' : 5000000,
+            'density' : 30000.0,
+            'markers' : 20.0,
+            'median' : 10000.0,
+            'sigma' : 1.5,
+            'strands' : '+:45,-:45,.:5,none:5',
+            'overlap' : 0.05,
+            'duplicates' : 0.01,
+            'seed' : 1}
+options = {'-c' : ('chromosomes', str), '-l' : ('length', int), '-d' : ('density', float),
+           '-k' : ('markers', float), '-m' : ('median', float), '-g' : ('sigma', float),
+           '-s' : ('strands', str), '-a' : ('overlap', float), '-u' : ('duplicates', float),
+           '-r' : ('seed', int)}
+
+engines = ['pair', 'batch']
+fetchSizes = [0]
+baselineFile = None
+tolerance = 0.25
+workDir = None
+verbose = 0
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:], 'c:l:d:k:m:g:s:a:u:r:e:f:b:t:o:v')
+    for opt, value in opts:
+        if opt in options:
+            settings[options[opt][0]] = options[opt][1](value)
+        elif opt == '-e':
+            engines = value.split(',')
+        elif opt == '-f':
+            fetchSizes = [int(n) for n in value.split(',')]
+        elif opt == '-b':
+            baselineFile = value
+        elif opt == '-t':
+            tolerance = float(value)
+        elif opt == '-o':
+            workDir = value
+        else:
+            verbose = 1
+    parseStrandMix(settings['strands'])
+except (getopt.GetoptError, ValueError) as e:
+    sys.stderr.write('%s\n%s' % (e, USAGE))
+    sys.exit(1)
+
+for engine in engines:
+    if engine not in ('pair', 'batch'):
+        sys.stderr.write('Unknown engine: %s (the sql engine needs a database; see snpbench.py)\n' % (engine))
+        sys.exit(1)
+
+removeWorkDir = workDir is None
+if workDir is None:
+    workDir = tempfile.mkdtemp(prefix = 'snpsynthbench.')
+
+#
+# snpmrkwithin.py reads its configuration when it is imported
+#
+os.environ['CACHEDATADIR'] = workDir
+os.environ['SNP_MRK_TABLE'] = 'SNP_ConsensusSnp_Marker'
+os.environ['SNP_MRK_FILE'] = 'SNP_ConsensusSnp_Marker.bcp'
+os.environ['SNP_ALLIANCE_TSV'] = workDir + '/snpalliance.output'
+os.environ['SNPMRK_SNAPSHOT'] = 'no'
+os.environ['SNP_ALLIANCE_KEYS'] = 'no'
+os.environ['SNPMRK_SQL_CHROMOSOMES'] = ''
+os.environ['SNPMRK_DIRECT_LOAD'] = 'no'
+
+installSyntheticDB()
+import snpmrkwithin
+snpmrkwithin.fxnLookup = {snpmrkwithin.WITHIN_COORD_TERM : WITHIN_COORD_KEY, snpmrkwithin.WITHIN_KB_TERM : WITHIN_KB_KEY}
+
+rng = random.Random(settings['seed'])
+chromosomes = settings['chromosomes'].split(',')
+for chrNumber, chr in enumerate(chromosomes):
+    generateChromosome(rng, chrNumber + 1, chr, settings, '%s.%s.tsv' % (os.environ['SNP_ALLIANCE_TSV'], chr))
+
+results = {}
+failed = 0
+for chr in chromosomes:
+    for engine in engines:
+        for fetchSize in fetchSizes:
+            name = '%s %s %s' % (chr, engine, fetchSize)
+            pool = multiprocessing.get_context('fork').Pool(1)
+            try:
+                results[name] = pool.apply(runBench, (chr, engine, fetchSize, '%s/synth.%s.%s.%s.bcp' % (workDir, chr, engine, fetchSize), verbose))
+            except Exception as e:
+                sys.stderr.write('%s: failed: %s\n' % (name, e))
+                failed = 1
+            pool.close()
+            pool.join()
+
+if removeWorkDir:
+    shutil.rmtree(workDir)
+
+print('\n%-5s %-6s %6s %10s %10s %8s %8s %10s %8s %8s  %s' % ('chr', 'engine', 'fetch', 'snps', 'pairs', \
+    'wall', 'cpu', 'pairs/sec', 'rss MB', '+rss MB', 'md5'))
+for name in sorted(results):
+    chr, engine, fetchSize = name.split()
+    r = results[name]
+    print('%-5s %-6s %6s %10s %10s %8.2f %8.2f %10.0f %8.1f %8.1f  %s' % (chr, engine, fetchSize, r['snps'], r['pairs'], \
+        r['wall'], r['cpu'], r['pairsPerSec'], r['peakRssKb'] / 1024.0, (r['peakRssKb'] - r['startRssKb']) / 1024.0, r['md5']))
+
+for chr in chromosomes:
+    if len(set([r['md5'] for name, r in results.items() if name.split()[0] == chr])) > 1:
+        print('chromosome %s: ERROR: the runs created different bcp files' % (chr))
+        failed = 1
+
+#
+# compare with (or save) the baseline
+#
+if baselineFile and os.path.exists(baselineFile):
+    with open(baselineFile, 'r') as fp:
+        baseline = json.load(fp)
+    if baseline['settings'] != settings:
+        print('\nbaseline %s: ERROR: generated with different settings: %s' % (baselineFile, baseline['settings']))
+        failed = 1
+    else:
+        print('\nbaseline %s:' % (baselineFile))
+        for name in sorted(results):
+            if name not in baseline['results']:
+                continue
+            old = baseline['results'][name]
+            new = results[name]
+            ratio = new['pairsPerSec'] / max(old['pairsPerSec'], 0.001)
+            status = 'ok'
+            if new['md5'] != old['md5']:
+                status = 'ERROR: different bcp file'
+                failed = 1
+            elif ratio < 1 - tolerance:
+                status = 'ERROR: slower'
+                failed = 1
+            print('%-20s %10.0f -> %10.0f pairs/sec (%5.2fx)  %s' % (name, old['pairsPerSec'], new['pairsPerSec'], ratio, status))
+elif baselineFile and not failed:
+    with open(baselineFile, 'w') as fp:
+        json.dump({'settings' : settings, 'results' : results}, fp, indent = 1, sort_keys = True)
+    print('\nbaseline saved: %s' % (baselineFile))
+
+sys.stdout.flush()
+sys.exit(failed)